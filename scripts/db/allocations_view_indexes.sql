@@ -0,0 +1,12 @@
+
+--- allocations_view: add a key and the index used by lookups and deletes.
+--- Afterwards repopulate it with
+---   python -m allocation.entrypoints.rebuild_allocations_view
+ALTER TABLE public.allocations_view ADD COLUMN id serial PRIMARY KEY;
+
+ALTER TABLE public.allocations_view ALTER COLUMN orderid SET NOT NULL;
+
+ALTER TABLE public.allocations_view ALTER COLUMN sku SET NOT NULL;
+
+CREATE INDEX ix_allocations_view_orderid_sku
+    ON public.allocations_view USING btree (orderid, sku);
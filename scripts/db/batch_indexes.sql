@@ -0,0 +1,11 @@
+
+--- batches: references are unique, and products load their batches by sku
+CREATE UNIQUE INDEX ix_batches_reference
+    ON public.batches USING btree (reference);
+
+CREATE INDEX ix_batches_sku
+    ON public.batches USING btree (sku);
+
+--- allocations: loaded per batch
+CREATE INDEX ix_allocations_batch_id
+    ON public.allocations USING btree (batch_id);
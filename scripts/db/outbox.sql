@@ -0,0 +1,14 @@
+
+--- outbox: events waiting for the outbox relay to publish them, written in
+--- the same transaction as the change they describe
+CREATE TABLE public.outbox
+(
+    id serial NOT NULL,
+    channel character varying(255) NOT NULL,
+    payload text NOT NULL,
+    created_at timestamp without time zone NOT NULL DEFAULT now(),
+    CONSTRAINT outbox_pkey PRIMARY KEY (id)
+);
+
+ALTER TABLE public.outbox
+    OWNER to allocation;
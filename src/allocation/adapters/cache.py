@@ -0,0 +1,210 @@
+import abc
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+from redis import WatchError
+
+
+class AbstractCache(abc.ABC):
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self._get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, hit_ratio=self.hit_ratio)
+
+    @abc.abstractmethod
+    def _get(self, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set(self, key: str, value: Any):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, *keys: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def clear(self):
+        """Deletes every key."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def generation(self, key: str) -> Any:
+        """A token that changes whenever key is deleted."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_if_unchanged(self, key: str, value: Any, generation: Any) -> bool:
+        """
+        Sets key unless it was deleted since generation() returned
+        generation: a value read before then may be stale.
+        """
+        raise NotImplementedError
+
+
+class LRUCache(AbstractCache):
+    """
+    In-process cache. Only this process's invalidations reach it, so
+    changes made by other processes show up once the TTL runs out.
+    """
+
+    def __init__(self, maxsize=10_000, ttl=60.0, clock=time.monotonic):
+        super().__init__()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()  # type: OrderedDict
+        self.lock = threading.Lock()
+        # the count of deletions when each key was last deleted, for the
+        # latest maxsize keys; older keys were deleted by deletions_forgotten
+        self.deletions = 0
+        self.deleted = OrderedDict()  # type: OrderedDict
+        self.deletions_forgotten = 0
+
+    def _get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= self.clock():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self._set(key, value)
+
+    def _set(self, key, value):
+        self.entries[key] = (self.clock() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self.lock:
+            self.deletions += 1
+            for key in keys:
+                self.entries.pop(key, None)
+                self.deleted[key] = self.deletions
+                self.deleted.move_to_end(key)
+            while len(self.deleted) > self.maxsize:
+                _, self.deletions_forgotten = self.deleted.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.deletions += 1
+            self.deleted.clear()
+            self.deletions_forgotten = self.deletions
+
+    def generation(self, key):
+        with self.lock:
+            return self.deletions
+
+    def set_if_unchanged(self, key, value, generation):
+        with self.lock:
+            if self.deleted.get(key, self.deletions_forgotten) > generation:
+                return False
+            self._set(key, value)
+        return True
+
+
+class AggregateCache(LRUCache):
+    """
+    Aggregates kept resident between units of work. Getting one checks it
+    out, so no two units of work ever share an instance; it comes back
+    with set() once its changes are committed. Staleness is caught by the
+    caller's version check rather than a TTL.
+    """
+
+    def __init__(self, maxsize=1_000, clock=time.monotonic):
+        super().__init__(maxsize=maxsize, ttl=float('inf'), clock=clock)
+        self.conflicts = 0
+
+    def _get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+        return None if entry is None else entry[1]
+
+    def stats(self):
+        return dict(
+            super().stats(), conflicts=self.conflicts, size=len(self.entries),
+        )
+
+
+class RedisCache(AbstractCache):
+    """Shared by every process, so invalidations are seen everywhere."""
+
+    def __init__(self, client, ttl=60, prefix='allocations:'):
+        super().__init__()
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value):
+        self.client.setex(self.prefix + key, self.ttl, json.dumps(value))
+
+    def delete(self, *keys):
+        if not keys:
+            return
+        # in one transaction, so no reader can set a key in between
+        pipe = self.client.pipeline()
+        pipe.delete(*(self.prefix + key for key in keys))
+        for key in keys:
+            pipe.incr(self._generation_key(key))
+            pipe.expire(self._generation_key(key), self.ttl)
+        pipe.execute()
+
+    def clear(self):
+        keys = [
+            key.decode()[len(self.prefix):]
+            for key in self.client.scan_iter(match=self.prefix + '*', count=1000)
+            if not key.endswith(b':generation')
+        ]
+        for start in range(0, len(keys), 1000):
+            self.delete(*keys[start:start + 1000])
+
+    def generation(self, key):
+        return self.client.get(self._generation_key(key))
+
+    def set_if_unchanged(self, key, value, generation):
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(self._generation_key(key))
+                if pipe.get(self._generation_key(key)) != generation:
+                    return False
+                pipe.multi()
+                pipe.setex(self.prefix + key, self.ttl, json.dumps(value))
+                pipe.execute()
+            except WatchError:
+                return False
+        return True
+
+    def _generation_key(self, key):
+        return f'{self.prefix}{key}:generation'
@@ -0,0 +1,150 @@
+import abc
+import bisect
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, List, Tuple
+
+SECONDS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0,
+)
+COUNTS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+HISTOGRAMS = {  # type: Dict[str, Tuple[str, Tuple[float, ...]]]
+    'allocation_message_seconds': (
+        'Time to handle one message, by type and kind', SECONDS,
+    ),
+    'allocation_messages_per_handle': (
+        'Messages processed by one MessageBus.handle call', COUNTS,
+    ),
+    'allocation_transaction_seconds': (
+        'Unit of work duration, by outcome', SECONDS,
+    ),
+    'allocation_commit_seconds': ('Time spent committing', SECONDS),
+    'allocation_scan_length': (
+        'Batch index nodes examined per allocation', COUNTS,
+    ),
+}
+
+COUNTERS = {
+    'allocation_handler_errors_total': (
+        'Exceptions raised by handlers, by message type and handler'
+    ),
+    'allocation_command_retries_total': (
+        'Commands retried after a concurrency conflict, by message type'
+    ),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class AbstractMetrics(abc.ABC):
+
+    @abc.abstractmethod
+    def observe(self, name: str, value: float, **labels: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def increment(self, name: str, amount: float = 1, **labels: str):
+        raise NotImplementedError
+
+
+class PrometheusMetrics(AbstractMetrics):
+    """
+    Histograms and counters kept in process, rendered in the Prometheus
+    text format. Each process has its own, so scrape every worker.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # per bucket counts (the last one is +Inf), then the sum
+        self.histograms = {}  # type: Dict[Tuple[str, Labels], List[float]]
+        self.counters = defaultdict(float)  # type: Dict[Tuple[str, Labels], float]
+        self.samplers = []  # type: List[Callable[[], Dict[str, float]]]
+
+    def observe(self, name, value, **labels):
+        buckets = HISTOGRAMS[name][1]
+        key = (name, tuple(sorted(labels.items())))
+        i = bisect.bisect_left(buckets, value)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(buckets) + 2)
+            histogram[i] += 1
+            histogram[-1] += value
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += amount
+
+    def add_samples(self, callback: Callable[[], Dict[str, float]]):
+        """
+        Adds samples read at render time, e.g. connection pool stats:
+        counters when named *_total, gauges otherwise.
+        """
+        if callback not in self.samplers:
+            self.samplers.append(callback)
+
+    def render(self) -> str:
+        with self.lock:
+            histograms = {k: list(v) for k, v in self.histograms.items()}
+            counters = dict(self.counters)
+        lines = []
+        for name, (help_text, buckets) in HISTOGRAMS.items():
+            series = sorted(
+                (labels, values) for (n, labels), values in histograms.items()
+                if n == name
+            )
+            if not series:
+                continue
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+            bounds = [repr(float(bound)) for bound in buckets] + ['+Inf']
+            for labels, values in series:
+                cumulative = 0
+                for le, count in zip(bounds, values):
+                    cumulative += int(count)
+                    lines.append(
+                        f'{name}_bucket{format_labels(labels, le=le)} {cumulative}'
+                    )
+                lines.append(f'{name}_sum{format_labels(labels)} {values[-1]}')
+                lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+        for name, help_text in COUNTERS.items():
+            samples = sorted(
+                (labels, value) for (n, labels), value in counters.items()
+                if n == name
+            )
+            if not samples:
+                continue
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            lines += [
+                f'{name}{format_labels(labels)} {value}'
+                for labels, value in samples
+            ]
+        for callback in self.samplers:
+            for name, value in callback().items():
+                kind = 'counter' if name.endswith('_total') else 'gauge'
+                lines += [f'# TYPE {name} {kind}', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels: Labels, **extra: str) -> str:
+    pairs = [*labels, *extra.items()]
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        f'{key}="{escape(str(value))}"' for key, value in pairs
+    ) + '}'
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def handler_name(handler) -> str:
+    # injected handlers are partials of the real function
+    return getattr(getattr(handler, 'func', handler), '__name__', repr(handler))
+
+
+# one registry per process, shared by every bus in it
+REGISTRY = PrometheusMetrics()
@@ -1,28 +1,159 @@
 import abc
+import atexit
+import logging
+import queue
 import smtplib
+import threading
+import time
 from allocation import config
 
+logger = logging.getLogger(__name__)
+
+
 class AbstractNotifications(abc.ABC):
 
   @abc.abstractmethod
   def send(self, destination, message):
     raise NotImplementedError
 
-CFG = config.get_email_host_and_port()
+FROM_ADDR = 'allocations@example.com'
+
+
+def format_email(message):
+  return f'Subject: allocation service notification\n{message}'
+
+
+def smtp_connector(smtp_host=None, port=None):
+  """Opens an SMTP connection when called; host and port default to config."""
+  if smtp_host is None or port is None:
+    settings = config.get_email_host_and_port()
+    smtp_host = smtp_host or settings['host']
+    port = port or settings['port']
+  return lambda: smtplib.SMTP(smtp_host, port=port)
 
-DEFAULT_HOST = CFG['host']
-DEFAULT_PORT = CFG['port']
 
 class EmailNotifications(AbstractNotifications):
 
-  def __init__(self, smtp_host=DEFAULT_HOST, port=DEFAULT_PORT):
-    self.server = smtplib.SMTP(smtp_host, port=port)
-    self.server.noop()
+  def __init__(self, smtp_host=None, port=None):
+    self.connect = smtp_connector(smtp_host, port)
+    self.server = None  # connected on the first send
 
   def send(self, destination, message):
-    msg = f'Subject: allocation service notification\n{message}'
+    if self.server is None:
+      self.server = self.connect()
+    msg = format_email(message)
     self.server.sendmail(
-      from_addr='allocations@example.com',
+      from_addr=FROM_ADDR,
       to_addrs=[destination],
       msg=msg
-    )
\ No newline at end of file
+    )
+
+
+class QueuedEmailNotifications(AbstractNotifications):
+  """
+  Hands messages to a pool of worker threads, so send() never waits on
+  SMTP. Each worker keeps its own connection, opened on first use and
+  reopened when the server drops it. A message identical to one sent to
+  the same destination within dedup_window seconds is dropped, so a storm
+  of out-of-stock events for one SKU produces a single email.
+  """
+
+  def __init__(
+    self, smtp_host=None, port=None, workers=2,
+    dedup_window=300.0, max_queued=1000, connect=None, clock=time.monotonic,
+  ):
+    self.connect = connect or smtp_connector(smtp_host, port)
+    self.workers = workers
+    self.dedup_window = dedup_window
+    self.clock = clock
+    self.queue = queue.Queue(maxsize=max_queued)  # type: queue.Queue
+    self.last_sent = {}  # type: dict
+    self.lock = threading.Lock()
+    self.threads = []  # type: list
+
+  def send(self, destination, message):
+    if self.is_duplicate(destination, message):
+      logger.debug('dropping duplicate notification %s', message)
+      return
+    self.start()
+    try:
+      self.queue.put_nowait((destination, message))
+    except queue.Full:
+      logger.error('notification queue full, dropping %s', message)
+      # never sent, so the next one may go
+      with self.lock:
+        self.last_sent.pop((destination, message), None)
+
+  def is_duplicate(self, destination, message):
+    now = self.clock()
+    key = (destination, message)
+    with self.lock:
+      last = self.last_sent.get(key)
+      if last is not None and now - last < self.dedup_window:
+        return True
+      self.last_sent[key] = now
+      if len(self.last_sent) > 10_000:
+        self.last_sent = {
+          k: t for k, t in self.last_sent.items()
+          if now - t < self.dedup_window
+        }
+    return False
+
+  def start(self):
+    with self.lock:
+      if self.threads:
+        return
+      self.threads = [
+        threading.Thread(target=self._work, daemon=True)
+        for _ in range(self.workers)
+      ]
+    for thread in self.threads:
+      thread.start()
+    atexit.register(self.close)
+
+  def flush(self):
+    self.queue.join()
+
+  def close(self):
+    for _ in self.threads:
+      self.queue.put(None)
+    for thread in self.threads:
+      thread.join()
+    self.threads = []
+
+  def _work(self):
+    server = None
+    while True:
+      item = self.queue.get()
+      try:
+        if item is None:
+          break
+        server = self._deliver(server, *item)
+      except Exception:  # pylint: disable=broad-except
+        logger.exception('Exception sending notification %s', item)
+        server = None
+      finally:
+        self.queue.task_done()
+    if server is not None:
+      try:
+        server.quit()
+      except (smtplib.SMTPException, OSError):
+        pass
+
+  def _deliver(self, server, destination, message):
+    for attempt in range(2):
+      try:
+        if server is None:
+          server = self.connect()
+        server.sendmail(
+          from_addr=FROM_ADDR,
+          to_addrs=[destination],
+          msg=format_email(message),
+        )
+        return server
+      except (smtplib.SMTPServerDisconnected, ConnectionError):
+        logger.warning('SMTP connection lost, reconnecting')
+        server = None
+        if attempt:
+          raise
+    return server
@@ -1,7 +1,8 @@
 import logging
+import sys
 from sqlalchemy import (
-    Table, MetaData, Column, Integer, String, Date, ForeignKey,
-    event,
+    Table, MetaData, Column, Integer, String, Date, DateTime, ForeignKey, Text,
+    Index, event, func,
 )
 from sqlalchemy.orm import mapper, relationship
 
@@ -32,6 +33,8 @@ batches = Table(
     Column('sku', ForeignKey('products.sku')),
     Column('_purchased_quantity', Integer, nullable=False),
     Column('eta', Date, nullable=True),
+    Index('ix_batches_reference', 'reference', unique=True),
+    Index('ix_batches_sku', 'sku'),
 )
 
 allocations = Table(
@@ -39,13 +42,38 @@ allocations = Table(
     Column('id', Integer, primary_key=True, autoincrement=True),
     Column('orderline_id', ForeignKey('order_lines.id')),
     Column('batch_id', ForeignKey('batches.id')),
+    Index('ix_allocations_batch_id', 'batch_id'),
 )
 
 allocations_view = Table(
     'allocations_view', metadata,
-    Column('orderid', String(255)),
-    Column('sku', String(255)),
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('orderid', String(255), nullable=False),
+    Column('sku', String(255), nullable=False),
     Column('batchref', String(255)),
+    # serves both lookups by orderid and deletes by (orderid, sku)
+    Index('ix_allocations_view_orderid_sku', 'orderid', 'sku'),
+)
+
+# allocations_view as it is rebuilt, then swapped in for it; not in
+# metadata, so create_all leaves it out
+staging = MetaData()
+
+allocations_view_rebuild = Table(
+    'allocations_view_rebuild', staging,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('orderid', String(255), nullable=False),
+    Column('sku', String(255), nullable=False),
+    Column('batchref', String(255)),
+    Index('ix_allocations_view_rebuild_orderid_sku', 'orderid', 'sku'),
+)
+
+outbox = Table(
+    'outbox', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('channel', String(255), nullable=False),
+    Column('payload', Text, nullable=False),
+    Column('created_at', DateTime, nullable=False, server_default=func.now()),
 )
 
 def start_mappers():
@@ -57,10 +85,37 @@ def start_mappers():
             collection_class=set,
         )
     })
-    mapper(model.Product, products, properties={
-        'batches': relationship(batches_mapper)
-    })
+    mapper(
+        model.Product, products,
+        # Product bumps its own version; flushes then UPDATE ... WHERE
+        # version_number = <old> and raise StaleDataError if it moved on
+        version_id_col=products.c.version_number,
+        version_id_generator=False,
+        properties={'batches': relationship(batches_mapper)},
+    )
 
 @event.listens_for(model.Product, 'load')
 def receive_load(product, _):
     product.events = []
+    product._batch_index = None
+
+
+@event.listens_for(model.OrderLine, 'load')
+def receive_line_load(line, _):
+    # loaded rows bypass __init__; write straight to the state dict so the
+    # (equal) interned value isn't recorded as a change
+    line.__dict__['sku'] = sys.intern(line.__dict__['sku'])
+
+
+@event.listens_for(model.Batch, 'load')
+def receive_batch_load(batch, _):
+    batch.__dict__['sku'] = sys.intern(batch.__dict__['sku'])
+    batch._allocated_quantity = None
+
+
+@event.listens_for(model.Batch, 'expire')
+def receive_batch_expire(batch, attrs):
+    if batch is None:  # instance already garbage collected
+        return
+    if attrs is None or '_allocations' in attrs:
+        batch._allocated_quantity = None
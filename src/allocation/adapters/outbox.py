@@ -0,0 +1,34 @@
+from typing import Callable, List, Tuple
+from allocation.adapters import orm
+from allocation.adapters.redis_eventpublisher import serialize
+from allocation.domain import events
+
+
+def add_events(session, channel_events: List[Tuple[str, events.Event]]):
+    if not channel_events:
+        return
+    session.execute(orm.outbox.insert(), [
+        dict(channel=channel, payload=serialize(event))
+        for channel, event in channel_events
+    ])
+
+
+def relay_batch(session, publish_batch: Callable, batch_size: int) -> int:
+    """
+    Publishes the oldest outbox rows in one go and deletes them, returning
+    how many there were. Rows are locked with SKIP LOCKED where supported,
+    so several relays can run side by side. Delivery is at-least-once: a
+    crash between publishing and committing publishes the rows again.
+    """
+    query = orm.outbox.select().order_by(orm.outbox.c.id).limit(batch_size)
+    if session.bind.dialect.name == 'postgresql':
+        query = query.with_for_update(skip_locked=True)
+    rows = list(session.execute(query))
+    if not rows:
+        return 0
+    publish_batch([(row.channel, row.payload) for row in rows])
+    session.execute(
+        orm.outbox.delete().where(orm.outbox.c.id.in_([row.id for row in rows]))
+    )
+    session.commit()
+    return len(rows)
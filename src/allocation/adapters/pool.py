@@ -0,0 +1,47 @@
+import threading
+import time
+from sqlalchemy.pool import QueuePool
+
+
+class PoolStats:
+
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.lock = threading.Lock()
+
+    def record_checkout(self, waited: float):
+        with self.lock:
+            self.checkouts += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    A QueuePool that times every checkout, including the wait for a free
+    connection once pool_size and max_overflow are used up.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkout_stats = PoolStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self.checkout_stats.record_checkout(time.perf_counter() - start)
+
+    def stats(self):
+        checkout_stats = self.checkout_stats
+        return dict(
+            size=self.size(),
+            checked_out=self.checkedout(),
+            overflow=max(self.overflow(), 0),
+            checkouts=checkout_stats.checkouts,
+            wait_seconds_total=checkout_stats.wait_seconds_total,
+            wait_seconds_max=checkout_stats.wait_seconds_max,
+        )
@@ -1,6 +1,9 @@
+import atexit
+import functools
 import json
 import logging
-from dataclasses import asdict
+import threading
+from collections import Counter
 import redis
 
 from allocation import config
@@ -8,9 +11,97 @@ from allocation.domain import events
 
 logger = logging.getLogger(__name__)
 
-r = redis.Redis(**config.get_redis_host_and_port())
+
+@functools.lru_cache(maxsize=None)
+def get_client() -> redis.Redis:
+    # made on first use; redis-py itself opens connections lazily, and
+    # reopens them in a forked child
+    return redis.Redis(**config.get_redis_host_and_port())
+
+
+STREAM_MAXLEN = config.get_stream_settings()['maxlen']
+
+
+_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+def serialize(event: events.Event) -> str:
+    # events are flat dataclasses, so their __dict__ is all asdict would
+    # give us, without its recursive deep copy
+    return _encoder.encode(event.__dict__)
 
 
 def publish(channel, event: events.Event):
     logging.debug('publishing: channel=%s, event=%s', channel, event)
-    r.publish(channel, json.dumps(asdict(event)))
+    get_client().publish(channel, serialize(event))
+
+
+def publish_to_stream(channel, event: events.Event):
+    logging.debug('publishing to stream: channel=%s, event=%s', channel, event)
+    get_client().xadd(
+        channel, {'data': serialize(event)},
+        maxlen=STREAM_MAXLEN, approximate=True,
+    )
+
+
+def publish_batch(messages, transport='pubsub', client=None):
+    """Sends already serialized (channel, data) pairs in one pipeline."""
+    pipe = (client or get_client()).pipeline(transaction=False)
+    for channel, data in messages:
+        if transport == 'streams':
+            pipe.xadd(
+                channel, {'data': data}, maxlen=STREAM_MAXLEN, approximate=True,
+            )
+        else:
+            pipe.publish(channel, data)
+    pipe.execute()
+
+
+class BufferedPublisher:
+    """
+    Collects published events and sends them to Redis in a single pipeline
+    on flush(); the message bus flushes at the end of each handle() call,
+    and anything left over is flushed at interpreter exit.
+    """
+
+    def __init__(self, transport='pubsub', client=None, max_buffer=1000):
+        self.transport = transport
+        self.client = client  # None: the shared client, when first needed
+        self.max_buffer = max_buffer
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.batch_sizes = Counter()  # type: Counter
+        atexit.register(self.flush)
+
+    def __call__(self, channel, event: events.Event):
+        with self.lock:
+            self.buffer.append((channel, serialize(event)))
+            full = len(self.buffer) >= self.max_buffer
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            buffer, self.buffer = self.buffer, []
+        if not buffer:
+            return
+        logging.debug('publishing %d buffered events', len(buffer))
+        publish_batch(buffer, self.transport, self.client)
+        self.batch_sizes[len(buffer)] += 1
+
+    @property
+    def metrics(self):
+        flushes = sum(self.batch_sizes.values())
+        published = sum(n * count for n, count in self.batch_sizes.items())
+        return dict(
+            flushes=flushes,
+            published=published,
+            mean_batch_size=published / flushes if flushes else 0,
+            max_batch_size=max(self.batch_sizes, default=0),
+        )
+
+
+PUBLISHERS = {
+    'pubsub': publish,
+    'streams': publish_to_stream,
+}
@@ -1,8 +1,10 @@
   
 import abc
-from typing import Set
+from typing import Dict, Optional, Set
+from sqlalchemy.orm import joinedload, selectinload
 from allocation.domain import model
 from allocation.adapters import orm
+from allocation.adapters.cache import AggregateCache
 
 class AbstractRepository(abc.ABC):
 
@@ -38,19 +40,114 @@ class AbstractRepository(abc.ABC):
         raise NotImplementedError
 
 
+LOADING_STRATEGIES = {
+    # one query per table in the aggregate, whatever its size
+    'selectin': lambda: [
+        selectinload('batches').selectinload('_allocations'),
+    ],
+    # a single query, at the cost of a wider result set
+    'joined': lambda: [
+        joinedload('batches').joinedload('_allocations'),
+    ],
+    # plain lazy loading: one query per batch when allocations are touched
+    'lazy': lambda: [],
+}
+
+
 class SqlAlchemyRepository(AbstractRepository):
 
-    def __init__(self, session):
+    def __init__(self, session, loading='selectin'):
         super().__init__()
         self.session = session
+        self.load_options = LOADING_STRATEGIES[loading]()
 
     def _add(self, product):
         self.session.add(product)
 
     def _get(self, sku):
-        return self.session.query(model.Product).filter_by(sku=sku).first()
+        return self.session.query(model.Product).options(
+            *self.load_options
+        ).filter_by(sku=sku).first()
 
     def _get_by_batchref(self, batchref) -> model.Product:
-        return self.session.query(model.Product).join(model.Batch).filter(
+        return self.session.query(model.Product).options(
+            *self.load_options
+        ).join(model.Batch).filter(
+            orm.batches.c.reference == batchref,
+        ).first()
+
+
+class CachingSqlAlchemyRepository(SqlAlchemyRepository):
+    """
+    Serves products kept resident in an AggregateCache once a single query
+    shows their version is still current; loads them in full only on a miss
+    or when another process has moved the version on.
+    """
+
+    def __init__(self, session, aggregates: AggregateCache, loading='selectin'):
+        super().__init__(session, loading)
+        self.aggregates = aggregates
+
+    def _get(self, sku):
+        product = self._in_session(sku)
+        if product is not None:
+            return product
+        resident = self.aggregates.get(sku)
+        if resident is not None:
+            version = self.session.query(orm.products.c.version_number).filter(
+                orm.products.c.sku == sku,
+            ).scalar()
+            if version == resident.version_number:
+                return self._attach(resident)
+            self.aggregates.conflicts += 1
+        return super()._get(sku)
+
+    def _get_by_batchref(self, batchref):
+        row = self.session.query(
+            orm.products.c.sku, orm.products.c.version_number,
+        ).join(orm.batches).filter(
             orm.batches.c.reference == batchref,
         ).first()
+        if row is None:
+            return None
+        product = self._in_session(row.sku)
+        if product is not None:
+            return product
+        resident = self.aggregates.get(row.sku)
+        if resident is not None:
+            if row.version_number == resident.version_number:
+                return self._attach(resident)
+            self.aggregates.conflicts += 1
+        return super()._get(row.sku)
+
+    def _in_session(self, sku):
+        key = self.session.identity_key(model.Product, sku)
+        return self.session.identity_map.get(key)
+
+    def _attach(self, product):
+        # cascades to its batches and their allocations, without a query
+        self.session.add(product)
+        return product
+
+
+class InMemoryRepository(AbstractRepository):
+    """
+    Products held in a dict, which the repositories of several units of
+    work can share. Nothing is persisted, and it isn't thread safe.
+    """
+
+    def __init__(self, products: Optional[Dict[str, model.Product]] = None):
+        super().__init__()
+        self.products = {} if products is None else products
+
+    def _add(self, product):
+        self.products[product.sku] = product
+
+    def _get(self, sku):
+        return self.products.get(sku)
+
+    def _get_by_batchref(self, batchref):
+        return next((
+            product for product in self.products.values()
+            for batch in product.batches if batch.reference == batchref
+        ), None)
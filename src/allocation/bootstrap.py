@@ -1,43 +1,222 @@
+import atexit
+import functools
 import inspect
-from typing import Callable
-from allocation.adapters import orm, redis_eventpublisher
+import threading
+from typing import Any, Callable, Dict, Optional
+from allocation import config, views
+from allocation.adapters import (
+  cache as view_cache, metrics as bus_metrics, orm, redis_eventpublisher,
+)
 from allocation.adapters.notifications import (
-  AbstractNotifications, EmailNotifications
+  AbstractNotifications, QueuedEmailNotifications
 )
-from allocation.service_layer import handlers, messagebus, unit_of_work
+from allocation.service_layer import engine, handlers, messagebus, unit_of_work
 
 
 def bootstrap(
   start_orm: bool = True,
-  uow: unit_of_work.AbstractUnitOfWork = unit_of_work.SqlAlchemyUnitOfWork(),
-  notifications: AbstractNotifications = None,
-  publish: Callable = redis_eventpublisher.publish,
+  uow: Optional[unit_of_work.AbstractUnitOfWork] = None,
+  notifications: Optional[AbstractNotifications] = None,
+  publish: Optional[Callable] = None,
+  batch_events: bool = True,
+  transport: Optional[str] = None,
+  outbox: Optional[bool] = None,
+  cache: Optional[view_cache.AbstractCache] = None,
+  engine_workers: Optional[int] = None,
+  allocation_engine: Optional[engine.ShardedEngine] = None,
+  metrics: Optional[bus_metrics.AbstractMetrics] = None,
 ) -> messagebus.MessageBus:
 
+  if uow is None:
+    uow = make_unit_of_work()
+
+  if outbox is None:
+    outbox = config.get_outbox_settings()['enabled']
+
+  if engine_workers is None:
+    engine_workers = config.get_engine_settings()['workers']
+
+  if metrics is None and config.get_metrics_enabled():
+    metrics = bus_metrics.REGISTRY
+  uow.metrics = metrics
+
+  transport = transport or config.get_event_transport()
+  if publish is None and config.get_publish_buffered():
+    publish = redis_eventpublisher.BufferedPublisher(transport)
+  elif publish is None:
+    publish = redis_eventpublisher.PUBLISHERS[transport]
+
   if notifications is None:
-    notifications = EmailNotifications()
+    notifications = QueuedEmailNotifications(
+      **config.get_notification_settings()
+    )
 
   if start_orm:
     orm.start_mappers()
 
-  dependencies = {'uow': uow, 'notifications': notifications, 'publish': publish}
+  if cache is None and config.get_view_cache_settings()['backend'] == 'redis':
+    # processes not serving views still invalidate a shared cache
+    cache = make_view_cache()
+
+  if outbox:
+    if not isinstance(uow, unit_of_work.SqlAlchemyUnitOfWork):
+      # its events would be left out of the bus and never written out
+      raise ValueError(f'OUTBOX=1 needs a database, not {type(uow).__name__}')
+    # external events go out through the outbox relay instead
+    uow.outbox_channels = handlers.EXTERNAL_CHANNELS
+
+  dependencies = {
+    'uow': uow, 'notifications': notifications, 'publish': publish,
+    'cache': cache, 'metrics': metrics,
+  }
   injected_event_handlers = {
     event_type: [
       inject_dependencies(handler, dependencies)
       for handler in event_handlers
+      if not (outbox and handler in handlers.PUBLISH_HANDLERS)
     ]
     for event_type, event_handlers in handlers.EVENT_HANDLERS.items()
   }
+  injected_batch_event_handlers = {
+    event_type: [
+      inject_dependencies(handler, dependencies)
+      for handler in event_handlers
+      if uow.read_model or handler not in handlers.READ_MODEL_HANDLERS
+    ]
+    for event_type, event_handlers in handlers.BATCH_EVENT_HANDLERS.items()
+  }
   injected_command_handlers = {
     command_type: inject_dependencies(handler, dependencies)
     for command_type, handler in handlers.COMMAND_HANDLERS.items()
   }
+  if allocation_engine is None and engine_workers:
+    allocation_engine = make_engine(engine_workers)
+  if allocation_engine is not None:
+    # product commands go to the worker owning their sku, whose own bus
+    # handles them and the events they raise
+    injected_command_handlers.update({
+      command_type: allocation_engine.handle
+      for command_type in engine.ROUTED_COMMANDS
+    })
 
   return messagebus.MessageBus(
     uow=uow,
     event_handlers=injected_event_handlers,
     command_handlers=injected_command_handlers,
+    batch_event_handlers=injected_batch_event_handlers,
+    batch_events=batch_events,
+    after_handle=[publish.flush] if hasattr(publish, 'flush') else [],
+    metrics=metrics,
+    # the worker's own bus has retried them already
+    unretried_commands=engine.ROUTED_COMMANDS if allocation_engine else (),
+  )
+
+
+def make_unit_of_work(
+  aggregates: Optional[view_cache.AggregateCache] = None,
+) -> unit_of_work.AbstractUnitOfWork:
+  settings = config.get_store_settings()
+  if settings['backend'] == 'memory':
+    return unit_of_work.InMemoryUnitOfWork()
+  session_factory = None  # postgres
+  if settings['backend'] == 'sqlite':
+    session_factory = unit_of_work.sqlite_session_factory(settings['sqlite_path'])
+  aggregates = aggregates or make_aggregate_cache()
+  if aggregates is None:
+    return unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+  return unit_of_work.CachingSqlAlchemyUnitOfWork(aggregates, session_factory)
+
+
+def make_aggregate_cache():
+  settings = config.get_aggregate_cache_settings()
+  if settings['enabled']:
+    return view_cache.AggregateCache(maxsize=settings['maxsize'])
+  return None
+
+
+def make_bus_factory(**kwargs) -> Callable[[], messagebus.MessageBus]:
+  """
+  For servers running one bus per thread. Nothing is set up until the
+  first bus is made, so after any fork; the first one also starts the
+  mappers. The buses share notifications, resident products and engine,
+  and each gets its own unit of work and publisher.
+  """
+  if config.get_store_settings()['backend'] == 'memory':
+    # the views read allocations_view, which an in-memory store hasn't got
+    raise ValueError('STORE=memory is for simulations; servers need a database')
+  lock = threading.Lock()
+  shared = {}  # type: Dict[str, Any]
+
+  def make_bus() -> messagebus.MessageBus:
+    with lock:
+      if not shared:
+        orm.start_mappers()
+        workers = config.get_engine_settings()['workers']
+        shared.update(
+          notifications=QueuedEmailNotifications(
+            **config.get_notification_settings()
+          ),
+          aggregates=make_aggregate_cache(),
+          allocation_engine=make_engine(workers) if workers else None,
+        )
+    return bootstrap(
+      start_orm=False,
+      uow=make_unit_of_work(shared['aggregates']),
+      notifications=shared['notifications'],
+      engine_workers=0,
+      allocation_engine=shared['allocation_engine'],
+      **kwargs,
+    )
+
+  return make_bus
+
+
+def make_engine(workers: int):
+  store = config.get_store_settings()
+  if store['backend'] == 'memory' or (
+      store['backend'] == 'sqlite' and store['sqlite_path'] == ':memory:'):
+    raise ValueError(
+      "ENGINE_WORKERS needs a store its worker processes share, not"
+      f" STORE={store['backend']} in this process's memory"
+    )
+  allocation_engine = engine.ShardedEngine(
+    workers, make_bus=bootstrap_engine_worker,
+    timeout=config.get_engine_settings()['timeout'],
+    # a unit of work per lookup, as the engine is shared between threads
+    sku_for_batchref=lambda batchref: views.batch_sku(
+      batchref, make_unit_of_work(),
+    ),
   )
+  allocation_engine.start()
+  atexit.register(allocation_engine.close)
+  return allocation_engine
+
+
+def bootstrap_engine_worker() -> messagebus.MessageBus:
+  # runs in the engine's worker process, which owns its skus' products,
+  # so they're always kept resident
+  settings = config.get_aggregate_cache_settings()
+  return bootstrap(
+    uow=make_unit_of_work(view_cache.AggregateCache(settings['maxsize'])),
+    engine_workers=0,
+  )
+
+
+def make_view_cache():
+  settings = config.get_view_cache_settings()
+  if settings['backend'] == 'memory':
+    if (config.get_web_settings()['workers'] > 1
+        or config.get_engine_settings()['workers']):
+      raise ValueError(
+        'VIEW_CACHE=memory is only invalidated by writes in its own process;'
+        ' use VIEW_CACHE=redis with WEB_WORKERS > 1 or ENGINE_WORKERS'
+      )
+    return view_cache.LRUCache(maxsize=settings['maxsize'], ttl=settings['ttl'])
+  if settings['backend'] == 'redis':
+    return view_cache.RedisCache(
+      redis_eventpublisher.get_client(), ttl=settings['ttl'],
+    )
+  return None
 
 
 def inject_dependencies(handler, dependencies):
@@ -47,4 +226,5 @@ def inject_dependencies(handler, dependencies):
     for name, dependency in dependencies.items()
     if name in params
   }
-  return lambda message: handler(message, **deps)
+  # bound once here rather than in a closure rebuilding kwargs per call
+  return functools.partial(handler, **deps) if deps else handler
@@ -8,16 +8,114 @@ def get_postgres_uri():
   return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
 
 
+def get_store_settings():
+  # where products live: postgres, sqlite (':memory:' or a file path) or
+  # memory, a dict per process for simulations
+  return dict(
+    backend=os.environ.get('STORE', 'postgres'),
+    sqlite_path=os.environ.get('SQLITE_PATH', ':memory:'),
+  )
+
+
+def get_db_settings():
+  return dict(
+    # per process; size against WEB_WORKERS * WEB_THREADS and the
+    # server's max_connections
+    pool_size=int(os.environ.get('DB_POOL_SIZE', 5)),
+    max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+    pool_timeout=float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+    pool_pre_ping=os.environ.get('DB_POOL_PRE_PING', '0') == '1',
+    pool_recycle=int(os.environ.get('DB_POOL_RECYCLE', -1)),  # -1: never
+    statement_timeout_ms=int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 0)),
+    # psycopg2 batching of executemany(): '', 'batch' or 'values'
+    executemany_mode=os.environ.get('DB_EXECUTEMANY_MODE', ''),
+  )
+
+
 def get_api_url():
   host = os.environ.get('API_HOST', 'localhost')
   port = 5005 if host == 'localhost' else 80
   return f"http://{host}:{port}"
 
+def get_web_settings():
+  # forked worker processes, each serving requests from a pool of threads
+  return dict(
+    workers=int(os.environ.get('WEB_WORKERS', os.cpu_count() or 1)),
+    threads=int(os.environ.get('WEB_THREADS', 4)),
+    reload=os.environ.get('WEB_RELOAD', '0') == '1',
+  )
+
 def get_redis_host_and_port():
   host = os.environ.get('REDIS_HOST', 'localhost')
   port = 63791 if host == 'localhost' else 6379
   return dict(host=host, port=port)
 
+def get_event_transport():
+  # 'pubsub' (fire-and-forget) or 'streams' (durable consumer groups)
+  return os.environ.get('EVENT_TRANSPORT', 'pubsub')
+
+def get_publish_buffered():
+  # buffer events published during one bus.handle and pipeline them
+  return os.environ.get('PUBLISH_BUFFERED', '1') == '1'
+
+def get_outbox_settings():
+  return dict(
+    enabled=os.environ.get('OUTBOX', '0') == '1',
+    batch_size=int(os.environ.get('OUTBOX_BATCH_SIZE', 500)),
+    poll_interval=float(os.environ.get('OUTBOX_POLL_INTERVAL', 0.1)),
+    # longest wait between attempts after failures, in seconds
+    max_backoff=float(os.environ.get('OUTBOX_MAX_BACKOFF', 30)),
+  )
+
+def get_stream_settings():
+  return dict(
+    group=os.environ.get('STREAM_GROUP', 'allocation'),
+    maxlen=int(os.environ.get('STREAM_MAXLEN', 100_000)),
+    reclaim_idle_ms=int(os.environ.get('STREAM_RECLAIM_IDLE_MS', 60_000)),
+    max_deliveries=int(os.environ.get('STREAM_MAX_DELIVERIES', 5)),
+  )
+
+def get_consumer_settings():
+  return dict(
+    concurrency=int(os.environ.get('CONSUMER_CONCURRENCY', 1)),
+    max_pending=int(os.environ.get('CONSUMER_MAX_PENDING', 100)),
+  )
+
+def get_notification_settings():
+  return dict(
+    workers=int(os.environ.get('NOTIFY_WORKERS', 2)),
+    dedup_window=float(os.environ.get('NOTIFY_DEDUP_WINDOW', 300)),
+  )
+
+def get_view_cache_settings():
+  return dict(
+    # none, redis, or memory: only when this process handles every write,
+    # so with one web worker, no engine and no separate consumer
+    backend=os.environ.get('VIEW_CACHE', 'none'),
+    maxsize=int(os.environ.get('VIEW_CACHE_SIZE', 10_000)),
+    ttl=int(os.environ.get('VIEW_CACHE_TTL', 60)),
+  )
+
+def get_aggregate_cache_settings():
+  # keep hot products resident per process, checked by version on each use
+  return dict(
+    enabled=os.environ.get('AGGREGATE_CACHE', '0') == '1',
+    maxsize=int(os.environ.get('AGGREGATE_CACHE_SIZE', 1_000)),
+  )
+
+def get_engine_settings():
+  # worker processes each owning a hash partition of skus; 0 handles
+  # commands in the calling process
+  return dict(
+    workers=int(os.environ.get('ENGINE_WORKERS', 0)),
+    # seconds a request waits for its worker before giving up
+    timeout=float(os.environ.get('ENGINE_TIMEOUT', 30)),
+  )
+
+def get_metrics_enabled():
+  # message, transaction and allocation metrics, served on /metrics
+  return os.environ.get('METRICS', '0') == '1'
+
 def get_email_host_and_port():
   host = os.environ.get('EMAIL_HOST', 'localhost')
   port = 11025 if host == 'localhost' else 1025
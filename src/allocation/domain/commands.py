@@ -1,6 +1,6 @@
 from datetime import date
 from dataclasses import dataclass
-from typing import Optional
+from typing import List, Optional
 
 class Command:
   pass
@@ -11,6 +11,10 @@ class Allocate(Command):
   sku: str
   qty: int
 
+@dataclass
+class AllocateMany(Command):
+  lines: List[Allocate]
+
 @dataclass
 class CreateBatch(Command):
   ref: str
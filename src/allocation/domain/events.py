@@ -8,7 +8,7 @@ class OutOfStock(Event):
   sku: str
 
 @dataclass
-class Allocated(Command):
+class Allocated(Event):
   orderid: str
   sku: str
   qty: int
@@ -1,5 +1,6 @@
 from __future__ import annotations
-from dataclasses import dataclass
+import sys
+from dataclasses import dataclass, FrozenInstanceError
 from datetime import date
 from typing import Optional, List, Set
 from . import commands, events
@@ -11,49 +12,150 @@ class Product:
         self.sku = sku
         self.batches = batches
         self.version_number = version_number
-        self.events = []
+        self.events = []  # type: List[events.Event]
+        self._batch_index = None  # type: Optional[BatchIndex]
 
-    def allocate(self, line: OrderLine) -> str:
-        try:
-            batch = next(
-                b for b in sorted(self.batches) if b.can_allocate(line)
-            )
-            batch.allocate(line)
-            self.version_number += 1
-            self.events.append(events.Allocated(
-                orderid=line.orderid, sku=line.sku, qty=line.qty,
-                batchref=batch.reference,
-            ))
-            return batch.reference
-        except StopIteration:
+    @property
+    def batch_index(self) -> BatchIndex:
+        # rebuilt lazily, and whenever batches were appended behind our back
+        index = self._batch_index
+        if index is None or len(index) != len(self.batches):
+            index = self._batch_index = BatchIndex(self.batches)
+        return index
+
+    def add_batch(self, batch: Batch):
+        self.batches.append(batch)
+        self._batch_index = None
+        self.version_number += 1
+
+    def allocate(self, line: OrderLine) -> Optional[str]:
+        batch = self.batch_index.first_fit(line.qty)
+        if batch is None or not batch.can_allocate(line):
             self.events.append(events.OutOfStock(line.sku))
-            return ''
+            return None
+        batch.allocate(line)
+        self.batch_index.update(batch)
+        self.version_number += 1
+        self.events.append(events.Allocated(
+            orderid=line.orderid, sku=line.sku, qty=line.qty,
+            batchref=batch.reference,
+        ))
+        return batch.reference
+
+    def get_batch(self, ref: str) -> Batch:
+        return self.batch_index.get(ref)
 
     def change_batch_quantity(self, ref: str, qty: int):
-        batch = next(b for b in self.batches if b.reference == ref)
+        batch = self.get_batch(ref)
         batch._purchased_quantity = qty
+        displaced = []
         while batch.available_quantity < 0:
             line = batch.deallocate_one()
+            displaced.append(line)
             self.events.append(
                 events.Deallocated(line.orderid, line.sku, line.qty)
             )
-
-@dataclass(unsafe_hash=True)
+        self.batch_index.update(batch)
+        self.version_number += 1
+        # reallocate displaced lines right away, so the whole change is
+        # one atomic update of the aggregate
+        for line in displaced:
+            self.allocate(line)
+
+    def change_batch_eta(self, ref: str, eta: Optional[date]):
+        batch = self.get_batch(ref)
+        batch.eta = eta
+        self._batch_index = None
+        self.version_number += 1
+
+
+class BatchIndex:
+    """
+    A product's batches in allocation order (in-stock first, then by ETA),
+    with a max-tree over their available quantities so the first batch that
+    can take a given quantity is found in O(log n).
+    """
+
+    def __init__(self, batches: List[Batch]):
+        self.batches = sorted(batches, key=allocation_order)
+        self.positions = {b.reference: i for i, b in enumerate(self.batches)}
+        self.size = 1
+        while self.size < len(self.batches):
+            self.size *= 2
+        self.tree = [float('-inf')] * (2 * self.size)
+        for i, batch in enumerate(self.batches):
+            self.tree[self.size + i] = batch.available_quantity
+        for i in range(self.size - 1, 0, -1):
+            self.tree[i] = max(self.tree[2 * i], self.tree[2 * i + 1])
+        self.last_scan = 0  # tree nodes examined by the last first_fit
+
+    def __len__(self):
+        return len(self.batches)
+
+    def get(self, ref: str) -> Batch:
+        return self.batches[self.positions[ref]]
+
+    def update(self, batch: Batch):
+        i = self.size + self.positions[batch.reference]
+        self.tree[i] = batch.available_quantity
+        i //= 2
+        while i:
+            self.tree[i] = max(self.tree[2 * i], self.tree[2 * i + 1])
+            i //= 2
+
+    def first_fit(self, qty: int) -> Optional[Batch]:
+        if not self.batches or self.tree[1] < qty:
+            self.last_scan = 1
+            return None
+        i = 1
+        scanned = 1
+        while i < self.size:
+            i = 2 * i if self.tree[2 * i] >= qty else 2 * i + 1
+            scanned += 1
+        self.last_scan = scanned
+        return self.batches[i - self.size]
+
+
+def allocation_order(batch: Batch):
+    return (batch.eta is not None, batch.eta or date.min)
+
+
+@dataclass(unsafe_hash=True, init=False)
 class OrderLine:
+    """
+    Immutable once built, so a line can never change its hash while it sits
+    in a batch's allocations. Not a frozen dataclass or __slots__: the
+    classical mapper sets its instance state with setattr and keeps the
+    mapped columns in the instance __dict__. Fields are set with
+    object.__setattr__, which still goes through the mapper's descriptors,
+    so assigning one afterwards can be refused outright.
+    """
     orderid: str
     sku: str
     qty: int
 
+    def __init__(self, orderid: str, sku: str, qty: int):
+        object.__setattr__(self, 'orderid', orderid)
+        # every line of a product carries the same sku; share one string
+        object.__setattr__(self, 'sku', sys.intern(sku))
+        object.__setattr__(self, 'qty', qty)
+
+    def __setattr__(self, name, value):
+        if name in self.__dataclass_fields__:
+            raise FrozenInstanceError(f'cannot assign to field {name!r}')
+        super().__setattr__(name, value)
+
 
 class Batch:
     def __init__(
         self, ref: str, sku: str, qty: int, eta: Optional[date]
     ):
         self.reference = ref
-        self.sku = sku
+        self.sku = sys.intern(sku)
         self.eta = eta
         self._purchased_quantity = qty
         self._allocations = set()  # type: Set[OrderLine]
+        self._allocated_quantity = 0  # type: Optional[int]
 
     def __repr__(self):
         return f'<Batch {self.reference}>'
@@ -74,15 +176,26 @@ class Batch:
         return self.eta > other.eta
 
     def allocate(self, line: OrderLine):
-        if self.can_allocate(line):
-            self._allocations.add(line)
+        if line in self._allocations or not self.can_allocate(line):
+            return
+        self._allocations.add(line)
+        self._allocated_quantity = self.allocated_quantity + line.qty
 
     def deallocate_one(self) -> OrderLine:
-        return self._allocations.pop()
+        allocated = self.allocated_quantity
+        line = self._allocations.pop()
+        self._allocated_quantity = allocated - line.qty
+        return line
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self._allocations)
+        # running total; None means "recount from _allocations" (set by the
+        # ORM when a batch is loaded or its allocations are expired)
+        if self._allocated_quantity is None:
+            self._allocated_quantity = sum(
+                line.qty for line in self._allocations
+            )
+        return self._allocated_quantity
 
     @property
     def available_quantity(self) -> int:
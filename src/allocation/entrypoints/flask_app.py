@@ -1,41 +1,103 @@
+import threading
 from datetime import datetime
+from typing import Callable, List, Optional
 from flask import Flask, jsonify, request
+from allocation.adapters import metrics as bus_metrics
+from allocation.adapters.cache import AbstractCache
 from allocation.domain import commands
+from allocation.service_layer import messagebus, unit_of_work
 from allocation.service_layer.handlers import InvalidSku
-from allocation import bootstrap, views
+from allocation import bootstrap, config, views
 
-app = Flask(__name__)
-bus = bootstrap.bootstrap()
 
+def create_app(
+    make_bus: Optional[Callable[[], messagebus.MessageBus]] = None,
+    cache: Optional[AbstractCache] = None,
+    metrics: Optional[bus_metrics.PrometheusMetrics] = None,
+) -> Flask:
+    """
+    Each thread serving requests bootstraps its own bus, and so its own
+    unit of work, on its first request: after the server has forked, and
+    never shared by two requests at once.
+    """
+    app = Flask(__name__)
+    if make_bus is None:
+        cache = cache or bootstrap.make_view_cache()
+        make_bus = bootstrap.make_bus_factory(cache=cache)
+    buses = threading.local()
+    if metrics is None and config.get_metrics_enabled():
+        metrics = bus_metrics.REGISTRY
+        metrics.add_samples(unit_of_work.pool_metrics)
 
-@app.route("/add_batch", methods=['POST'])
-def add_batch():
-    eta = request.json['eta']
-    if eta is not None:
-        eta = datetime.fromisoformat(eta).date()
-    cmd = commands.CreateBatch(
-        request.json['ref'], request.json['sku'], request.json['qty'], eta,
-    )
-    bus.handle(cmd)
-    return 'OK', 201
+    def get_bus() -> messagebus.MessageBus:
+        bus = getattr(buses, 'bus', None)
+        if bus is None:
+            bus = buses.bus = make_bus()
+        return bus
 
-
-@app.route("/allocate", methods=['POST'])
-def allocate_endpoint():
-    try:
-        cmd = commands.Allocate(
-            request.json['orderid'], request.json['sku'], request.json['qty'],
+    @app.route("/add_batch", methods=['POST'])
+    def add_batch():
+        eta = request.json['eta']
+        if eta is not None:
+            eta = datetime.fromisoformat(eta).date()
+        cmd = commands.CreateBatch(
+            request.json['ref'], request.json['sku'], request.json['qty'], eta,
         )
-        bus.handle(cmd)
-    except InvalidSku as e:
-        return jsonify({'message': str(e)}), 400
+        get_bus().handle(cmd)
+        return 'OK', 201
+
+    @app.route("/allocate", methods=['POST'])
+    def allocate_endpoint():
+        try:
+            cmd = commands.Allocate(
+                request.json['orderid'], request.json['sku'], request.json['qty'],
+            )
+            get_bus().handle(cmd)
+        except InvalidSku as e:
+            return jsonify({'message': str(e)}), 400
+
+        return 'OK', 202
+
+    @app.route("/allocate/bulk", methods=['POST'])
+    def allocate_bulk_endpoint():
+        try:
+            lines = bulk_lines(request.get_json(silent=True))
+        except ValueError as e:
+            return jsonify({'message': str(e)}), 400
+        [results] = get_bus().handle(commands.AllocateMany(lines))
+        return jsonify(results), 202
+
+    @app.route("/allocations/<orderid>", methods=['GET'])
+    def allocations_view_endpoint(orderid):
+        result = views.allocations(orderid, get_bus().uow, cache)
+        if not result:
+            return 'not found', 404
+        return jsonify(result), 200
+
+    @app.route("/metrics", methods=['GET'])
+    def metrics_endpoint():
+        if metrics is None:
+            return 'metrics are disabled', 404
+        return metrics.render(), 200, {
+            'Content-Type': 'text/plain; version=0.0.4; charset=utf-8',
+        }
 
-    return 'OK', 202
+    return app
 
 
-@app.route("/allocations/<orderid>", methods=['GET'])
-def allocations_view_endpoint(orderid):
-    result = views.allocations(orderid, bus.uow)
-    if not result:
-        return 'not found', 404
-    return jsonify(result), 200
\ No newline at end of file
+def bulk_lines(payload) -> List[commands.Allocate]:
+    if not isinstance(payload, dict) or not isinstance(payload.get('lines'), list):
+        raise ValueError('Expected an object with a list of lines')
+    lines = []
+    for i, line in enumerate(payload['lines']):
+        if not isinstance(line, dict):
+            raise ValueError(f'Line {i} is not an object')
+        missing = [key for key in ('orderid', 'sku', 'qty') if key not in line]
+        if missing:
+            raise ValueError(f"Line {i} has no {', '.join(missing)}")
+        if not isinstance(line['orderid'], str) or not isinstance(line['sku'], str):
+            raise ValueError(f'Line {i} has an orderid or sku that is not a string')
+        if not isinstance(line['qty'], int) or isinstance(line['qty'], bool):
+            raise ValueError(f'Line {i} has a qty that is not an integer')
+        lines.append(commands.Allocate(line['orderid'], line['sku'], line['qty']))
+    return lines
@@ -0,0 +1,14 @@
+# gunicorn -c allocation/entrypoints/gunicorn_conf.py \
+#   'allocation.entrypoints.flask_app:create_app()'
+from allocation import config
+
+_settings = config.get_web_settings()
+
+bind = '0.0.0.0:80'
+workers = _settings['workers']
+threads = _settings['threads']
+worker_class = 'gthread'
+reload = _settings['reload']
+# no post_fork hook needed: each worker makes its own engine on first use,
+# see unit_of_work.default_session_factory
+
@@ -0,0 +1,44 @@
+import functools
+import logging
+import time
+
+from allocation import config
+from allocation.adapters import outbox, redis_eventpublisher
+from allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+  settings = config.get_outbox_settings()
+  logger.info('Outbox relay starting, batch_size=%s', settings['batch_size'])
+  publish_batch = functools.partial(
+    redis_eventpublisher.publish_batch, transport=config.get_event_transport(),
+  )
+  relay_forever(
+    unit_of_work.default_session_factory(), publish_batch, settings,
+  )
+
+
+def relay_forever(session_factory, publish_batch, settings, sleep=time.sleep):
+  delay = settings['poll_interval']
+  while True:
+    session = session_factory()
+    try:
+      relayed = outbox.relay_batch(
+        session, publish_batch, settings['batch_size'],
+      )
+    except Exception:  # pylint: disable=broad-except
+      logger.exception('Exception relaying outbox, retrying in %.1fs', delay)
+      sleep(delay)
+      # while Redis or the database is down, wait longer between attempts
+      delay = min(delay * 2, settings['max_backoff'])
+      continue
+    finally:
+      session.close()
+    delay = settings['poll_interval']
+    if relayed < settings['batch_size']:
+      sleep(settings['poll_interval'])
+
+if __name__ == '__main__':
+  main()
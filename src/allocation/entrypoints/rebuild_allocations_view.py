@@ -0,0 +1,30 @@
+import argparse
+import logging
+
+from allocation import bootstrap, config, views
+from allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+    description='Rebuild the allocations_view read model from scratch.',
+  )
+  parser.add_argument('--chunk-size', type=int, default=10_000)
+  args = parser.parse_args(argv)
+
+  # a memory cache lives in the web process, and expires with its TTL
+  cache = None
+  if config.get_view_cache_settings()['backend'] == 'redis':
+    cache = bootstrap.make_view_cache()
+  rebuilt = views.rebuild_allocations(
+    unit_of_work.SqlAlchemyUnitOfWork(), chunk_size=args.chunk_size,
+    cache=cache,
+  )
+  logger.info('rebuilt %s rows of allocations_view', rebuilt)
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  main()
@@ -1,25 +1,144 @@
+import asyncio
+import functools
 import json
 import logging
+import os
+import signal
+import socket
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional
 import redis
 
-from allocation import bootstrap, config
+from allocation import bootstrap, config, views
+from allocation.adapters.cache import LRUCache
+from allocation.adapters.redis_eventpublisher import get_client
 from allocation.domain import commands
 
 logger = logging.getLogger(__name__)
 
-r = redis.Redis(**config.get_redis_host_and_port())
+STREAM = 'change_batch_quantity'
 
 
 def main():
   logger.info('Redis pubsub starting')
   bus = bootstrap.bootstrap()
-  pubsub = r.pubsub(ignore_subscribe_messages=True)
+  pubsub = get_client().pubsub(ignore_subscribe_messages=True)
   pubsub.subscribe('change_batch_quantity')
   
   for m in pubsub.listen():
     handle_change_batch_quantity(m, bus)
 
 
+async def main_async(concurrency: int, max_pending: int):
+  logger.info('Redis pubsub starting, concurrency=%s', concurrency)
+  loop = asyncio.get_running_loop()
+  # one bus (and unit of work) per worker, as they're not thread-safe;
+  # resident products are shared, each checked out by one worker at a time
+  aggregates = bootstrap.make_aggregate_cache()
+  buses = [
+    bootstrap.bootstrap(
+      start_orm=(i == 0), uow=bootstrap.make_unit_of_work(aggregates),
+    )
+    for i in range(concurrency)
+  ]
+  dispatcher = KeyedDispatcher([
+    functools.partial(handle_change_batch_quantity, bus=bus) for bus in buses
+  ], max_pending=max_pending)
+  dispatcher.start()
+  batch_skus = BatchSkus(
+    lambda batchref: views.batch_sku(batchref, bootstrap.make_unit_of_work())
+  )
+
+  stopping = asyncio.Event()
+  for sig in (signal.SIGINT, signal.SIGTERM):
+    loop.add_signal_handler(sig, stopping.set)
+
+  pubsub = get_client().pubsub(ignore_subscribe_messages=True)
+  pubsub.subscribe('change_batch_quantity')
+  get_message = functools.partial(pubsub.get_message, timeout=1.0)
+  while not stopping.is_set():
+    m = await loop.run_in_executor(None, get_message)
+    if m is None:
+      continue
+    data = json.loads(m['data'])
+    # batches of the same product conflict, so they go to the same worker
+    sku = data.get('sku') or await loop.run_in_executor(
+      None, batch_skus, data['batchref'],
+    )
+    await dispatcher.submit(sku or data['batchref'], m)
+
+  logger.info('Redis pubsub stopping, draining %s messages', dispatcher.pending)
+  pubsub.close()
+  await dispatcher.drain()
+
+
+def main_streams(consumer: Optional[str] = None):
+  settings = config.get_stream_settings()
+  consumer = consumer or f'{socket.gethostname()}-{os.getpid()}'
+  logger.info('Redis streams consumer %s starting', consumer)
+  bus = bootstrap.bootstrap(transport='streams')
+  ensure_group(STREAM, settings['group'])
+  while True:
+    consume_stream(bus, STREAM, settings['group'], consumer, block=5000)
+
+
+def ensure_group(stream: str, group: str):
+  try:
+    get_client().xgroup_create(stream, group, id='0', mkstream=True)
+  except redis.ResponseError as e:
+    if 'BUSYGROUP' not in str(e):
+      raise
+
+
+def consume_stream(bus, stream: str, group: str, consumer: str, block=None):
+  """
+  Handles entries other consumers left pending for too long, then one
+  batch of new entries. Entries are acknowledged only once handled, so a
+  crash leaves them pending for the group to reclaim.
+  """
+  settings = config.get_stream_settings()
+  for entry_id, fields in reclaim_pending(
+      stream, group, consumer,
+      settings['reclaim_idle_ms'], settings['max_deliveries'],
+  ):
+    handle_stream_entry(bus, stream, group, entry_id, fields)
+
+  response = get_client().xreadgroup(
+    group, consumer, {stream: '>'}, count=100, block=block,
+  )  # type: Any
+  for _, entries in response or []:
+    for entry_id, fields in entries:
+      handle_stream_entry(bus, stream, group, entry_id, fields)
+
+
+def reclaim_pending(stream, group, consumer, min_idle_ms, max_deliveries):
+  pending = get_client().xpending_range(stream, group, '-', '+', 100)
+  stale = [p for p in pending if p['time_since_delivered'] >= min_idle_ms]
+  for entry in stale:
+    if entry['times_delivered'] >= max_deliveries:
+      logger.error(
+        'giving up on %s entry %s after %s deliveries',
+        stream, entry['message_id'], entry['times_delivered'],
+      )
+      get_client().xack(stream, group, entry['message_id'])
+  retry_ids = [
+    p['message_id'] for p in stale if p['times_delivered'] < max_deliveries
+  ]  # type: List[Any]
+  if not retry_ids:
+    return []
+  return get_client().xclaim(stream, group, consumer, min_idle_ms, retry_ids)
+
+
+def handle_stream_entry(bus, stream, group, entry_id, fields):
+  try:
+    handle_change_batch_quantity({'data': fields[b'data']}, bus)
+  except Exception:  # pylint: disable=broad-except
+    logger.exception('Exception handling %s entry %s', stream, entry_id)
+    return
+  get_client().xack(stream, group, entry_id)
+
+
 def handle_change_batch_quantity(m, bus):
   logging.debug('handling %s', m)
   data = json.loads(m['data'])
@@ -27,5 +146,83 @@ def handle_change_batch_quantity(m, bus):
   bus.handle(cmd)
 
 
+class BatchSkus:
+  """
+  Looks up the sku of a batch, remembering it as a batch never moves to
+  another product. Unknown batchrefs are looked up again next time, as
+  their batch may yet be added.
+  """
+
+  def __init__(self, lookup: Callable[[str], Optional[str]], maxsize=100_000):
+    self.lookup = lookup
+    self.skus = LRUCache(maxsize=maxsize, ttl=float('inf'))
+
+  def __call__(self, batchref: str) -> Optional[str]:
+    sku = self.skus.get(batchref)
+    if sku is None:
+      sku = self.lookup(batchref)
+      if sku is not None:
+        self.skus.set(batchref, sku)
+    return sku
+
+
+class KeyedDispatcher:
+  """
+  Runs one handler per worker, each in its own thread. Messages are routed
+  to a worker by key, so messages sharing a key are handled one at a time
+  and in the order they were submitted. submit() waits once max_pending
+  messages are queued or in flight.
+  """
+
+  def __init__(self, handlers: List[Callable], max_pending: int):
+    self.handlers = handlers
+    self.max_pending = max_pending
+    self.pending = 0
+
+  def start(self):
+    self.queues = [
+      asyncio.Queue() for _ in self.handlers
+    ]  # type: List[asyncio.Queue]
+    self.slots = asyncio.Semaphore(self.max_pending)
+    self.executor = ThreadPoolExecutor(max_workers=len(self.handlers))
+    self.workers = [
+      asyncio.ensure_future(self._work(handler, queue))
+      for handler, queue in zip(self.handlers, self.queues)
+    ]
+
+  async def submit(self, key: str, message):
+    await self.slots.acquire()
+    self.pending += 1
+    worker = zlib.crc32(key.encode()) % len(self.queues)
+    self.queues[worker].put_nowait(message)
+
+  async def drain(self):
+    for queue in self.queues:
+      await queue.join()
+    for worker in self.workers:
+      worker.cancel()
+    await asyncio.gather(*self.workers, return_exceptions=True)
+    self.executor.shutdown()
+
+  async def _work(self, handler: Callable, queue: asyncio.Queue):
+    loop = asyncio.get_running_loop()
+    while True:
+      message = await queue.get()
+      try:
+        await loop.run_in_executor(self.executor, handler, message)
+      except Exception:  # pylint: disable=broad-except
+        logger.exception('Exception handling %s', message)
+      finally:
+        self.pending -= 1
+        self.slots.release()
+        queue.task_done()
+
+
 if __name__ == '__main__':
-  main()
+  settings = config.get_consumer_settings()
+  if config.get_event_transport() == 'streams':
+    main_streams()
+  elif settings['concurrency'] > 1:
+    asyncio.run(main_async(**settings))
+  else:
+    main()
@@ -0,0 +1,162 @@
+"""
+Replays commands from files of JSON lines through a bus of its own, e.g. a
+day's orders against a proposed batch plan:
+
+  python -m allocation.entrypoints.replay plan.jsonl orders.jsonl
+
+Each line is a command, named by its "command" key, with its fields:
+
+  {"command": "CreateBatch", "ref": "b1", "sku": "LAMP", "qty": 10, "eta": null}
+  {"command": "Allocate", "orderid": "o1", "sku": "LAMP", "qty": 2}
+
+Every allocation is written out as a JSON line, its batchref null when
+nothing was in stock, as is every other command that failed, with the
+reason in its "message"; then a summary goes to stderr. Products are kept in
+memory by default, or in SQLite with --store sqlite.
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+from collections import Counter
+from datetime import date
+from typing import IO, Iterable, Iterator, List
+
+from allocation import bootstrap
+from allocation.adapters.notifications import AbstractNotifications
+from allocation.domain import commands
+from allocation.service_layer import handlers, messagebus, unit_of_work
+
+logger = logging.getLogger(__name__)
+
+COMMANDS = {
+  command_type.__name__: command_type for command_type in handlers.COMMAND_HANDLERS
+}
+
+
+class OutOfStockLog(AbstractNotifications):
+
+  def __init__(self):
+    self.messages = Counter()  # type: Counter
+
+  def send(self, destination, message):
+    self.messages[message] += 1
+
+
+def parse_command(line: str) -> commands.Command:
+  fields = json.loads(line)
+  command_type = COMMANDS[fields.pop('command')]
+  if command_type is commands.AllocateMany:
+    return commands.AllocateMany([
+      commands.Allocate(**allocation) for allocation in fields['lines']
+    ])
+  if fields.get('eta'):
+    fields['eta'] = date.fromisoformat(fields['eta'])
+  return command_type(**fields)
+
+
+def read_commands(files: Iterable[IO[str]]) -> Iterator[commands.Command]:
+  for file in files:
+    for line in file:
+      if line.strip():
+        yield parse_command(line)
+
+
+def make_bus(
+  store: str, sqlite_path: str, notifications: AbstractNotifications,
+) -> messagebus.MessageBus:
+  uow: unit_of_work.AbstractUnitOfWork
+  if store == 'memory':
+    uow = unit_of_work.InMemoryUnitOfWork(products={})
+  else:
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+      unit_of_work.sqlite_session_factory(sqlite_path),
+    )
+  return bootstrap.bootstrap(
+    start_orm=store != 'memory',
+    uow=uow,
+    notifications=notifications,
+    publish=lambda *args: None,
+    outbox=False,
+    engine_workers=0,
+  )
+
+
+def replay(
+  bus: messagebus.MessageBus, stream: Iterable[commands.Command], output: IO[str],
+) -> Counter:
+  totals = Counter()  # type: Counter
+  for command in stream:
+    totals['commands'] += 1
+    try:
+      [result] = bus.handle(command)
+    except Exception as e:  # pylint: disable=broad-except
+      # e.g. an unknown sku or batchref; the rest of the day goes on
+      totals['failed'] += 1
+      lines = failed(command, str(e))
+    else:
+      lines = allocations_made(command, result)
+    for line in lines:
+      if 'batchref' in line:
+        totals['allocated' if line['batchref'] else 'unallocated'] += 1
+      output.write(json.dumps(line, default=str) + '\n')
+  return totals
+
+
+def allocations_made(command: commands.Command, result) -> List[dict]:
+  if isinstance(command, commands.Allocate):
+    return [dict(
+      orderid=command.orderid, sku=command.sku, qty=command.qty,
+      batchref=result,
+    )]
+  if isinstance(command, commands.AllocateMany):
+    return result
+  return []
+
+
+def failed(command: commands.Command, message: str) -> List[dict]:
+  if isinstance(command, commands.Allocate):
+    return [dict(allocations_made(command, None)[0], message=message)]
+  if isinstance(command, commands.AllocateMany):
+    return [
+      dict(orderid=line.orderid, sku=line.sku, qty=line.qty, batchref=None,
+           message=message)
+      for line in command.lines
+    ]
+  return [dict(vars(command), command=type(command).__name__, message=message)]
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument(
+    'files', nargs='*', type=argparse.FileType('r'), default=[sys.stdin],
+  )
+  parser.add_argument('--store', choices=['memory', 'sqlite'], default='memory')
+  parser.add_argument('--sqlite-path', default=':memory:')
+  parser.add_argument(
+    '--output', type=argparse.FileType('w'), default=sys.stdout,
+  )
+  args = parser.parse_args(argv)
+
+  out_of_stock = OutOfStockLog()
+  bus = make_bus(args.store, args.sqlite_path, out_of_stock)
+  start = time.perf_counter()
+  totals = replay(bus, read_commands(args.files), args.output)
+  elapsed = time.perf_counter() - start
+  args.output.flush()
+  logger.info(
+    'replayed %s commands in %.2fs (%.0f/s): %s allocated, %s unallocated,'
+    ' %s failed',
+    totals['commands'], elapsed, totals['commands'] / max(elapsed, 1e-9),
+    totals['allocated'], totals['unallocated'], totals['failed'],
+  )
+  for message, count in out_of_stock.messages.most_common():
+    logger.info('%s (%s times)', message, count)
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO, format='%(message)s')
+  # failed commands are reported in the output instead
+  logging.getLogger(messagebus.__name__).setLevel(logging.CRITICAL)
+  main()
@@ -0,0 +1,242 @@
+from __future__ import annotations
+import logging
+import multiprocessing
+import pickle
+import threading
+import zlib
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from itertools import count
+from multiprocessing.connection import wait
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from allocation.domain import commands
+from . import messagebus
+
+logger = logging.getLogger(__name__)
+
+# commands that change one product, and so belong to the sku's owner
+ROUTED_COMMANDS = (
+  commands.Allocate, commands.AllocateMany, commands.ChangeBatchQuantity,
+  commands.CreateBatch,
+)
+
+
+class EngineError(Exception):
+  pass
+
+
+class WorkerDied(EngineError):
+  pass
+
+
+class EngineTimeout(EngineError):
+  """
+  No answer in time. The command may still be handled, or may have been
+  already: its outcome is unknown.
+  """
+
+
+class ShardedEngine:
+  """
+  Single writer per sku: skus are hash-partitioned over worker processes,
+  each with its own bus handling its partitions' commands one at a time.
+  Products never contend for rows, and can stay resident in their worker.
+
+  That holds within one engine only. Each process starting one, such as
+  every gunicorn worker and the event consumer, has its own, so a sku can
+  have a writer in each; the product's version check, and the bus's retry
+  on conflict, are what keep their changes correct.
+  """
+
+  def __init__(
+    self,
+    workers: int,
+    make_bus: Callable[[], messagebus.MessageBus],
+    sku_for_batchref: Callable[[str], Optional[str]],
+    context: str = 'spawn',
+    timeout: float = 30.0,
+    max_batch_skus: int = 100_000,
+  ):
+    self.context = multiprocessing.get_context(context)  # type: Any
+    self.timeout = timeout
+    self.make_bus = make_bus
+    self.sku_for_batchref = sku_for_batchref
+    # batchref to sku, least recently used first
+    self.batch_skus = OrderedDict()  # type: OrderedDict[str, str]
+    self.max_batch_skus = max_batch_skus
+    self.requests = [self.context.Queue() for _ in range(workers)]
+    self.results = self.context.Queue()
+    self.processes = []  # type: List[multiprocessing.process.BaseProcess]
+    # pending requests, by id, with the shard handling them
+    self.futures = {}  # type: Dict[int, Tuple[int, Future]]
+    self.dead = set()  # type: Set[int]
+    self.closing = False
+    self.ids = count()
+    self.lock = threading.Lock()
+    self.collector = threading.Thread(
+      target=self._collect, name='allocation-engine-results', daemon=True,
+    )
+    self.monitor = threading.Thread(
+      target=self._monitor, name='allocation-engine-monitor', daemon=True,
+    )
+
+  def start(self):
+    self.processes = [
+      self.context.Process(
+        target=run_worker, args=(self.make_bus, requests, self.results),
+        name=f'allocation-engine-{i}', daemon=True,
+      )
+      for i, requests in enumerate(self.requests)
+    ]
+    for process in self.processes:
+      process.start()
+    self.collector.start()
+    self.monitor.start()
+
+  def close(self):
+    self.closing = True
+    for requests in self.requests:
+      requests.put(None)
+    for process in self.processes:
+      process.join()
+    self.results.put(None)
+    self.collector.join()
+    self.monitor.join()
+
+  def shard_for(self, sku: str) -> int:
+    return zlib.crc32(sku.encode()) % len(self.requests)
+
+  def handle(self, command: commands.Command):
+    if isinstance(command, commands.AllocateMany):
+      return self._handle_many(command)
+    shard = self.shard_for(self._sku(command))
+    return self._result(self.submit(shard, command))
+
+  def submit(self, shard: int, command: commands.Command) -> Future:
+    future = Future()  # type: Future
+    with self.lock:
+      if shard in self.dead:
+        future.set_exception(WorkerDied(f'engine worker {shard} has exited'))
+        return future
+      request_id = next(self.ids)
+      self.futures[request_id] = (shard, future)
+    self.requests[shard].put((request_id, command))
+    return future
+
+  def _sku(self, command: commands.Command) -> str:
+    if isinstance(command, (commands.Allocate, commands.CreateBatch)):
+      return command.sku
+    assert isinstance(command, commands.ChangeBatchQuantity)
+    # a batch never moves to another sku, so each lookup is done once
+    # while it stays in the memo
+    with self.lock:
+      sku = self.batch_skus.get(command.ref)
+      if sku is not None:
+        self.batch_skus.move_to_end(command.ref)
+        return sku
+    sku = self.sku_for_batchref(command.ref)
+    if sku is None:
+      return ''  # unknown batch; any worker can report that
+    with self.lock:
+      self.batch_skus[command.ref] = sku
+      if len(self.batch_skus) > self.max_batch_skus:
+        self.batch_skus.popitem(last=False)
+    return sku
+
+  def _handle_many(self, command: commands.AllocateMany) -> List[dict]:
+    indexes_by_shard = defaultdict(list)
+    for i, line in enumerate(command.lines):
+      indexes_by_shard[self.shard_for(line.sku)].append(i)
+    futures = [
+      (indexes, self.submit(
+        shard, commands.AllocateMany([command.lines[i] for i in indexes]),
+      ))
+      for shard, indexes in indexes_by_shard.items()
+    ]
+    results = [None] * len(command.lines)  # type: List[Any]
+    for indexes, future in futures:
+      for i, result in zip(indexes, self._result(future)):
+        results[i] = result
+    return results
+
+  def _result(self, future: Future):
+    try:
+      return future.result(timeout=self.timeout)
+    except FutureTimeout:
+      # stop waiting for it, so a worker that never answers leaks nothing
+      with self.lock:
+        for request_id, (_, pending) in list(self.futures.items()):
+          if pending is future:
+            del self.futures[request_id]
+      raise EngineTimeout(
+        f'no answer from the engine within {self.timeout}s; the command'
+        ' may or may not take effect'
+      ) from None
+
+  def _collect(self):
+    for request_id, failed, payload in iter(self.results.get, None):
+      with self.lock:
+        pending = self.futures.pop(request_id, None)
+      if pending is None:
+        continue  # already failed: timed out, or its worker died
+      try:
+        result = pickle.loads(payload)
+      except Exception as e:  # pylint: disable=broad-except
+        failed, result = True, EngineError(f'unreadable engine result: {e}')
+      if failed:
+        pending[1].set_exception(result)
+      else:
+        pending[1].set_result(result)
+
+  def _monitor(self):
+    """
+    Fails the pending requests of a worker that has exited, e.g. killed
+    for running out of memory, and any later ones for its skus, which
+    would otherwise wait for an answer that never comes.
+    """
+    alive = {
+      process.sentinel: shard for shard, process in enumerate(self.processes)
+    }  # type: Dict[Any, int]
+    while alive:
+      for sentinel in wait(list(alive)):
+        shard = alive.pop(sentinel)
+        if self.closing:
+          continue
+        logger.error(
+          'engine worker %s exited with code %s', shard,
+          self.processes[shard].exitcode,
+        )
+        with self.lock:
+          self.dead.add(shard)
+          lost = [
+            (request_id, future)
+            for request_id, (owner, future) in self.futures.items()
+            if owner == shard
+          ]
+          for request_id, _ in lost:
+            del self.futures[request_id]
+        for _, future in lost:
+          future.set_exception(WorkerDied(f'engine worker {shard} has exited'))
+
+
+def run_worker(make_bus, requests, results):
+  bus = make_bus()
+  for request_id, command in iter(requests.get, None):
+    try:
+      [result] = bus.handle(command)
+    except Exception as e:  # pylint: disable=broad-except
+      results.put((request_id, True, dumps(e)))
+    else:
+      results.put((request_id, False, dumps(result)))
+
+
+def dumps(result) -> bytes:
+  # pickled here rather than by the queue's feeder thread, which would
+  # only log the failure and leave the caller waiting
+  try:
+    return pickle.dumps(result)
+  except Exception as e:  # pylint: disable=broad-except
+    return pickle.dumps(EngineError(
+      f'{type(result).__name__} could not be sent back from the engine'
+      f' worker: {result!r} ({e})'
+    ))
@@ -1,18 +1,28 @@
 #pylint: disable=unused-argument
 from __future__ import annotations
-from dataclasses import asdict
-from typing import List, Dict, Callable, Type, TYPE_CHECKING
+import logging
+from collections import defaultdict
+from typing import List, Dict, Callable, Optional, Type, TYPE_CHECKING
 from allocation.domain import commands, events, model
 from allocation.domain.model import OrderLine
+from . import unit_of_work
 if TYPE_CHECKING:
     from allocation.adapters import notifications
-    from . import unit_of_work
+    from allocation.adapters.cache import AbstractCache
+    from allocation.adapters.metrics import AbstractMetrics
+
+
+logger = logging.getLogger(__name__)
 
 
 class InvalidSku(Exception):
     pass
 
 
+class InvalidBatchref(Exception):
+    pass
+
+
 
 def add_batch(
 	cmd: commands.CreateBatch, uow: unit_of_work.AbstractUnitOfWork
@@ -22,28 +32,87 @@ def add_batch(
 		if product is None:
 			product = model.Product(cmd.sku, batches=[])
 			uow.products.add(product)
-		product.batches.append(model.Batch(
+		product.add_batch(model.Batch(
 			cmd.ref, cmd.sku, cmd.qty, cmd.eta
 		))
 		uow.commit()
 
 
 def allocate(
-	cmd: commands.Allocate, uow: unit_of_work.AbstractUnitOfWork
+	cmd: commands.Allocate, uow: unit_of_work.AbstractUnitOfWork,
+	metrics: Optional[AbstractMetrics] = None,
 ):
 	line = OrderLine(cmd.orderid, cmd.sku, cmd.qty)
 	with uow:
 		product = uow.products.get(sku=line.sku)
 		if product is None:
 			raise InvalidSku(f'Invalid sku {line.sku}')
-		product.allocate(line)
+		batchref = product.allocate(line)
+		if metrics:
+			record_scan(product, metrics)
+		uow.commit()
+	return batchref
+
+
+def allocate_many(
+	cmd: commands.AllocateMany, uow: unit_of_work.AbstractUnitOfWork,
+	metrics: Optional[AbstractMetrics] = None,
+) -> List[dict]:
+	results = [
+		dict(orderid=line.orderid, sku=line.sku, qty=line.qty, batchref=None)
+		for line in cmd.lines
+	]
+	lines_by_sku = defaultdict(list)
+	for i, line in enumerate(cmd.lines):
+		lines_by_sku[line.sku].append(i)
+
+	for sku, indexes in lines_by_sku.items():
+		lines = [cmd.lines[i] for i in indexes]
+		try:
+			# retried here rather than by the bus, since other products'
+			# lines may already be committed
+			for attempt in unit_of_work.retry_on_conflict():
+				with attempt:
+					batchrefs = _allocate_lines(sku, lines, uow, metrics)
+		except InvalidSku as e:
+			for i in indexes:
+				results[i]['message'] = str(e)
+		except unit_of_work.ConcurrencyError:
+			for i in indexes:
+				results[i]['message'] = f'Concurrent update to sku {sku}'
+		except Exception:  # pylint: disable=broad-except
+			# reported per line rather than raised, as that would lose the
+			# events of the skus already committed
+			logger.exception('Exception allocating lines for sku %s', sku)
+			for i in indexes:
+				results[i]['message'] = f'Could not allocate sku {sku}'
+		else:
+			for i, batchref in zip(indexes, batchrefs):
+				results[i]['batchref'] = batchref
+	return results
+
+
+def _allocate_lines(
+	sku: str, lines: List[commands.Allocate],
+	uow: unit_of_work.AbstractUnitOfWork, metrics: Optional[AbstractMetrics],
+) -> List[Optional[str]]:
+	with uow:
+		product = uow.products.get(sku=sku)
+		if product is None:
+			raise InvalidSku(f'Invalid sku {sku}')
+		batchrefs = []
+		for line in lines:
+			batchrefs.append(
+				product.allocate(OrderLine(line.orderid, line.sku, line.qty))
+			)
+			if metrics:
+				record_scan(product, metrics)
 		uow.commit()
+	return batchrefs
 
 
-def reallocate(
-	event: events.Deallocated, uow: unit_of_work.AbstractUnitOfWork
-):
-	allocate(commands.Allocate(**asdict(event)), uow=uow)
+def record_scan(product: model.Product, metrics: AbstractMetrics):
+	metrics.observe('allocation_scan_length', product.batch_index.last_scan)
 
 
 def change_batch_quantity(
@@ -51,6 +120,8 @@ def change_batch_quantity(
 ):
 	with uow:
 		product = uow.products.get_by_batchref(batchref=cmd.ref)
+		if product is None:
+			raise InvalidBatchref(f'Invalid batchref {cmd.ref}')
 		product.change_batch_quantity(ref=cmd.ref, qty=cmd.qty)
 		uow.commit()
 
@@ -69,41 +140,69 @@ def send_out_of_stock_notification(
 def publish_allocated_event(
 	event: events.Allocated, publish: Callable,
 ):
-	publish('line_allocated', event)
+	publish(EXTERNAL_CHANNELS[events.Allocated], event)
 
 
-def add_allocation_to_read_model(
-	event: events.Allocated, uow: unit_of_work.SqlAlchemyUnitOfWork,
+def add_allocations_to_read_model(
+	batch: List[events.Allocated], uow: unit_of_work.SqlAlchemyUnitOfWork,
+	cache: Optional[AbstractCache] = None,
 ):
 	with uow:
 		uow.session.execute(
 			'INSERT INTO allocations_view (orderid, sku, batchref)'
 			' VALUES (:orderid, :sku, :batchref)',
-			dict(orderid=event.orderid, sku=event.sku, batchref=event.batchref)
+			[
+				dict(orderid=e.orderid, sku=e.sku, batchref=e.batchref)
+				for e in batch
+			],
 		)
 		uow.commit()
+	if cache is not None:
+		cache.delete(*{e.orderid for e in batch})
 
 
-def remove_allocation_from_read_model(
-	event: events.Deallocated, uow: unit_of_work.SqlAlchemyUnitOfWork,
+def remove_allocations_from_read_model(
+	batch: List[events.Deallocated], uow: unit_of_work.SqlAlchemyUnitOfWork,
+	cache: Optional[AbstractCache] = None,
 ):
 	with uow:
 		uow.session.execute(
 			'DELETE FROM allocations_view '
 			' WHERE orderid = :orderid AND sku = :sku',
-			dict(orderid=event.orderid, sku=event.sku)
+			[dict(orderid=e.orderid, sku=e.sku) for e in batch],
 		)
 		uow.commit()
+	if cache is not None:
+		cache.delete(*{e.orderid for e in batch})
+
+
+# events published to other systems, by channel; with the outbox enabled
+# the unit of work stores these and the publish handlers are left out
+EXTERNAL_CHANNELS = {
+    events.Allocated: 'line_allocated',
+}  # type: Dict[Type[events.Event], str]
 
+PUBLISH_HANDLERS = {publish_allocated_event}
+
+# left out for units of work without the allocations_view table
+READ_MODEL_HANDLERS = {
+    add_allocations_to_read_model, remove_allocations_from_read_model,
+}
 
 EVENT_HANDLERS = {
-    events.Allocated: [publish_allocated_event, add_allocation_to_read_model],
-    events.Deallocated: [remove_allocation_from_read_model, reallocate],
+    events.Allocated: [publish_allocated_event],
     events.OutOfStock: [send_out_of_stock_notification],
 }  # type: Dict[Type[events.Event], List[Callable]]
 
+# handlers taking a list of events of one type
+BATCH_EVENT_HANDLERS = {
+    events.Allocated: [add_allocations_to_read_model],
+    events.Deallocated: [remove_allocations_from_read_model],
+}  # type: Dict[Type[events.Event], List[Callable]]
+
 COMMAND_HANDLERS = {
     commands.Allocate: allocate,
+    commands.AllocateMany: allocate_many,
     commands.CreateBatch: add_batch,
     commands.ChangeBatchQuantity: change_batch_quantity,
 }  # type: Dict[Type[commands.Command], Callable]
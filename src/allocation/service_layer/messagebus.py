@@ -1,16 +1,35 @@
 from __future__ import annotations
 import logging
-from typing import Callable, Dict, List, Union, Type, TYPE_CHECKING
+import time
+from collections import deque
+from typing import (
+  Any, Callable, Deque, Dict, List, NamedTuple, Optional, Sequence, Union, Type,
+)
+from allocation.adapters.metrics import AbstractMetrics, handler_name
 from allocation.domain import commands, events
-
-if TYPE_CHECKING:
-  from . import unit_of_work
+from . import unit_of_work
 
 logger = logging.getLogger(__name__)
 
 Message = Union[commands.Command, events.Event]
 
 
+class Route(NamedTuple):
+  """Where messages of one type go, resolved once per type."""
+  is_command: bool
+  command_handler: Optional[Callable] = None
+  retry_on_conflict: bool = True
+  event_handlers: Sequence[Callable] = ()
+  # handlers taking a list of events, and the type they're grouped under
+  batched: bool = False
+  batch_handlers: Sequence[Callable] = ()
+  batch_type: type = events.Event
+
+
+# nothing pending yet
+NO_ROUTE = Route(False)
+
+
 class MessageBus:
 
   def __init__(
@@ -18,40 +37,209 @@ class MessageBus:
     uow: unit_of_work.AbstractUnitOfWork,
     event_handlers: Dict[Type[events.Event], List[Callable]],
     command_handlers: Dict[Type[commands.Command], Callable],
+    batch_event_handlers: Optional[
+      Dict[Type[events.Event], List[Callable]]
+    ] = None,
+    batch_events: bool = True,
+    after_handle: Optional[List[Callable]] = None,
+    retry_attempts: int = 3,
+    retry_backoff: float = 0.05,
+    metrics: Optional[AbstractMetrics] = None,
+    unretried_commands: Sequence[Type[commands.Command]] = (),
   ):
     self.uow = uow
     self.event_handlers = event_handlers
     self.command_handlers = command_handlers
+    self.batch_event_handlers = batch_event_handlers or {}
+    self.batch_events = batch_events
+    self.after_handle = after_handle or []
+    self.retry_attempts = retry_attempts
+    self.retry_backoff = retry_backoff
+    # their handlers retry conflicts themselves, e.g. in the engine's workers
+    self.unretried_commands = unretried_commands
+    # None turns instrumentation off, at the cost of a check per message
+    self.metrics = metrics
+    self.debug = False
+    self.routes = {}  # type: Dict[type, Route]
+    for message_type in [
+      *self.command_handlers, *self.event_handlers, *self.batch_event_handlers,
+    ]:
+      self.compile_route(message_type)
 
-  def handle(self, message: Message):
-    self.queue = [message]
-    while self.queue:
-      message = self.queue.pop(0)
-      if isinstance(message, events.Event):
-          self.handle_event(message)
-      elif isinstance(message, commands.Command):
-          self.handle_command(message)
+  def compile_route(self, message_type: type) -> Route:
+    """
+    Resolves a message type to its handlers, through its base classes, and
+    keeps the result so each type is only resolved once.
+    """
+    for base in message_type.__mro__:
+      if base in self.command_handlers:
+        route = Route(
+          True, command_handler=self.command_handlers[base],
+          retry_on_conflict=base not in self.unretried_commands,
+        )
+        break
+      if base in self.event_handlers or base in self.batch_event_handlers:
+        route = Route(
+          False,
+          event_handlers=self.event_handlers.get(base, []),
+          batched=base in self.batch_event_handlers,
+          batch_handlers=self.batch_event_handlers.get(base, []),
+          batch_type=base,
+        )
+        break
+    else:
+      if issubclass(message_type, commands.Command):
+        route = Route(True)
+      elif issubclass(message_type, events.Event):
+        route = Route(False)
       else:
-          raise Exception(f'{message} was not an Event or Command')
+        raise Exception(f'{message_type} was not an Event or Command')
+    self.routes[message_type] = route
+    return route
+
+  def handle(self, message: Message) -> List:
+    results = []
+    self.queue = deque([message])  # type: Deque[Message]
+    self.pending = []  # type: List[events.Event]
+    self.pending_route = NO_ROUTE
+    self.debug = logger.isEnabledFor(logging.DEBUG)
+    routes = self.routes
+    metrics = self.metrics
+    handled = 0
+    try:
+      while self.queue or self.pending:
+        if not self.queue:
+          self.flush_pending()
+          continue
+        # the route tells commands from events, without isinstance checks
+        current = self.queue.popleft()  # type: Any
+        message_type = type(current)
+        route = routes.get(message_type) or self.compile_route(message_type)
+        handled += 1
+        start = time.perf_counter() if metrics else 0.0
+        try:
+          if route.is_command:
+            results.append(self.handle_command(current, route))
+          else:
+            self.handle_event(current, route)
+        finally:
+          if metrics:
+            metrics.observe(
+              'allocation_message_seconds', time.perf_counter() - start,
+              message_type=message_type.__name__,
+              kind='command' if route.is_command else 'event',
+            )
+    finally:
+      if metrics:
+        metrics.observe('allocation_messages_per_handle', handled)
+      for hook in self.after_handle:
+        try:
+          hook()
+        except Exception:
+          logger.exception('Exception in after-handle hook %s', hook)
+    return results
+
 
+  def handle_event(self, event: events.Event, route: Route):
+    if route.batched:
+      if self.batch_events:
+        # consecutive events of one type are held back and delivered
+        # together; a different type flushes them, so order is preserved
+        if self.pending and self.pending_route.batch_type is not route.batch_type:
+          self.flush_pending()
+        self.pending.append(event)
+        self.pending_route = route
+      else:
+        self.handle_event_batch([event], route)
 
-  def handle_event(self, event: events.Event):
-    for handler in self.event_handlers[type(event)]:
+    for handler in route.event_handlers:
       try:
-        logger.debug('handling event %s with handler %s', event, handler)
+        if self.debug:
+          logger.debug('handling event %s with handler %s', event, handler)
         handler(event)
         self.queue.extend(self.uow.collect_new_events())
       except Exception:
         logger.exception('Exception handling event %s', event)
+        self.count_error(type(event), handler)
         continue
 
 
-  def handle_command(self, command: commands.Command):
-    logger.debug('handling command %s', command)
+  def flush_pending(self):
+    pending, self.pending = self.pending, []
+    route = self.pending_route
+    metrics = self.metrics
+    start = time.perf_counter() if metrics else 0.0
+    self.handle_event_batch(pending, route)
+    if metrics:
+      metrics.observe(
+        'allocation_message_seconds', time.perf_counter() - start,
+        message_type=route.batch_type.__name__, kind='batch',
+      )
+
+
+  def handle_event_batch(self, batch: List[events.Event], route: Route):
+    for handler in route.batch_handlers:
+      try:
+        if self.debug:
+          logger.debug(
+            'handling %d %s events with handler %s',
+            len(batch), route.batch_type.__name__, handler,
+          )
+        handler(batch)
+        self.queue.extend(self.uow.collect_new_events())
+      except Exception:
+        logger.exception('Exception handling %d events %s', len(batch), batch)
+        self.count_error(route.batch_type, handler)
+        continue
+
+
+  def handle_command(self, command: commands.Command, route: Route):
+    if self.debug:
+      logger.debug('handling command %s', command)
     try:
-      handler = self.command_handlers[type(command)]
-      handler(command)
+      handler = route.command_handler
+      if handler is None:
+        raise KeyError(type(command))
+      try:
+        result = handler(command)
+      except unit_of_work.ConcurrencyError as e:
+        if not route.retry_on_conflict:
+          raise
+        # building the retry loop only once there's a conflict keeps it
+        # off the common path
+        result = self.retry_command(command, handler, e)
       self.queue.extend(self.uow.collect_new_events())
+      return result
     except Exception:
       logger.exception('Exception handling command %s', command)
+      self.count_error(type(command), route.command_handler)
       raise
+
+
+  def retry_command(
+    self, command: commands.Command, handler: Callable,
+    conflict: unit_of_work.ConcurrencyError,
+  ):
+    retrying = unit_of_work.retry_on_conflict(
+      self.retry_attempts, self.retry_backoff,
+    )
+    for attempt in retrying:
+      with attempt:
+        if attempt.retry_state.attempt_number == 1:
+          raise conflict
+        logger.warning('retrying command %s after conflict', command)
+        if self.metrics:
+          self.metrics.increment(
+            'allocation_command_retries_total',
+            message_type=type(command).__name__,
+          )
+        result = handler(command)
+    return result
+
+
+  def count_error(self, message_type: type, handler: Optional[Callable]):
+    if self.metrics:
+      self.metrics.increment(
+        'allocation_handler_errors_total',
+        message_type=message_type.__name__, handler=handler_name(handler),
+      )
@@ -1,17 +1,51 @@
 # pylint: disable=attribute-defined-outside-init
 from __future__ import annotations
 import abc
-from sqlalchemy import create_engine
+import functools
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set, Type
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import DisconnectionError, OperationalError
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
 from sqlalchemy.orm.session import Session
+from sqlalchemy.pool import StaticPool
+from tenacity import (
+	Retrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential,
+)
 
 
 from allocation import config
-from allocation.adapters import repository
+from allocation.adapters import orm, outbox, pool, repository
+from allocation.adapters.cache import AggregateCache
+from allocation.adapters.metrics import AbstractMetrics
+from allocation.domain import events, model
+
+
+class ConcurrencyError(Exception):
+	pass
+
+
+# serialization_failure, deadlock_detected
+RETRYABLE_PGCODES = {'40001', '40P01'}
+
+
+def retry_on_conflict(attempts=3, backoff=0.05) -> Retrying:
+	return Retrying(
+		retry=retry_if_exception_type(ConcurrencyError),
+		stop=stop_after_attempt(attempts),
+		wait=wait_random_exponential(multiplier=backoff, max=backoff * 2 ** attempts),
+		reraise=True,
+	)
 
 
 class AbstractUnitOfWork(abc.ABC):
 	products: repository.AbstractRepository
+	metrics = None  # type: Optional[AbstractMetrics]
+	# whether the allocations_view read model is kept in this store
+	read_model = True
 
 	def __enter__(self) -> AbstractUnitOfWork:
 		return self
@@ -24,8 +58,8 @@ class AbstractUnitOfWork(abc.ABC):
 
 	def collect_new_events(self):
 		for product in self.products.seen:
-			while product.events:
-				yield product.events.pop(0)
+			new_events, product.events[:] = product.events[:], []
+			yield from new_events
 
 	@abc.abstractmethod
 	def _commit(self):
@@ -37,27 +71,276 @@ class AbstractUnitOfWork(abc.ABC):
 
 
 
-DEFAULT_SESSION_FACTORY = sessionmaker(bind=create_engine(
-	config.get_postgres_uri(),
-	isolation_level="REPEATABLE READ",
-))
+def make_engine():
+	settings = config.get_db_settings()
+	connect_args = {}
+	if settings['statement_timeout_ms']:
+		connect_args['options'] = f"-c statement_timeout={settings['statement_timeout_ms']}"
+	dialect_args = {}
+	if settings['executemany_mode']:
+		dialect_args['executemany_mode'] = settings['executemany_mode']
+	engine = create_engine(
+		config.get_postgres_uri(),
+		isolation_level="READ COMMITTED",
+		poolclass=pool.InstrumentedQueuePool,
+		pool_size=settings['pool_size'],
+		max_overflow=settings['max_overflow'],
+		pool_timeout=settings['pool_timeout'],
+		pool_pre_ping=settings['pool_pre_ping'],
+		pool_recycle=settings['pool_recycle'],
+		connect_args=connect_args,
+		**dialect_args,
+	)
+	detach_connections_of_other_processes(engine)
+	return engine
+
+
+# connections and engines inherited from a parent process: referenced, so
+# garbage collection never closes them, which would end the parent's
+# sessions on the server too
+_inherited = []  # type: List[Any]
+
+
+def detach_connections_of_other_processes(engine):
+	"""
+	SQLAlchemy's recipe for pools that cross a fork: a connection checked
+	out in another process than the one that opened it is given up on, and
+	a new one opened in its place.
+	"""
+	@event.listens_for(engine, 'connect')
+	def record_pid(dbapi_connection, connection_record):
+		connection_record.info['pid'] = os.getpid()
+
+	@event.listens_for(engine, 'checkout')
+	def check_pid(dbapi_connection, connection_record, connection_proxy):
+		pid = os.getpid()
+		if connection_record.info['pid'] != pid:
+			_inherited.append(dbapi_connection)
+			connection_record.connection = connection_proxy.connection = None
+			raise DisconnectionError(
+				f"connection opened by process {connection_record.info['pid']},"
+				f' checked out by {pid}'
+			)
+
+
+_session_factories = {}  # type: Dict[int, sessionmaker]
+_session_factories_lock = threading.Lock()
+
+
+def default_session_factory() -> sessionmaker:
+	"""
+	One engine per process, made on first use. A process forked after that
+	makes its own rather than share the parent's connections. The parent's
+	engine is kept, never used nor garbage collected, so its connections
+	stay open for the parent.
+	"""
+	pid = os.getpid()
+	session_factory = _session_factories.get(pid)
+	if session_factory is None:
+		with _session_factories_lock:
+			session_factory = _session_factories.get(pid)
+			if session_factory is None:
+				_inherited.extend(_session_factories.values())
+				_session_factories.clear()
+				session_factory = sessionmaker(bind=make_engine())
+				_session_factories[pid] = session_factory
+	return session_factory
+
+
+def pool_stats() -> dict:
+	# without making an engine, if this process hasn't needed one yet
+	session_factory = _session_factories.get(os.getpid())
+	if session_factory is None:
+		return {}
+	return session_factory.kw['bind'].pool.stats()
+
+
+def pool_metrics() -> Dict[str, float]:
+	stats = pool_stats()
+	if not stats:
+		return {}
+	return {
+		'allocation_db_pool_size': stats['size'],
+		'allocation_db_pool_checked_out': stats['checked_out'],
+		'allocation_db_pool_overflow': stats['overflow'],
+		# cumulative, so counters
+		'allocation_db_pool_checkouts_total': stats['checkouts'],
+		'allocation_db_pool_wait_seconds_total': stats['wait_seconds_total'],
+	}
+
+
+@functools.lru_cache(maxsize=None)
+def sqlite_session_factory(path: str = ':memory:') -> sessionmaker:
+	"""
+	A SQLite database with the schema created, one per path per process.
+	An in-memory one lives on a single connection, shared by every thread.
+	"""
+	if path == ':memory:':
+		engine = create_engine(
+			'sqlite://', poolclass=StaticPool,
+			connect_args={'check_same_thread': False},
+		)
+	else:
+		engine = create_engine(f'sqlite:///{path}')
+	orm.metadata.create_all(engine)
+	return sessionmaker(bind=engine)
+
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
 
-	def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
+	def __init__(
+		self, session_factory=None, loading='selectin',
+		outbox_channels: Optional[Dict[Type[events.Event], str]] = None,
+	):
+		# None means this process's default engine, made on first use
 		self.session_factory = session_factory
+		self.loading = loading
+		# events of these types are written to the outbox table, for the
+		# relay to publish on the given channel
+		self.outbox_channels = outbox_channels
 
 	def __enter__(self):
-		self.session = self.session_factory()  # type: Session
-		self.products = repository.SqlAlchemyRepository(self.session)
+		# products whose events haven't been collected yet, e.g. from an
+		# earlier unit of work in the same handler, must not be forgotten
+		previous = getattr(self, 'products', None)
+		pending = {p for p in previous.seen if p.events} if previous else set()
+		self.session = self._make_session()  # type: Session
+		self.products = self._make_repository()
+		self.products.seen.update(pending)
+		self.carried_over = pending
+		self.outcome = 'rollback'
+		self.entered_at = time.perf_counter() if self.metrics else 0.0
 		return super().__enter__()
 
-	def __exit__(self, *args):
-		super().__exit__(*args)
+	def __exit__(self, exc_type, *args):
+		if exc_type is not None:
+			# whatever these products announced was rolled back with them
+			for product in self.products.seen - self.carried_over:
+				product.events.clear()
+		super().__exit__(exc_type, *args)
 		self.session.close()
+		if self.metrics:
+			self.metrics.observe(
+				'allocation_transaction_seconds',
+				time.perf_counter() - self.entered_at, outcome=self.outcome,
+			)
 
 	def _commit(self):
-		self.session.commit()
+		if self.outbox_channels:
+			outbox.add_events(self.session, [
+				(self.outbox_channels[type(event)], event)
+				for product in self.products.seen - self.carried_over
+				for event in product.events
+				if type(event) in self.outbox_channels
+			])
+		start = time.perf_counter() if self.metrics else 0.0
+		try:
+			self.session.commit()
+			self.outcome = 'commit'
+		except StaleDataError as e:
+			raise ConcurrencyError(str(e)) from e
+		except OperationalError as e:
+			if getattr(e.orig, 'pgcode', None) in RETRYABLE_PGCODES:
+				raise ConcurrencyError(str(e)) from e
+			raise
+		finally:
+			if self.metrics:
+				self.metrics.observe(
+					'allocation_commit_seconds', time.perf_counter() - start,
+				)
 
 	def rollback(self):
 		self.session.rollback()
+
+	def _make_session(self, **kwargs) -> Session:
+		session_factory = self.session_factory or default_session_factory()
+		return session_factory(**kwargs)
+
+	def _make_repository(self) -> repository.AbstractRepository:
+		return repository.SqlAlchemyRepository(self.session, loading=self.loading)
+
+
+class CachingSqlAlchemyUnitOfWork(SqlAlchemyUnitOfWork):
+	"""
+	Keeps committed products resident in `aggregates` for later units of
+	work, in this process or another thread's unit of work sharing the
+	cache. A product goes back only after a clean commit and once its events
+	have been collected, so its events are never handed to someone else.
+	"""
+
+	def __init__(
+		self, aggregates: AggregateCache,
+		session_factory=None, **kwargs,
+	):
+		super().__init__(session_factory, **kwargs)
+		self.aggregates = aggregates
+		self.committed = set()  # type: Set[model.Product]
+		self.resident = set()  # type: Set[model.Product]
+
+	def __exit__(self, exc_type, *args):
+		session = self.session
+		if exc_type is None and not (session.new or session.dirty or session.deleted):
+			self.resident.update(self.committed)
+			# detached, the rollback below can't expire them
+			session.expunge_all()
+		self.committed = set()
+		super().__exit__(exc_type, *args)
+		self._release()
+
+	def _commit(self):
+		super()._commit()
+		self.committed = self.products.seen - self.carried_over
+
+	def collect_new_events(self):
+		yield from super().collect_new_events()
+		self._release()
+
+	def _release(self):
+		for product in [p for p in self.resident if not p.events]:
+			self.resident.discard(product)
+			self.aggregates.set(product.sku, product)
+
+	def _make_session(self, **kwargs) -> Session:
+		# resident products must stay loaded after their session has gone
+		kwargs.setdefault('expire_on_commit', False)
+		return super()._make_session(**kwargs)
+
+	def _make_repository(self):
+		return repository.CachingSqlAlchemyRepository(
+			self.session, self.aggregates, loading=self.loading,
+		)
+
+
+@functools.lru_cache(maxsize=None)
+def in_memory_products() -> Dict[str, model.Product]:
+	# the default store of InMemoryUnitOfWork, one per process
+	return {}
+
+
+class InMemoryUnitOfWork(AbstractUnitOfWork):
+	"""
+	Products kept in a dict rather than a database, for simulations and
+	tests; no ORM mappers needed. Units of work given the same dict see
+	each other's products, but none of them is thread safe. Nothing is
+	rolled back: a handler that fails has raised before changing a product.
+	"""
+
+	read_model = False
+
+	def __init__(self, products: Optional[Dict[str, model.Product]] = None):
+		self.store = in_memory_products() if products is None else products
+		self.products = repository.InMemoryRepository(self.store)
+
+	def __enter__(self):
+		# as with a database, each unit of work gets a fresh repository,
+		# keeping products whose events haven't been collected yet
+		pending = {p for p in self.products.seen if p.events}
+		self.products = repository.InMemoryRepository(self.store)
+		self.products.seen.update(pending)
+		return super().__enter__()
+
+	def _commit(self):
+		pass
+
+	def rollback(self):
+		pass
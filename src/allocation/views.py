@@ -1,9 +1,109 @@
+from typing import Optional
+from allocation.adapters import orm
+from allocation.adapters.cache import AbstractCache
 from allocation.service_layer import unit_of_work
 
-def allocations(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
+def allocations(
+    orderid: str, uow: unit_of_work.AbstractUnitOfWork,
+    cache: Optional[AbstractCache] = None,
+):
+  if not isinstance(uow, unit_of_work.SqlAlchemyUnitOfWork):
+    # see AbstractUnitOfWork.read_model
+    raise TypeError(f'{type(uow).__name__} keeps no allocations view')
+  if cache is not None:
+    cached = cache.get(orderid)
+    if cached is not None:
+      return cached
+    generation = cache.generation(orderid)
   with uow:
     results = list(uow.session.execute(
         'SELECT sku, batchref FROM allocations_view WHERE orderid = :orderid',
         dict(orderid=orderid)
     ))
-  return [dict(r) for r in results]
+  results = [dict(r) for r in results]
+  # an order not allocated yet may be allocated by another process, which
+  # only invalidates orders it changes; nor are rows kept that the order
+  # changed under while they were read
+  if cache is not None and results:
+    cache.set_if_unchanged(orderid, results, generation)
+  return results
+
+
+def batch_sku(batchref: str, uow: unit_of_work.AbstractUnitOfWork):
+  if not isinstance(uow, unit_of_work.SqlAlchemyUnitOfWork):
+    with uow:
+      product = uow.products.get_by_batchref(batchref)
+    return product.sku if product else None
+  with uow:
+    row = uow.session.execute(
+        'SELECT sku FROM batches WHERE reference = :batchref',
+        dict(batchref=batchref)
+    ).first()
+  return row.sku if row else None
+
+
+def rebuild_allocations(
+    uow: unit_of_work.SqlAlchemyUnitOfWork, chunk_size: int = 10_000,
+    cache: Optional[AbstractCache] = None,
+) -> int:
+  """
+  Rebuilds allocations_view from the write model into a staging table, a
+  range of allocation ids per transaction, then swaps it in with one
+  transaction: readers see the old view until the new one is complete.
+  Run it with event consumers stopped, or their changes in the meantime
+  are lost with the old view.
+  """
+  with uow:
+    connection = uow.session.connection()
+    orm.allocations_view_rebuild.drop(connection, checkfirst=True)
+    orm.allocations_view_rebuild.create(connection)
+    [[max_id]] = uow.session.execute('SELECT MAX(id) FROM allocations')
+    uow.commit()
+
+  rebuilt = 0
+  for start in range(0, (max_id or 0) + 1, chunk_size):
+    with uow:
+      result = uow.session.execute(
+          'INSERT INTO allocations_view_rebuild (orderid, sku, batchref)'
+          ' SELECT ol.orderid, ol.sku, b.reference'
+          ' FROM allocations AS a'
+          ' JOIN order_lines AS ol ON a.orderline_id = ol.id'
+          ' JOIN batches AS b ON a.batch_id = b.id'
+          ' WHERE a.id > :start AND a.id <= :end',
+          dict(start=start - 1, end=start + chunk_size - 1),
+      )
+      uow.commit()
+    rebuilt += result.rowcount
+
+  with uow:
+    _swap_in_rebuilt_allocations(uow.session.connection())
+    uow.commit()
+  if cache is not None:
+    cache.clear()
+  return rebuilt
+
+
+def _swap_in_rebuilt_allocations(connection):
+  orm.allocations_view.drop(connection)
+  connection.execute(
+      'ALTER TABLE allocations_view_rebuild RENAME TO allocations_view'
+  )
+  # the next rebuild creates its staging table under the same names
+  if connection.dialect.name == 'postgresql':
+    connection.execute(
+        'ALTER INDEX ix_allocations_view_rebuild_orderid_sku'
+        ' RENAME TO ix_allocations_view_orderid_sku'
+    )
+    connection.execute(
+        'ALTER TABLE allocations_view RENAME CONSTRAINT'
+        ' allocations_view_rebuild_pkey TO allocations_view_pkey'
+    )
+    connection.execute(
+        'ALTER SEQUENCE allocations_view_rebuild_id_seq'
+        ' RENAME TO allocations_view_id_seq'
+    )
+  else:
+    # SQLite can't rename an index
+    connection.execute('DROP INDEX ix_allocations_view_rebuild_orderid_sku')
+    for index in orm.allocations_view.indexes:
+      index.create(connection)
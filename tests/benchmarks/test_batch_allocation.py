@@ -0,0 +1,61 @@
+import time
+from datetime import date, timedelta
+from allocation.domain.model import Batch, OrderLine, Product
+
+
+def time_per_allocation(existing_lines, sample_size=500):
+  batch = Batch('batch1', 'BENCH-SKU', existing_lines + sample_size, eta=None)
+  for i in range(existing_lines):
+    batch.allocate(OrderLine(f'existing-{i}', 'BENCH-SKU', 1))
+
+  sample = [OrderLine(f'sample-{i}', 'BENCH-SKU', 1) for i in range(sample_size)]
+  start = time.perf_counter()
+  for line in sample:
+    batch.allocate(line)
+  elapsed = time.perf_counter() - start
+
+  assert batch.available_quantity == 0
+  return elapsed / sample_size
+
+
+def test_per_allocation_cost_is_flat_as_line_count_grows():
+  small = min(time_per_allocation(100) for _ in range(3))
+  large = min(time_per_allocation(20_000) for _ in range(3))
+  # summing allocations on every call would make this ~200x slower
+  assert large < small * 10
+
+
+def test_running_total_survives_deallocation():
+  batch = Batch('batch1', 'BENCH-SKU', 100, eta=None)
+  for i in range(10):
+    batch.allocate(OrderLine(f'order-{i}', 'BENCH-SKU', 5))
+  batch.deallocate_one()
+  assert batch.allocated_quantity == 45
+  assert batch.allocated_quantity == sum(l.qty for l in batch._allocations)
+
+
+def time_per_product_allocation(batch_count, sample_size=500):
+  batches = [
+    Batch(f'batch-{i}', 'BENCH-SKU', 1, eta=date.today() + timedelta(days=i))
+    for i in range(batch_count - 1)
+  ]
+  # the only batch with room is the last one in allocation order
+  batches.append(Batch(
+    'roomy-batch', 'BENCH-SKU', 2 * sample_size + 1,
+    eta=date.today() + timedelta(days=batch_count),
+  ))
+  product = Product('BENCH-SKU', batches=batches)
+  product.allocate(OrderLine('warm-up', 'BENCH-SKU', 1))
+
+  sample = [OrderLine(f'sample-{i}', 'BENCH-SKU', 2) for i in range(sample_size)]
+  start = time.perf_counter()
+  for line in sample:
+    assert product.allocate(line) == 'roomy-batch'
+  return (time.perf_counter() - start) / sample_size
+
+
+def test_per_allocation_cost_barely_grows_with_batch_count():
+  few = min(time_per_product_allocation(4) for _ in range(3))
+  many = min(time_per_product_allocation(2_000) for _ in range(3))
+  # re-sorting and scanning every batch would make this ~500x slower
+  assert many < few * 10
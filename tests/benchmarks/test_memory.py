@@ -0,0 +1,40 @@
+import sys
+import tracemalloc
+from dataclasses import dataclass
+from allocation.domain.model import Batch, OrderLine
+
+
+@dataclass(unsafe_hash=True)
+class UnsharedOrderLine:
+  """ the old representation, for comparison """
+  orderid: str
+  sku: str
+  qty: int
+
+
+def bytes_per_line(line_class, count=20_000):
+  batch = Batch('batch1', 'BENCH-SKU', count, eta=None)
+  tracemalloc.start()
+  try:
+    start, _ = tracemalloc.get_traced_memory()
+    for i in range(count):
+      # a fresh sku string per row, as the database driver hands them back
+      sku = ''.join(['BENCH-', 'SKU'])
+      batch.allocate(line_class(f'order-{i}', sku, 1))
+    end, _ = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+  assert batch.allocated_quantity == count
+  return (end - start) / count
+
+
+def test_lines_are_smaller_than_before():
+  before = bytes_per_line(UnsharedOrderLine)
+  after = bytes_per_line(OrderLine)
+  assert after < before, f'bytes per line: before={before:.0f} after={after:.0f}'
+
+
+def test_lines_share_their_sku():
+  lines = [OrderLine(f'order-{i}', ''.join(['BENCH-', 'SKU']), 1) for i in range(3)]
+  assert len({id(line.sku) for line in lines}) == 1
+  assert lines[0].sku is sys.intern('BENCH-SKU')
@@ -0,0 +1,79 @@
+import time
+from allocation import bootstrap
+from allocation.domain import commands, model
+from allocation.service_layer import messagebus
+from ..unit.test_handlers import FakeNotifications, FakeUnitOfWork
+
+
+class FakeSession:
+
+  def execute(self, *args, **kwargs):
+    pass
+
+
+class BenchUnitOfWork(FakeUnitOfWork):
+  """ with a session for the read model handlers to write to """
+
+  def __init__(self):
+    super().__init__()
+    self.session = FakeSession()
+
+
+def messages_per_second(handle, messages):
+  start = time.perf_counter()
+  for message in messages:
+    handle(message)
+  return len(messages) / (time.perf_counter() - start)
+
+
+def best_of(rounds, measure):
+  return max(measure() for _ in range(rounds))
+
+
+# Rates are compared with the same work done without the bus, measured in
+# the same run, so the thresholds hold on slower or busier machines. When
+# the dispatch table was compiled, bare dispatch went from about 1/900 to
+# 1/33 the rate of plain function calls, and allocate commands from 1/16
+# to 1/4 the rate of allocating on the product directly.
+
+
+def test_dispatch_throughput():
+  bus = messagebus.MessageBus(
+    uow=FakeUnitOfWork(),
+    event_handlers={},
+    command_handlers={commands.Allocate: lambda cmd: None},
+  )
+  messages = [commands.Allocate(f'o{i}', 'sku1', 1) for i in range(20_000)]
+  rate = best_of(3, lambda: messages_per_second(bus.handle, messages))
+  calls = best_of(3, lambda: messages_per_second(lambda cmd: None, messages))
+  assert rate > calls / 100, f'{rate:,.0f} messages/s, {calls:,.0f} calls/s'
+
+
+def allocations_per_second(count=5_000):
+  product = model.Product('sku1', batches=[
+    model.Batch('b1', 'sku1', 1_000_000, eta=None),
+  ])
+  lines = [model.OrderLine(f'o{i}', 'sku1', 1) for i in range(count)]
+  return messages_per_second(product.allocate, lines)
+
+
+def commands_per_second(count=5_000):
+  uow = BenchUnitOfWork()
+  uow.products.add(model.Product('sku1', batches=[
+    model.Batch('b1', 'sku1', 1_000_000, eta=None),
+  ]))
+  bus = bootstrap.bootstrap(
+    start_orm=False, uow=uow, notifications=FakeNotifications(),
+    publish=lambda *args: None, outbox=False, engine_workers=0,
+  )
+  # each command also raises an Allocated event, handled by the bus
+  messages = [commands.Allocate(f'o{i}', 'sku1', 1) for i in range(count)]
+  return messages_per_second(bus.handle, messages)
+
+
+def test_allocation_throughput():
+  rate = best_of(3, commands_per_second)
+  direct = best_of(3, allocations_per_second)
+  assert rate > direct / 8, (
+    f'{rate:,.0f} commands/s, {direct:,.0f} allocations/s on the product'
+  )
@@ -0,0 +1,52 @@
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+STARTUP_SCRIPT = textwrap.dedent('''
+  import json, socket, time
+  connects = []
+  real_connect = socket.socket.connect
+
+  def connect(sock, address):
+    connects.append(repr(address))
+    return real_connect(sock, address)
+
+  socket.socket.connect = connect
+
+  start = time.perf_counter()
+  from allocation import bootstrap
+  from allocation.entrypoints import flask_app, outbox_relay, redis_eventconsumer
+  from allocation.service_layer import unit_of_work
+  imported = time.perf_counter()
+  bus = bootstrap.bootstrap()
+  app = flask_app.create_app()
+  built = time.perf_counter()
+
+  print(json.dumps(dict(
+    import_seconds=imported - start,
+    bootstrap_seconds=built - imported,
+    connects=connects,
+    engines=len(unit_of_work._session_factories),
+  )))
+''')
+
+
+def run_startup():
+  # a fresh interpreter, so nothing is imported or connected already
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+  output = subprocess.run(
+    [sys.executable, '-c', STARTUP_SCRIPT],
+    env=env, check=True, capture_output=True, text=True,
+  ).stdout
+  return json.loads(output.splitlines()[-1])
+
+
+def test_startup_opens_no_connections_and_bootstraps_in_milliseconds():
+  startup = run_startup()
+  assert startup['connects'] == []
+  assert startup['engines'] == 0
+  assert startup['bootstrap_seconds'] < 0.05, startup
+  # Flask, SQLAlchemy and redis-py take most of it; generous, for slow hosts
+  assert startup['import_seconds'] < 2, startup
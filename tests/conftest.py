@@ -7,7 +7,7 @@ from pathlib import Path
 import pytest
 import redis
 import requests
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, clear_mappers
 from tenacity import retry, stop_after_delay
 
@@ -16,6 +16,20 @@ from allocation import config
 
 pytest.register_assert_rewrite('tests.e2e.api_client')
 
+def pytest_configure(config):
+	config.addinivalue_line(
+		'markers', 'load: timed runs, left out unless selected with -m load',
+	)
+
+def pytest_collection_modifyitems(config, items):
+	if config.getoption('markexpr'):
+		return
+	# their timings depend on the machine, so they only run when asked for
+	timed = [item for item in items if item.get_closest_marker('load')]
+	if timed:
+		config.hook.pytest_deselected(items=timed)
+		items[:] = [item for item in items if item not in timed]
+
 @pytest.fixture
 def in_memory_sqlite_db():
 	engine = create_engine('sqlite:///:memory:')
@@ -26,6 +40,17 @@ def in_memory_sqlite_db():
 def sqlite_session_factory(in_memory_sqlite_db):
 	yield sessionmaker(bind=in_memory_sqlite_db)
 
+@pytest.fixture
+def query_log(in_memory_sqlite_db):
+	statements = []
+
+	def log_statement(conn, cursor, statement, *args):
+		statements.append(statement)
+
+	event.listen(in_memory_sqlite_db, 'before_cursor_execute', log_statement)
+	yield statements
+	event.remove(in_memory_sqlite_db, 'before_cursor_execute', log_statement)
+
 @pytest.fixture
 def mappers():
 	start_mappers()
@@ -20,6 +20,12 @@ def post_to_allocate(orderid, sku, qty, expect_success=True):
       assert r.status_code == 202
   return r
 
+def post_to_allocate_bulk(lines):
+  url = config.get_api_url()
+  r = requests.post(f'{url}/allocate/bulk', json={'lines': lines})
+  assert r.status_code == 202
+  return r
+
 def get_allocation(orderid):
   url = config.get_api_url()
   return requests.get(f'{url}/allocations/{orderid}')
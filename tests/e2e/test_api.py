@@ -36,3 +36,24 @@ def test_unhappy_path_returns_400_and_error_message():
 
 	r = api_client.get_allocation(orderid)
 	assert r.status_code == 404
+
+
+
+@pytest.mark.usefixtures('postgres_db')
+@pytest.mark.usefixtures('restart_api')
+def test_bulk_allocate_reports_a_result_per_line():
+	orderid = random_orderid()
+	sku, unknown_sku = random_sku(), random_sku('unknown')
+	batch = random_batchref()
+	api_client.post_to_add_batch(batch, sku, 100, None)
+
+	r = api_client.post_to_allocate_bulk([
+		{'orderid': orderid, 'sku': sku, 'qty': 3},
+		{'orderid': orderid, 'sku': unknown_sku, 'qty': 3},
+	])
+	[allocated, invalid] = r.json()
+	assert allocated['batchref'] == batch
+	assert invalid['message'] == f'Invalid sku {unknown_sku}'
+
+	r = api_client.get_allocation(orderid)
+	assert r.json() == [{'sku': sku, 'batchref': batch}]
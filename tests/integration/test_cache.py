@@ -0,0 +1,45 @@
+from allocation.adapters import redis_eventpublisher
+from allocation.adapters.cache import RedisCache
+from ..conftest import wait_for_redis_to_come_up
+from ..random_refs import random_orderid
+
+
+def test_redis_cache_round_trips_and_invalidates():
+  wait_for_redis_to_come_up()
+  cache = RedisCache(redis_eventpublisher.get_client(), ttl=5)
+  orderid = random_orderid()
+  assert cache.get(orderid) is None
+
+  cache.set(orderid, [{'sku': 'sku1', 'batchref': 'b1'}])
+  assert cache.get(orderid) == [{'sku': 'sku1', 'batchref': 'b1'}]
+
+  cache.delete(orderid)
+  assert cache.get(orderid) is None
+  assert cache.stats()['hits'] == 1
+
+
+def test_redis_cache_keeps_no_value_read_before_a_delete():
+  wait_for_redis_to_come_up()
+  cache = RedisCache(redis_eventpublisher.get_client(), ttl=5)
+  orderid = random_orderid()
+  generation = cache.generation(orderid)
+  cache.delete(orderid)
+
+  assert not cache.set_if_unchanged(orderid, [], generation)
+  assert cache.get(orderid) is None
+  assert cache.set_if_unchanged(orderid, [], cache.generation(orderid))
+  assert cache.get(orderid) == []
+
+
+def test_redis_cache_clears_only_its_own_keys():
+  wait_for_redis_to_come_up()
+  client = redis_eventpublisher.get_client()
+  cache = RedisCache(client, ttl=5, prefix=f'{random_orderid()}:')
+  other = RedisCache(client, ttl=5, prefix=f'{random_orderid()}:')
+  cache.set('o1', [])
+  other.set('o1', [])
+
+  cache.clear()
+
+  assert cache.get('o1') is None
+  assert other.get('o1') == []
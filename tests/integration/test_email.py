@@ -34,3 +34,24 @@ def test_out_of_stock_email(bus):
   assert email['Raw']['From'] == 'allocations@example.com'
   assert email['Raw']['To'] == ['stock@made.com']
   assert f'Out of stock for {sku}' in email['Raw']['Data']
+
+
+
+@pytest.mark.usefixtures('mappers')
+def test_queued_out_of_stock_email_is_sent_once(sqlite_session_factory):
+  queued = notifications.QueuedEmailNotifications()
+  bus = bootstrap.bootstrap(
+    start_orm=False,
+    uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+    notifications=queued,
+    publish=lambda *args: None,
+  )
+  sku = random_sku()
+  bus.handle(commands.CreateBatch('batch1', sku, 9, None))
+  for i in range(3):
+    bus.handle(commands.Allocate(f'order{i}', sku, 10))
+  queued.flush()
+
+  host, port = map(config.get_email_host_and_port().get, ['host', 'http_port'])
+  all_emails = requests.get(f'http://{host}:{port}/api/v2/messages').json()
+  assert len([m for m in all_emails['items'] if sku in str(m)]) == 1
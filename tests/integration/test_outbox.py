@@ -0,0 +1,93 @@
+# pylint: disable=redefined-outer-name
+import json
+from typing import List, Tuple
+from unittest import mock
+import pytest
+from sqlalchemy.orm import clear_mappers
+from allocation import bootstrap
+from allocation.adapters import outbox
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+
+
+@pytest.fixture
+def published():
+  return []
+
+
+@pytest.fixture
+def outbox_bus(sqlite_session_factory, published):
+  bus = bootstrap.bootstrap(
+    start_orm=True,
+    uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+    notifications=mock.Mock(),
+    publish=lambda *args: published.append(args),
+    outbox=True,
+  )
+  yield bus
+  clear_mappers()
+
+
+def outbox_rows(session_factory):
+  return list(session_factory().execute(
+    'SELECT channel, payload FROM outbox ORDER BY id'
+  ))
+
+
+def test_allocated_events_are_written_to_the_outbox(
+    outbox_bus, sqlite_session_factory, published,
+):
+  outbox_bus.handle(commands.CreateBatch('b1', 'sku1', 100, None))
+  outbox_bus.handle(commands.Allocate('o1', 'sku1', 10))
+
+  [(channel, payload)] = outbox_rows(sqlite_session_factory)
+  assert channel == 'line_allocated'
+  assert json.loads(payload) == dict(
+    orderid='o1', sku='sku1', qty=10, batchref='b1',
+  )
+  assert published == []
+
+
+def test_bulk_allocation_writes_each_event_once(
+    outbox_bus, sqlite_session_factory,
+):
+  outbox_bus.handle(commands.CreateBatch('b1', 'sku1', 100, None))
+  outbox_bus.handle(commands.CreateBatch('b2', 'sku2', 100, None))
+  outbox_bus.handle(commands.AllocateMany([
+    commands.Allocate('o1', 'sku1', 10),
+    commands.Allocate('o1', 'sku2', 10),
+  ]))
+
+  payloads = [json.loads(p) for _, p in outbox_rows(sqlite_session_factory)]
+  assert sorted(p['sku'] for p in payloads) == ['sku1', 'sku2']
+
+
+def test_relay_publishes_and_removes_rows(outbox_bus, sqlite_session_factory):
+  outbox_bus.handle(commands.CreateBatch('b1', 'sku1', 100, None))
+  for i in range(5):
+    outbox_bus.handle(commands.Allocate(f'o{i}', 'sku1', 1))
+
+  batches = []  # type: List[List[Tuple[str, str]]]
+  relayed = outbox.relay_batch(sqlite_session_factory(), batches.append, 3)
+  assert relayed == 3
+  relayed = outbox.relay_batch(sqlite_session_factory(), batches.append, 3)
+  assert relayed == 2
+
+  assert [len(b) for b in batches] == [3, 2]
+  orderids = [json.loads(data)['orderid'] for b in batches for _, data in b]
+  assert orderids == [f'o{i}' for i in range(5)]
+  assert outbox_rows(sqlite_session_factory) == []
+
+
+def test_rows_stay_if_publishing_fails(outbox_bus, sqlite_session_factory):
+  outbox_bus.handle(commands.CreateBatch('b1', 'sku1', 100, None))
+  outbox_bus.handle(commands.Allocate('o1', 'sku1', 1))
+
+  def broken(messages):
+    raise ConnectionError('redis is down')
+
+  session = sqlite_session_factory()
+  with pytest.raises(ConnectionError):
+    outbox.relay_batch(session, broken, 10)
+  session.rollback()
+  assert len(outbox_rows(sqlite_session_factory)) == 1
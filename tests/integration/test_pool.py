@@ -0,0 +1,77 @@
+import threading
+import time
+from sqlalchemy import create_engine
+from allocation.adapters.pool import InstrumentedQueuePool
+from allocation.service_layer import unit_of_work
+
+
+def test_pool_counts_checkouts_and_time_spent_waiting(tmp_path):
+	engine = create_engine(
+		f'sqlite:///{tmp_path}/pool.db', poolclass=InstrumentedQueuePool,
+		pool_size=1, max_overflow=0,
+	)
+	connection = engine.connect()
+
+	def release_soon():
+		time.sleep(0.1)
+		connection.close()
+
+	threading.Thread(target=release_soon).start()
+	engine.connect().close()
+
+	stats = engine.pool.stats()
+	assert stats['checkouts'] == 2
+	assert stats['wait_seconds_max'] >= 0.05
+	assert stats['checked_out'] == 0
+
+
+def test_pool_reports_overflow_in_use(tmp_path):
+	engine = create_engine(
+		f'sqlite:///{tmp_path}/pool.db', poolclass=InstrumentedQueuePool,
+		pool_size=1, max_overflow=2,
+	)
+	connections = [engine.connect() for _ in range(3)]
+
+	assert engine.pool.stats()['overflow'] == 2
+	assert engine.pool.stats()['checked_out'] == 3
+	for connection in connections:
+		connection.close()
+
+
+def test_each_process_makes_its_own_engine(monkeypatch):
+	pid = [100]
+	monkeypatch.setattr(unit_of_work.os, 'getpid', lambda: pid[0])
+	monkeypatch.setattr(unit_of_work, 'make_engine', lambda: object())
+	monkeypatch.setattr(unit_of_work, '_session_factories', {})
+	monkeypatch.setattr(unit_of_work, '_inherited', [])
+
+	parent = unit_of_work.default_session_factory()
+	assert unit_of_work.default_session_factory() is parent
+	pid[0] = 101  # as in a forked child
+	child = unit_of_work.default_session_factory()
+
+	assert child is not parent
+	assert child.kw['bind'] is not parent.kw['bind']
+	# never garbage collected, which would close the parent's connections
+	assert unit_of_work._inherited == [parent]
+
+
+def test_connections_opened_by_another_process_are_replaced_not_closed(
+		tmp_path, monkeypatch,
+):
+	monkeypatch.setattr(unit_of_work, '_inherited', [])
+	engine = create_engine(
+		f'sqlite:///{tmp_path}/pool.db', poolclass=InstrumentedQueuePool,
+		pool_size=1, max_overflow=0,
+	)
+	unit_of_work.detach_connections_of_other_processes(engine)
+	with engine.connect() as connection:
+		parents = connection.connection.connection
+	monkeypatch.setattr(unit_of_work.os, 'getpid', lambda: -1)
+
+	with engine.connect() as connection:
+		assert connection.connection.connection is not parents
+		connection.execute('SELECT 1')
+
+	assert unit_of_work._inherited == [parents]
+	parents.execute('SELECT 1')  # still open
@@ -0,0 +1,50 @@
+import json
+from dataclasses import asdict
+from allocation.adapters import redis_eventpublisher
+from allocation.domain import events
+from ..conftest import wait_for_redis_to_come_up
+from ..random_refs import random_orderid, random_suffix
+
+
+def allocated(orderid):
+  return events.Allocated(orderid=orderid, sku='sku1', qty=1, batchref='b1')
+
+
+def test_serializer_matches_asdict():
+  event = allocated('o1')
+  assert json.loads(redis_eventpublisher.serialize(event)) == asdict(event)
+
+
+def test_buffered_events_are_published_on_flush():
+  wait_for_redis_to_come_up()
+  channel = f'test-channel-{random_suffix()}'
+  pubsub = redis_eventpublisher.get_client().pubsub(ignore_subscribe_messages=True)
+  pubsub.subscribe(channel)
+  pubsub.get_message(timeout=1)
+  publisher = redis_eventpublisher.BufferedPublisher()
+  orderids = [random_orderid(i) for i in range(5)]
+
+  for orderid in orderids:
+    publisher(channel, allocated(orderid))
+  assert pubsub.get_message(timeout=0.2) is None
+
+  publisher.flush()
+  received = [pubsub.get_message(timeout=1) for _ in orderids]
+  assert [json.loads(m['data'])['orderid'] for m in received] == orderids
+  assert publisher.metrics['flushes'] == 1
+  assert publisher.metrics['max_batch_size'] == 5
+
+
+def test_buffered_events_can_go_to_a_stream():
+  wait_for_redis_to_come_up()
+  stream = f'test-stream-{random_suffix()}'
+  publisher = redis_eventpublisher.BufferedPublisher('streams', max_buffer=2)
+
+  for i in range(3):
+    publisher(stream, allocated(random_orderid(i)))
+  # max_buffer reached once already
+  assert redis_eventpublisher.get_client().xlen(stream) == 2
+  publisher.flush()
+  assert redis_eventpublisher.get_client().xlen(stream) == 3
+  assert publisher.metrics['mean_batch_size'] == 1.5
+  redis_eventpublisher.get_client().delete(stream)
@@ -0,0 +1,76 @@
+# pylint: disable=redefined-outer-name
+import json
+import pytest
+from allocation.domain import commands
+from allocation.entrypoints import redis_eventconsumer
+from ..conftest import wait_for_redis_to_come_up
+from ..random_refs import random_batchref, random_suffix
+
+
+class FakeBus:
+
+  def __init__(self, fail=False):
+    self.fail = fail
+    self.handled = []
+
+  def handle(self, cmd):
+    if self.fail:
+      raise Exception('handler blew up')
+    self.handled.append(cmd)
+
+
+@pytest.fixture
+def stream():
+  wait_for_redis_to_come_up()
+  stream, group = f'test-stream-{random_suffix()}', 'test-group'
+  redis_eventconsumer.ensure_group(stream, group)
+  yield stream, group
+  redis_eventconsumer.get_client().delete(stream)
+
+
+def add_change(stream, batchref, qty):
+  redis_eventconsumer.get_client().xadd(stream, {
+    'data': json.dumps({'batchref': batchref, 'qty': qty}),
+  })
+
+
+def test_handled_entries_are_acknowledged(stream):
+  stream, group = stream
+  batchref = random_batchref()
+  add_change(stream, batchref, 5)
+  bus = FakeBus()
+
+  redis_eventconsumer.consume_stream(bus, stream, group, 'consumer1', block=100)
+
+  assert bus.handled == [commands.ChangeBatchQuantity(ref=batchref, qty=5)]
+  assert redis_eventconsumer.get_client().xpending(stream, group)['pending'] == 0
+
+
+def test_failed_entries_are_reclaimed_by_another_consumer(stream, monkeypatch):
+  stream, group = stream
+  monkeypatch.setenv('STREAM_RECLAIM_IDLE_MS', '0')
+  batchref = random_batchref()
+  add_change(stream, batchref, 5)
+
+  redis_eventconsumer.consume_stream(
+    FakeBus(fail=True), stream, group, 'consumer1', block=100,
+  )
+  assert redis_eventconsumer.get_client().xpending(stream, group)['pending'] == 1
+
+  bus = FakeBus()
+  redis_eventconsumer.consume_stream(bus, stream, group, 'consumer2', block=100)
+  assert bus.handled == [commands.ChangeBatchQuantity(ref=batchref, qty=5)]
+  assert redis_eventconsumer.get_client().xpending(stream, group)['pending'] == 0
+
+
+def test_poison_entries_are_dropped_after_max_deliveries(stream, monkeypatch):
+  stream, group = stream
+  monkeypatch.setenv('STREAM_RECLAIM_IDLE_MS', '0')
+  monkeypatch.setenv('STREAM_MAX_DELIVERIES', '2')
+  add_change(stream, random_batchref(), 5)
+  bus = FakeBus(fail=True)
+
+  for _ in range(3):
+    redis_eventconsumer.consume_stream(bus, stream, group, 'consumer1', block=100)
+
+  assert redis_eventconsumer.get_client().xpending(stream, group)['pending'] == 0
@@ -1,4 +1,5 @@
 import pytest
+from sqlalchemy.exc import IntegrityError
 from allocation.adapters import repository
 from allocation.domain import model
 
@@ -16,4 +17,86 @@ def test_get_by_batchref(sqlite_session_factory):
   repo.add(p1)
   repo.add(p2)
   assert repo.get_by_batchref('b2') == p1
-  assert repo.get_by_batchref('b3') == p2
\ No newline at end of file
+  assert repo.get_by_batchref('b3') == p2
+
+
+def test_loaded_batch_recounts_allocated_quantity(sqlite_session_factory):
+  session = sqlite_session_factory()
+  batch = model.Batch(ref='b1', sku='sku1', qty=100, eta=None)
+  product = model.Product(sku='sku1', batches=[batch])
+  product.allocate(model.OrderLine('o1', 'sku1', 10))
+  product.allocate(model.OrderLine('o2', 'sku1', 15))
+  session.add(product)
+  session.commit()
+
+  session = sqlite_session_factory()
+  [loaded] = repository.SqlAlchemyRepository(session).get('sku1').batches
+  assert loaded.available_quantity == 75
+  loaded.deallocate_one()
+  assert loaded.allocated_quantity in (10, 15)
+
+
+def add_product_with_allocated_batches(session_factory, sku, batch_count):
+  session = session_factory()
+  batches = [
+    model.Batch(ref=f'{sku}-b{i}', sku=sku, qty=100, eta=None)
+    for i in range(batch_count)
+  ]
+  for i, batch in enumerate(batches):
+    batch.allocate(model.OrderLine(f'o{i}', sku, 10))
+  session.add(model.Product(sku=sku, batches=batches))
+  session.commit()
+
+
+@pytest.mark.parametrize('loading', ['selectin', 'joined'])
+@pytest.mark.parametrize('batch_count', [1, 5, 20])
+def test_get_loads_whole_aggregate_in_fixed_queries(
+    sqlite_session_factory, query_log, loading, batch_count,
+):
+  add_product_with_allocated_batches(sqlite_session_factory, 'sku1', batch_count)
+  repo = repository.SqlAlchemyRepository(sqlite_session_factory(), loading)
+  query_log.clear()
+
+  product = repo.get('sku1')
+  product.allocate(model.OrderLine('new-order', 'sku1', 10))
+
+  expected = {'selectin': 3, 'joined': 1}[loading]
+  assert len(query_log) == expected
+
+
+@pytest.mark.parametrize('loading', ['selectin', 'joined'])
+def test_get_by_batchref_loads_whole_aggregate_in_fixed_queries(
+    sqlite_session_factory, query_log, loading,
+):
+  add_product_with_allocated_batches(sqlite_session_factory, 'sku1', 10)
+  repo = repository.SqlAlchemyRepository(sqlite_session_factory(), loading)
+  query_log.clear()
+
+  product = repo.get_by_batchref('sku1-b3')
+  product.change_batch_quantity('sku1-b3', 5)
+
+  expected = {'selectin': 3, 'joined': 1}[loading]
+  assert len(query_log) == expected
+
+
+def test_lazy_loading_issues_a_query_per_batch(sqlite_session_factory, query_log):
+  add_product_with_allocated_batches(sqlite_session_factory, 'sku1', 5)
+  repo = repository.SqlAlchemyRepository(sqlite_session_factory(), 'lazy')
+  query_log.clear()
+
+  product = repo.get('sku1')
+  product.allocate(model.OrderLine('new-order', 'sku1', 10))
+
+  assert len(query_log) == 2 + 5
+
+
+def test_batch_references_are_unique(sqlite_session_factory):
+  session = sqlite_session_factory()
+  session.add(model.Product(sku='sku1', batches=[
+    model.Batch(ref='b1', sku='sku1', qty=100, eta=None),
+  ]))
+  session.add(model.Product(sku='sku2', batches=[
+    model.Batch(ref='b1', sku='sku2', qty=100, eta=None),
+  ]))
+  with pytest.raises(IntegrityError):
+    session.commit()
@@ -5,7 +5,10 @@ import traceback
 from typing import List
 from unittest.mock import Mock
 import pytest
-from allocation.domain import model
+from sqlalchemy.orm import sessionmaker
+from allocation import bootstrap
+from allocation.adapters.cache import AggregateCache
+from allocation.domain import commands, model
 from allocation.service_layer import unit_of_work
 from ..random_refs import random_sku, random_batchref, random_orderid
 
@@ -49,8 +52,8 @@ def test_uow_can_retrieve_a_batch_and_allocate_to_it(sqlite_session_factory):
 		product.allocate(line)
 		uow.commit()
 
-  batchref = get_allocated_batch_ref(session, 'o1', 'HIPSTER-WORKBENCH')
-  assert batchref == 'batch1'
+	batchref = get_allocated_batch_ref(session, 'o1', 'HIPSTER-WORKBENCH')
+	assert batchref == 'batch1'
 
 
 def test_rolls_back_uncommitted_work_by_default(sqlite_session_factory):
@@ -78,6 +81,110 @@ def test_rolls_back_on_error(sqlite_session_factory):
 	assert rows == []
 
 
+def test_stale_version_raises_concurrency_error(sqlite_session_factory):
+	session = sqlite_session_factory()
+	insert_batch(session, 'batch1', 'STEADY-TABLE', 100, None, product_version=1)
+	session.commit()
+
+	uow1 = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+	uow2 = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+	with pytest.raises(unit_of_work.ConcurrencyError):
+		with uow1:
+			product1 = uow1.products.get(sku='STEADY-TABLE')
+			product1.allocate(model.OrderLine('o1', 'STEADY-TABLE', 10))
+			with uow2:
+				product2 = uow2.products.get(sku='STEADY-TABLE')
+				product2.allocate(model.OrderLine('o2', 'STEADY-TABLE', 10))
+				uow2.commit()
+			uow1.commit()
+
+	[[version]] = session.execute(
+		"SELECT version_number FROM products WHERE sku='STEADY-TABLE'"
+	)
+	assert version == 2
+	assert product1.events == []
+
+
+
+def allocate_and_collect(uow, orderid, sku, qty=10):
+	with uow:
+		product = uow.products.get(sku=sku)
+		product.allocate(model.OrderLine(orderid, sku, qty))
+		uow.commit()
+	return list(uow.collect_new_events())
+
+
+def test_caching_uow_reuses_a_resident_product_after_a_version_check(
+		sqlite_session_factory, query_log,
+):
+	session = sqlite_session_factory()
+	insert_batch(session, 'batch1', 'HOT-SKU', 100, None)
+	session.commit()
+	aggregates = AggregateCache()
+	uow = unit_of_work.CachingSqlAlchemyUnitOfWork(aggregates, sqlite_session_factory)
+	allocate_and_collect(uow, 'o1', 'HOT-SKU')
+
+	query_log.clear()
+	with uow:
+		product = uow.products.get(sku='HOT-SKU')
+		assert len(query_log) == 1
+		product.allocate(model.OrderLine('o2', 'HOT-SKU', 10))
+		uow.commit()
+
+	assert get_allocated_batch_ref(session, 'o2', 'HOT-SKU') == 'batch1'
+	assert aggregates.stats()['hits'] == 1
+
+
+def test_caching_uow_reloads_a_product_changed_elsewhere(sqlite_session_factory):
+	session = sqlite_session_factory()
+	insert_batch(session, 'batch1', 'HOT-SKU', 20, None)
+	session.commit()
+	aggregates = AggregateCache()
+	uow = unit_of_work.CachingSqlAlchemyUnitOfWork(aggregates, sqlite_session_factory)
+	allocate_and_collect(uow, 'o1', 'HOT-SKU')
+	other_uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+	allocate_and_collect(other_uow, 'o2', 'HOT-SKU')
+
+	with uow:
+		product = uow.products.get(sku='HOT-SKU')
+		assert product.batches[0].available_quantity == 0
+	assert aggregates.conflicts == 1
+
+
+def test_caching_uow_only_keeps_products_once_their_events_are_collected(
+		sqlite_session_factory,
+):
+	session = sqlite_session_factory()
+	insert_batch(session, 'batch1', 'HOT-SKU', 100, None)
+	session.commit()
+	aggregates = AggregateCache()
+	uow = unit_of_work.CachingSqlAlchemyUnitOfWork(aggregates, sqlite_session_factory)
+	with uow:
+		uow.products.get(sku='HOT-SKU').allocate(model.OrderLine('o1', 'HOT-SKU', 10))
+		uow.commit()
+	assert aggregates.stats()['size'] == 0
+
+	[event] = uow.collect_new_events()
+	assert event.orderid == 'o1'
+	assert aggregates.stats()['size'] == 1
+
+
+def test_caching_uow_drops_products_with_uncommitted_changes(sqlite_session_factory):
+	session = sqlite_session_factory()
+	insert_batch(session, 'batch1', 'HOT-SKU', 100, None)
+	session.commit()
+	aggregates = AggregateCache()
+	uow = unit_of_work.CachingSqlAlchemyUnitOfWork(aggregates, sqlite_session_factory)
+	allocate_and_collect(uow, 'o1', 'HOT-SKU')
+
+	with uow:
+		uow.products.get(sku='HOT-SKU').allocate(model.OrderLine('o2', 'HOT-SKU', 10))
+	list(uow.collect_new_events())
+
+	with uow:
+		product = uow.products.get(sku='HOT-SKU')
+		assert product.batches[0].available_quantity == 90
+
 def try_to_allocate(orderid, sku, exceptions, session_factory):
 	line = model.OrderLine(orderid, sku, 10)
 	try:
@@ -130,3 +237,48 @@ def test_concurrent_updates_to_version_are_not_allowed(postgres_session_factory)
 	assert len(orders) == 1
 	with unit_of_work.SqlAlchemyUnitOfWork(postgres_session_factory) as uow:
 		uow.session.execute('select 1')
+
+
+def test_read_committed_updates_are_version_checked(postgres_db):
+	engine = postgres_db.execution_options(isolation_level='READ COMMITTED')
+	session_factory = sessionmaker(bind=engine)
+	sku, batch = random_sku(), random_batchref()
+	session = session_factory()
+	insert_batch(session, batch, sku, 100, eta=None, product_version=1)
+	session.commit()
+
+	exceptions = []  # type: List[Exception]
+	threads = [
+		threading.Thread(target=try_to_allocate, args=(
+			random_orderid(i), sku, exceptions, session_factory,
+		))
+		for i in range(2)
+	]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	[[version]] = session.execute(
+		"SELECT version_number FROM products WHERE sku=:sku",
+		dict(sku=sku),
+	)
+	assert version == 2
+	[exception] = exceptions
+	assert isinstance(exception, unit_of_work.ConcurrencyError)
+
+
+def test_bootstrap_can_keep_products_in_sqlite(monkeypatch):
+	monkeypatch.setenv('STORE', 'sqlite')
+	uow = bootstrap.make_unit_of_work()
+	bus = bootstrap.bootstrap(
+		start_orm=False, uow=uow, notifications=Mock(), publish=lambda *args: None,
+		outbox=False, engine_workers=0,
+	)
+	bus.handle(commands.CreateBatch('b1', 'SQLITE-LAMP', 10, None))
+	bus.handle(commands.Allocate('o1', 'SQLITE-LAMP', 2))
+
+	# SQLITE_PATH's default: one in-memory database per process
+	session = unit_of_work.sqlite_session_factory(':memory:')()
+	assert get_allocated_batch_ref(session, 'o1', 'SQLITE-LAMP') == 'b1'
+	assert list(session.execute('SELECT batchref FROM allocations_view')) == [('b1',)]
@@ -1,9 +1,12 @@
 # pylint: disable=redefined-outer-name
 from datetime import date
+from typing import Any, List
+from sqlalchemy import event
 from sqlalchemy.orm import clear_mappers
 from unittest import mock
 import pytest
 from allocation import bootstrap, views
+from allocation.adapters import cache as view_cache
 from allocation.domain import commands
 from allocation.service_layer import unit_of_work
 
@@ -11,12 +14,18 @@ today = date.today()
 
 
 @pytest.fixture
-def sqlite_bus(sqlite_session_factory):
+def cache():
+  return view_cache.LRUCache()
+
+
+@pytest.fixture
+def sqlite_bus(sqlite_session_factory, cache):
   bus = bootstrap.bootstrap(
     start_orm=True,
     uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
     notifications=mock.Mock(),
     publish=lambda *args: None,
+    cache=cache,
   )
   yield bus
   clear_mappers()
@@ -46,3 +55,172 @@ def test_deallocation(sqlite_bus):
   assert views.allocations('o1', sqlite_bus.uow) == [
     {'sku': 'sku1', 'batchref': 'b2'},
   ]
+
+
+def test_bulk_allocation_populates_view_for_every_product(sqlite_bus):
+  sqlite_bus.handle(commands.CreateBatch('sku1batch', 'sku1', 50, None))
+  sqlite_bus.handle(commands.CreateBatch('sku2batch', 'sku2', 50, None))
+  sqlite_bus.handle(commands.AllocateMany([
+    commands.Allocate('order1', 'sku1', 20),
+    commands.Allocate('order1', 'sku2', 20),
+  ]))
+
+  results = views.allocations('order1', sqlite_bus.uow)
+  assert sorted(results, key=lambda r: r['sku']) == [
+    {'sku': 'sku1', 'batchref': 'sku1batch'},
+    {'sku': 'sku2', 'batchref': 'sku2batch'},
+  ]
+
+
+def test_shrinking_a_batch_costs_a_fixed_number_of_transactions(
+    sqlite_bus, in_memory_sqlite_db,
+):
+  sqlite_bus.handle(commands.CreateBatch('b1', 'sku1', 100, None))
+  sqlite_bus.handle(commands.CreateBatch('b2', 'sku1', 100, today))
+  sqlite_bus.handle(commands.AllocateMany([
+    commands.Allocate(f'o{i}', 'sku1', 1) for i in range(50)
+  ]))
+  commits = []  # type: List[Any]
+  event.listen(in_memory_sqlite_db, 'commit', commits.append)
+
+  sqlite_bus.handle(commands.ChangeBatchQuantity('b1', 10))
+
+  # the change itself, then one for each batch of read-model updates
+  assert len(commits) == 3
+  moved = [
+    r for i in range(50) for r in views.allocations(f'o{i}', sqlite_bus.uow)
+    if r['batchref'] == 'b2'
+  ]
+  assert len(moved) == 40
+
+
+def test_cached_view_is_served_without_a_query(sqlite_bus, cache, query_log):
+  sqlite_bus.handle(commands.CreateBatch('b1', 'sku1', 50, None))
+  sqlite_bus.handle(commands.Allocate('o1', 'sku1', 20))
+
+  first = views.allocations('o1', sqlite_bus.uow, cache)
+  query_log.clear()
+  second = views.allocations('o1', sqlite_bus.uow, cache)
+
+  assert first == second == [{'sku': 'sku1', 'batchref': 'b1'}]
+  assert query_log == []
+  assert cache.stats()['hits'] == 1
+
+
+def test_cached_view_is_refreshed_by_events(sqlite_bus, cache):
+  sqlite_bus.handle(commands.CreateBatch('b1', 'sku1', 50, None))
+  sqlite_bus.handle(commands.CreateBatch('b2', 'sku1', 50, today))
+  assert views.allocations('o1', sqlite_bus.uow, cache) == []
+
+  sqlite_bus.handle(commands.Allocate('o1', 'sku1', 40))
+  assert views.allocations('o1', sqlite_bus.uow, cache) == [
+    {'sku': 'sku1', 'batchref': 'b1'},
+  ]
+
+  sqlite_bus.handle(commands.ChangeBatchQuantity('b1', 10))
+  assert views.allocations('o1', sqlite_bus.uow, cache) == [
+    {'sku': 'sku1', 'batchref': 'b2'},
+  ]
+
+
+def test_rebuild_repopulates_view_from_allocations(sqlite_bus):
+  sqlite_bus.handle(commands.CreateBatch('b1', 'sku1', 50, None))
+  sqlite_bus.handle(commands.CreateBatch('b2', 'sku2', 50, None))
+  sqlite_bus.handle(commands.AllocateMany([
+    commands.Allocate(f'o{i}', sku, 1) for i in range(5) for sku in ['sku1', 'sku2']
+  ]))
+  before = {
+    f'o{i}': views.allocations(f'o{i}', sqlite_bus.uow) for i in range(5)
+  }
+  with sqlite_bus.uow:
+    sqlite_bus.uow.session.execute('DELETE FROM allocations_view')
+    sqlite_bus.uow.commit()
+
+  rebuilt = views.rebuild_allocations(sqlite_bus.uow, chunk_size=3)
+
+  assert rebuilt == 10
+  after = {
+    f'o{i}': views.allocations(f'o{i}', sqlite_bus.uow) for i in range(5)
+  }
+  by_sku = lambda rows: sorted(rows, key=lambda r: r['sku'])
+  assert {k: by_sku(v) for k, v in after.items()} == {
+    k: by_sku(v) for k, v in before.items()
+  }
+
+
+def test_view_is_readable_while_it_is_rebuilt(
+    sqlite_bus, in_memory_sqlite_db, cache,
+):
+  sqlite_bus.handle(commands.CreateBatch('b1', 'sku1', 50, None))
+  sqlite_bus.handle(commands.AllocateMany([
+    commands.Allocate(f'o{i}', 'sku1', 1) for i in range(5)
+  ]))
+  with sqlite_bus.uow:
+    sqlite_bus.uow.session.execute(
+        "INSERT INTO allocations_view (orderid, sku, batchref)"
+        " VALUES ('stale', 'sku1', 'b1')"
+    )
+    sqlite_bus.uow.commit()
+  assert views.allocations('stale', sqlite_bus.uow, cache) != []
+  served = []
+
+  def read_view(conn, cursor, statement, *args):
+    if statement.startswith('INSERT INTO allocations_view_rebuild'):
+      [[count]] = conn.execute('SELECT COUNT(*) FROM allocations_view')
+      served.append(count)
+
+  event.listen(in_memory_sqlite_db, 'before_cursor_execute', read_view)
+  try:
+    rebuilt = views.rebuild_allocations(sqlite_bus.uow, chunk_size=2, cache=cache)
+  finally:
+    event.remove(in_memory_sqlite_db, 'before_cursor_execute', read_view)
+
+  assert rebuilt == 5
+  assert served == [6, 6, 6]
+  assert views.allocations('stale', sqlite_bus.uow, cache) == []
+  assert views.allocations('o1', sqlite_bus.uow, cache) == [
+    {'sku': 'sku1', 'batchref': 'b1'},
+  ]
+  # and again, over the staging table's names left free by the swap
+  assert views.rebuild_allocations(sqlite_bus.uow) == 5
+
+
+def test_orders_without_allocations_are_not_cached(sqlite_bus, cache):
+  sqlite_bus.handle(commands.CreateBatch('b1', 'sku1', 50, None))
+  assert views.allocations('o1', sqlite_bus.uow, cache) == []
+  assert cache.get('o1') is None
+
+
+class RacingCache(view_cache.LRUCache):
+  """The order changes, and is invalidated, while its rows are read."""
+
+  def generation(self, key):
+    generation = super().generation(key)
+    self.delete(key)
+    return generation
+
+
+def test_rows_read_while_the_order_changed_are_not_cached(sqlite_bus):
+  sqlite_bus.handle(commands.CreateBatch('b1', 'sku1', 50, None))
+  sqlite_bus.handle(commands.Allocate('o1', 'sku1', 20))
+  cache = RacingCache()
+
+  assert views.allocations('o1', sqlite_bus.uow, cache) == [
+    {'sku': 'sku1', 'batchref': 'b1'},
+  ]
+  assert cache.get('o1') is None
+
+
+def test_a_memory_cache_needs_a_single_process(monkeypatch):
+  monkeypatch.setenv('VIEW_CACHE', 'memory')
+  monkeypatch.setenv('WEB_WORKERS', '2')
+  with pytest.raises(ValueError, match='VIEW_CACHE=redis'):
+    bootstrap.make_view_cache()
+
+  monkeypatch.setenv('WEB_WORKERS', '1')
+  assert isinstance(bootstrap.make_view_cache(), view_cache.LRUCache)
+
+
+def test_stores_without_a_read_model_have_no_allocations_view():
+  with pytest.raises(TypeError, match='keeps no allocations view'):
+    views.allocations('o1', unit_of_work.InMemoryUnitOfWork(products={}))
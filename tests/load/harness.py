@@ -0,0 +1,353 @@
+"""
+Load generator for the allocation API: creates batches for a catalogue of
+skus, then places orders whose skus follow a Zipf distribution, each
+allocated and then read back, from a pool of client threads.
+
+Run it against a server (by default the one config.get_api_url() points
+at, e.g. `make load`), or in process against a Flask test client backed by
+an in-memory SQLite database:
+
+  python -m tests.load.harness --local
+  python -m tests.load.harness --url http://localhost:5005 --concurrency 16
+
+With --baseline it repeats the stored run's workload and concurrency and
+exits non-zero when throughput or p99 latency regressed beyond the stored
+tolerance (or --tolerance, when given), or any request failed;
+--update-baseline stores the run, keeping the stored tolerance unless
+--tolerance is given. Each
+run also times a fixed piece of domain work, and the baseline's figures
+are scaled by how much slower or faster that was this time, so a baseline
+taken on one machine holds on a slower or busier one.
+"""
+import abc
+import argparse
+import dataclasses
+import itertools
+import math
+import json
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import requests
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from allocation import bootstrap, config
+from allocation.adapters import orm
+from allocation.adapters.cache import LRUCache
+from allocation.adapters.notifications import AbstractNotifications
+from allocation.domain import model
+from allocation.entrypoints.flask_app import create_app
+from allocation.service_layer import unit_of_work
+
+BASELINE = Path(__file__).parent / 'baseline.json'
+# for a new baseline: a local run's p99s, even scaled by the calibration,
+# vary between a third and one and a half times the baseline's
+DEFAULT_TOLERANCE = 1.0
+
+
+@dataclasses.dataclass
+class Workload:
+  skus: int = 200
+  batches_per_sku: int = 3
+  batch_qty: int = 1_000
+  order_count: int = 2_000
+  zipf_s: float = 1.1  # the larger, the more orders go to the top skus
+  seed: int = 42
+  # keeps the refs of runs against the same server apart
+  prefix: str = 'load'
+
+  def sku(self, rank: int) -> str:
+    return f'{self.prefix.upper()}-SKU-{rank:05d}'
+
+  def batches(self) -> List[dict]:
+    today = time.strftime('%Y-%m-%d')
+    return [
+      dict(
+        ref=f'{self.prefix}-batch-{rank}-{i}', sku=self.sku(rank),
+        qty=self.batch_qty,
+        # one batch in stock, the rest on their way
+        eta=None if i == 0 else today,
+      )
+      for rank in range(self.skus)
+      for i in range(self.batches_per_sku)
+    ]
+
+  def orders(self) -> List[dict]:
+    rng = random.Random(self.seed)
+    ranks = rng.choices(
+      range(self.skus), cum_weights=zipf_cum_weights(self.skus, self.zipf_s),
+      k=self.order_count,
+    )
+    return [
+      dict(
+        orderid=f'{self.prefix}-order-{i}', sku=self.sku(rank),
+        qty=rng.randint(1, 10),
+      )
+      for i, rank in enumerate(ranks)
+    ]
+
+
+def zipf_cum_weights(n: int, s: float) -> List[float]:
+  return list(itertools.accumulate(1 / rank ** s for rank in range(1, n + 1)))
+
+
+class Backend(abc.ABC):
+
+  @abc.abstractmethod
+  def request(self, method: str, path: str, json=None) -> int:
+    raise NotImplementedError
+
+
+class HttpBackend(Backend):
+  """A running server, e.g. gunicorn in front of Postgres and Redis."""
+
+  def __init__(self, url: str):
+    self.url = url.rstrip('/')
+    self.sessions = threading.local()
+
+  def request(self, method: str, path: str, json=None) -> int:
+    session = getattr(self.sessions, 'session', None)
+    if session is None:
+      session = self.sessions.session = requests.Session()
+    return session.request(method, self.url + path, json=json).status_code
+
+
+class LocalBackend(Backend):
+  """
+  The Flask app in this process, its bus backed by an in-memory SQLite
+  database. SQLite has the one connection, so requests are served one at a
+  time: this measures the cost of a request through the app, not how it
+  scales. Needs the mappers started.
+  """
+
+  def __init__(self):
+    engine = create_engine(
+      'sqlite://', poolclass=StaticPool,
+      connect_args={'check_same_thread': False},
+    )
+    orm.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    cache = LRUCache()
+
+    def make_bus():
+      return bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+        notifications=NullNotifications(),
+        publish=lambda *args: None,
+        outbox=False,
+        cache=cache,
+        engine_workers=0,
+      )
+
+    self.client = create_app(make_bus=make_bus, cache=cache).test_client()
+    self.lock = threading.Lock()
+
+  def request(self, method: str, path: str, json=None) -> int:
+    with self.lock:
+      return self.client.open(path, method=method, json=json).status_code
+
+
+class NullNotifications(AbstractNotifications):
+
+  def send(self, destination, message):
+    pass
+
+
+class Recorder:
+
+  def __init__(self):
+    self.latencies = defaultdict(list)  # type: Dict[str, List[float]]
+    self.errors = defaultdict(int)  # type: Dict[str, int]
+    self.lock = threading.Lock()
+
+  def call(self, backend, method: str, endpoint: str, path: str, json=None,
+           expected=(200, 201, 202)):
+    start = time.perf_counter()
+    status = backend.request(method, path, json=json)
+    elapsed = time.perf_counter() - start
+    with self.lock:
+      self.latencies[endpoint].append(elapsed)
+      if status not in expected:
+        self.errors[endpoint] += 1
+
+
+def calibrate(rounds: int = 5) -> float:
+  """Seconds allocating a fixed set of order lines takes, best of rounds."""
+  best = math.inf
+  for _ in range(rounds):
+    product = model.Product('CALIBRATE', [
+      model.Batch(f'calibrate-{i}', 'CALIBRATE', 1_000, eta=None)
+      for i in range(3)
+    ])
+    lines = [model.OrderLine(f'order-{i}', 'CALIBRATE', 1) for i in range(2_000)]
+    start = time.perf_counter()
+    for line in lines:
+      product.allocate(line)
+    best = min(best, time.perf_counter() - start)
+  return best
+
+
+def run(backend, workload: Workload, concurrency: int = 8) -> dict:
+  calibration = calibrate()
+  recorder = Recorder()
+
+  def add_batch(batch):
+    recorder.call(backend, 'POST', 'POST /add_batch', '/add_batch', json=batch)
+
+  def place_order(order):
+    recorder.call(backend, 'POST', 'POST /allocate', '/allocate', json=order)
+    recorder.call(
+      backend, 'GET', 'GET /allocations', f"/allocations/{order['orderid']}",
+      # out of stock orders have no allocations to show
+      expected=(200, 404),
+    )
+
+  start = time.perf_counter()
+  with ThreadPoolExecutor(concurrency) as pool:
+    list(pool.map(add_batch, workload.batches()))
+    list(pool.map(place_order, workload.orders()))
+  elapsed = time.perf_counter() - start
+  return report(recorder, elapsed, calibration)
+
+
+def report(recorder: Recorder, elapsed: float, calibration: float) -> dict:
+  requests_made = sum(len(l) for l in recorder.latencies.values())
+  return dict(
+    calibration_ms=round(calibration * 1000, 3),
+    throughput_rps=round(requests_made / elapsed, 1),
+    endpoints={
+      endpoint: dict(
+        requests=len(latencies),
+        errors=recorder.errors[endpoint],
+        p50_ms=round(percentile(latencies, 50) * 1000, 3),
+        p99_ms=round(percentile(latencies, 99) * 1000, 3),
+      )
+      for endpoint, latencies in sorted(recorder.latencies.items())
+    },
+  )
+
+
+def percentile(values: List[float], p: float) -> float:
+  ordered = sorted(values)
+  # nearest rank
+  return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+def regressions(
+  result: dict, baseline: dict, tolerance: Optional[float] = None,
+) -> List[str]:
+  # a tolerance of 1 allows half the throughput, or twice the latency,
+  # of the baseline's as if it ran on this machine as it is now
+  if tolerance is None:
+    tolerance = baseline['tolerance']
+  slowdown = result['calibration_ms'] / baseline['calibration_ms']
+  found = []
+  if result['throughput_rps'] < (
+      baseline['throughput_rps'] / slowdown / (1 + tolerance)):
+    found.append(
+      f"throughput {result['throughput_rps']} rps,"
+      f" baseline {baseline['throughput_rps'] / slowdown:.1f} rps"
+    )
+  for endpoint, figures in result['endpoints'].items():
+    if figures['errors']:
+      found.append(f"{endpoint}: {figures['errors']} failed requests")
+    expected = baseline['endpoints'].get(endpoint)
+    if expected and (
+        figures['p99_ms'] > expected['p99_ms'] * slowdown * (1 + tolerance)):
+      found.append(
+        f"{endpoint}: p99 {figures['p99_ms']} ms,"
+        f" baseline {expected['p99_ms'] * slowdown:.3f} ms"
+      )
+  return found
+
+
+def load_baseline(path: Path, backend: str) -> dict:
+  return json.loads(path.read_text())[backend]
+
+
+def save_baseline(
+  path: Path, backend: str, result: dict,
+  workload: Workload, concurrency: int, tolerance: float,
+):
+  baselines = json.loads(path.read_text()) if path.exists() else {}
+  baselines[backend] = dict(
+    result, tolerance=tolerance, concurrency=concurrency,
+    workload={
+      k: v for k, v in dataclasses.asdict(workload).items() if k != 'prefix'
+    },
+  )
+  path.write_text(json.dumps(baselines, indent=2, sort_keys=True) + '\n')
+
+
+def main(argv=None) -> int:
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  target = parser.add_mutually_exclusive_group()
+  target.add_argument('--url', default=None, help='defaults to the configured API url')
+  target.add_argument('--local', action='store_true', help='in process, on SQLite')
+  parser.add_argument('--concurrency', type=int, default=8)
+  parser.add_argument('--skus', type=int, default=Workload.skus)
+  parser.add_argument('--orders', type=int, default=Workload.order_count)
+  parser.add_argument('--zipf-s', type=float, default=Workload.zipf_s)
+  parser.add_argument('--seed', type=int, default=Workload.seed)
+  parser.add_argument('--baseline', type=Path, nargs='?', const=BASELINE)
+  parser.add_argument('--update-baseline', action='store_true')
+  parser.add_argument(
+    '--tolerance', type=float, default=None,
+    help="defaults to the baseline's",
+  )
+  args = parser.parse_args(argv)
+
+  backend: Backend
+  if args.local:
+    orm.start_mappers()
+    backend, name = LocalBackend(), 'local'
+  else:
+    backend, name = HttpBackend(args.url or config.get_api_url()), 'http'
+  path = args.baseline or BASELINE
+  try:
+    stored = load_baseline(path, name)  # type: Optional[dict]
+  except (FileNotFoundError, KeyError):
+    stored = None
+  baseline = None
+  if args.baseline and not args.update_baseline:
+    if stored is None:
+      parser.error(f'no {name} baseline in {path}; store one with --update-baseline')
+    baseline = stored
+    workload = Workload(**baseline['workload'])
+    concurrency = baseline['concurrency']
+  else:
+    workload = Workload(
+      skus=args.skus, order_count=args.orders, zipf_s=args.zipf_s,
+      seed=args.seed,
+    )
+    concurrency = args.concurrency
+  if not args.local:
+    # a server keeps what earlier runs created, so each run starts afresh
+    workload.prefix = f'load-{time.time_ns():x}'
+
+  result = run(backend, workload, concurrency)
+  print(json.dumps(result, indent=2))
+  if args.update_baseline:
+    tolerance = args.tolerance
+    if tolerance is None:
+      tolerance = stored['tolerance'] if stored else DEFAULT_TOLERANCE
+    save_baseline(path, name, result, workload, concurrency, tolerance)
+  if baseline is None:
+    return 0
+  found = regressions(result, baseline, args.tolerance)
+  for regression in found:
+    print(f'REGRESSION {regression}', file=sys.stderr)
+  return 1 if found else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
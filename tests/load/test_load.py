@@ -0,0 +1,42 @@
+# pylint: disable=redefined-outer-name
+from collections import Counter
+import pytest
+from . import harness
+
+
+def test_orders_are_skewed_towards_the_top_skus():
+  workload = harness.Workload(skus=100, order_count=5_000)
+  orders_per_sku = Counter(order['sku'] for order in workload.orders())
+  [(top, top_orders)] = orders_per_sku.most_common(1)
+
+  assert top == workload.sku(0)
+  assert top_orders > 10 * orders_per_sku[workload.sku(50)]
+
+
+def test_baseline_figures_are_scaled_by_the_calibration():
+  baseline = dict(
+    calibration_ms=10.0, throughput_rps=300.0, tolerance=0.5,
+    endpoints={'POST /allocate': dict(p99_ms=8.0)},
+  )
+  # twice as slow a machine, twice the latency, half the throughput
+  slower = dict(
+    calibration_ms=20.0, throughput_rps=150.0,
+    endpoints={'POST /allocate': dict(p99_ms=16.0, errors=0)},
+  )
+  assert harness.regressions(slower, baseline) == []
+
+  regressed = dict(
+    calibration_ms=10.0, throughput_rps=150.0,
+    endpoints={'POST /allocate': dict(p99_ms=16.0, errors=0)},
+  )
+  assert len(harness.regressions(regressed, baseline)) == 2
+
+
+@pytest.mark.load
+def test_local_run_has_not_regressed_from_the_baseline(mappers):
+  baseline = harness.load_baseline(harness.BASELINE, 'local')
+  result = harness.run(
+    harness.LocalBackend(), harness.Workload(**baseline['workload']),
+    baseline['concurrency'],
+  )
+  assert harness.regressions(result, baseline) == [], result
@@ -1,3 +1,5 @@
+import pytest
+from dataclasses import FrozenInstanceError
 from datetime import date
 from allocation.domain.model import Batch, OrderLine
 
@@ -39,3 +41,9 @@ def test_allocation_is_idempotent():
 	batch.allocate(line)
 	batch.allocate(line)
 	assert batch.available_quantity == 18
+
+
+def test_order_lines_are_immutable():
+	line = OrderLine('order-ref', 'SMALL-TABLE', 2)
+	with pytest.raises(FrozenInstanceError):
+		line.qty = 10
@@ -0,0 +1,89 @@
+from allocation.adapters.cache import AggregateCache, LRUCache
+
+
+def test_least_recently_used_entries_are_evicted():
+	cache = LRUCache(maxsize=2)
+	cache.set('o1', [1])
+	cache.set('o2', [2])
+	cache.get('o1')
+	cache.set('o3', [3])
+
+	assert cache.get('o1') == [1]
+	assert cache.get('o2') is None
+	assert cache.get('o3') == [3]
+
+
+def test_entries_expire_after_ttl():
+	now = [0.0]
+	cache = LRUCache(ttl=10, clock=lambda: now[0])
+	cache.set('o1', [])
+	now[0] = 9.9
+	assert cache.get('o1') == []
+	now[0] = 10
+	assert cache.get('o1') is None
+
+
+def test_counts_hits_and_misses():
+	cache = LRUCache()
+	cache.get('o1')
+	cache.set('o1', [])
+	cache.get('o1')
+	cache.get('o1')
+	cache.delete('o1')
+	cache.get('o1')
+
+	assert cache.stats() == dict(hits=2, misses=2, hit_ratio=0.5)
+
+
+def test_keys_deleted_since_their_generation_are_not_set():
+	cache = LRUCache()
+	generation = cache.generation('o1')
+	assert cache.set_if_unchanged('o1', [1], generation)
+	assert cache.get('o1') == [1]
+
+	generation = cache.generation('o1')
+	cache.delete('o2')
+	assert cache.set_if_unchanged('o1', [2], generation)
+	cache.delete('o1')
+	assert not cache.set_if_unchanged('o1', [3], generation)
+	assert cache.get('o1') is None
+
+
+def test_deletions_beyond_maxsize_are_remembered_conservatively():
+	cache = LRUCache(maxsize=2)
+	generation = cache.generation('o1')
+	cache.delete('o1')
+	cache.delete('o2')
+	cache.delete('o3')
+	assert not cache.set_if_unchanged('o1', [1], generation)
+	assert cache.set_if_unchanged('o1', [1], cache.generation('o1'))
+
+
+def test_clearing_deletes_every_key_and_its_generation():
+	cache = LRUCache()
+	cache.set('o1', [1])
+	generation = cache.generation('o2')
+	cache.clear()
+
+	assert cache.get('o1') is None
+	assert not cache.set_if_unchanged('o2', [2], generation)
+
+
+def test_aggregates_are_checked_out_by_one_reader_at_a_time():
+	cache = AggregateCache(maxsize=2)
+	product = object()
+	cache.set('sku1', product)
+
+	assert cache.get('sku1') is product
+	assert cache.get('sku1') is None
+	cache.set('sku1', product)
+	assert cache.get('sku1') is product
+
+
+def test_aggregate_cache_is_size_bounded():
+	cache = AggregateCache(maxsize=2)
+	for sku in ['sku1', 'sku2', 'sku3']:
+		cache.set(sku, object())
+
+	assert cache.get('sku1') is None
+	assert cache.stats()['size'] == 2
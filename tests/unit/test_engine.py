@@ -0,0 +1,163 @@
+import os
+from typing import Dict
+import pytest
+from allocation import bootstrap
+from allocation.domain import commands
+from allocation.service_layer import engine, handlers
+from .test_handlers import FakeNotifications, FakeUnitOfWork
+
+
+def bootstrap_test_worker():
+	return bootstrap.bootstrap(
+		start_orm=False,
+		uow=FakeUnitOfWork(),
+		notifications=FakeNotifications(),
+		publish=lambda *args: None,
+		engine_workers=0,
+	)
+
+
+@pytest.fixture
+def allocation_engine():
+	allocation_engine = engine.ShardedEngine(
+		2, make_bus=bootstrap_test_worker,
+		sku_for_batchref=lambda batchref: batchref.split('-')[0],
+	)
+	allocation_engine.start()
+	yield allocation_engine
+	allocation_engine.close()
+
+
+def skus_on_each_shard(allocation_engine):
+	skus = {}  # type: Dict[int, str]
+	for i in range(100):
+		skus.setdefault(allocation_engine.shard_for(f'sku{i}'), f'sku{i}')
+	return skus[0], skus[1]
+
+
+def test_commands_for_a_sku_go_to_the_worker_holding_its_product(allocation_engine):
+	# each worker has its own fake repository, so a misrouted command
+	# would find no product and raise InvalidSku
+	for sku in skus_on_each_shard(allocation_engine):
+		allocation_engine.handle(commands.CreateBatch(f'{sku}-b1', sku, 100, None))
+		allocation_engine.handle(commands.Allocate('o1', sku, 10))
+
+	pids = {p.pid for p in allocation_engine.processes}
+	assert len(pids) == 2
+	assert os.getpid() not in pids
+
+
+def test_errors_are_raised_to_the_caller(allocation_engine):
+	with pytest.raises(handlers.InvalidSku, match='Invalid sku nonexistent'):
+		allocation_engine.handle(commands.Allocate('o1', 'nonexistent', 10))
+
+
+def test_bulk_allocation_is_split_across_workers_and_results_kept_in_order(
+		allocation_engine,
+):
+	sku1, sku2 = skus_on_each_shard(allocation_engine)
+	allocation_engine.handle(commands.CreateBatch('b1', sku1, 100, None))
+	allocation_engine.handle(commands.CreateBatch('b2', sku2, 100, None))
+
+	results = allocation_engine.handle(commands.AllocateMany([
+		commands.Allocate('o1', sku1, 10),
+		commands.Allocate('o1', sku2, 10),
+		commands.Allocate('o2', sku1, 10),
+	]))
+
+	assert [(r['sku'], r['batchref']) for r in results] == [
+		(sku1, 'b1'), (sku2, 'b2'), (sku1, 'b1'),
+	]
+
+
+def test_batch_changes_are_routed_by_the_batch_sku(allocation_engine):
+	for sku in skus_on_each_shard(allocation_engine):
+		allocation_engine.handle(commands.CreateBatch(f'{sku}-b1', sku, 10, None))
+		allocation_engine.handle(commands.Allocate('o1', sku, 10))
+		allocation_engine.handle(commands.ChangeBatchQuantity(f'{sku}-b1', 5))
+
+	assert set(allocation_engine.batch_skus.values()) == set(
+		skus_on_each_shard(allocation_engine)
+	)
+
+
+class Unpicklable(Exception):
+
+	def __reduce__(self):
+		raise TypeError('not today')
+
+
+def bootstrap_worker_with_unpicklable_errors():
+	bus = bootstrap_test_worker()
+
+	def raise_unpicklable(cmd):
+		raise Unpicklable(cmd.ref)
+
+	bus.routes.clear()
+	bus.command_handlers[commands.ChangeBatchQuantity] = raise_unpicklable
+	return bus
+
+
+def test_errors_that_cannot_be_pickled_are_still_reported():
+	allocation_engine = engine.ShardedEngine(
+		1, make_bus=bootstrap_worker_with_unpicklable_errors,
+		sku_for_batchref=lambda batchref: 'sku1', timeout=10,
+	)
+	allocation_engine.start()
+	try:
+		with pytest.raises(engine.EngineError, match='Unpicklable'):
+			allocation_engine.handle(commands.ChangeBatchQuantity('b1', 5))
+	finally:
+		allocation_engine.close()
+
+
+def test_requests_fail_when_their_worker_dies(allocation_engine):
+	sku1, sku2 = skus_on_each_shard(allocation_engine)
+	allocation_engine.handle(commands.CreateBatch('b2', sku2, 100, None))
+	worker = allocation_engine.processes[allocation_engine.shard_for(sku1)]
+	worker.kill()
+	worker.join()
+
+	with pytest.raises(engine.WorkerDied):
+		allocation_engine.handle(commands.CreateBatch('b1', sku1, 100, None))
+	allocation_engine.handle(commands.Allocate('o1', sku2, 10))
+
+
+def test_requests_that_time_out_are_given_up_on():
+	# never started, so nothing answers
+	allocation_engine = engine.ShardedEngine(
+		1, make_bus=bootstrap_test_worker,
+		sku_for_batchref=lambda batchref: 'sku1', timeout=0.05,
+	)
+	with pytest.raises(engine.EngineTimeout, match='may or may not'):
+		allocation_engine.handle(commands.CreateBatch('b1', 'sku1', 100, None))
+	with pytest.raises(engine.EngineTimeout):
+		allocation_engine.handle(commands.AllocateMany([
+			commands.Allocate('o1', 'sku1', 10),
+		]))
+
+	assert allocation_engine.futures == {}
+
+
+def test_the_batch_sku_memo_is_bounded():
+	lookups = []
+
+	def sku_for_batchref(batchref):
+		lookups.append(batchref)
+		return 'sku1'
+
+	allocation_engine = engine.ShardedEngine(
+		1, make_bus=bootstrap_test_worker, sku_for_batchref=sku_for_batchref,
+		max_batch_skus=2,
+	)
+	for ref in ['b1', 'b2', 'b1', 'b3', 'b1', 'b2']:
+		allocation_engine._sku(commands.ChangeBatchQuantity(ref, 1))
+
+	assert list(allocation_engine.batch_skus) == ['b1', 'b2']
+	assert lookups == ['b1', 'b2', 'b3', 'b2']
+
+
+def test_the_engine_refuses_a_store_its_workers_cannot_share(monkeypatch):
+	monkeypatch.setenv('STORE', 'memory')
+	with pytest.raises(ValueError, match='STORE=memory'):
+		bootstrap.make_engine(2)
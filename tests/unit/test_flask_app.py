@@ -0,0 +1,80 @@
+import threading
+from allocation.entrypoints.flask_app import create_app
+from .test_handlers import bootstrap_test_app
+
+
+def make_app():
+	buses = []
+
+	def make_bus():
+		bus = bootstrap_test_app()
+		buses.append(bus)
+		return bus
+
+	return create_app(make_bus=make_bus), buses
+
+
+def post_batch(app, ref, sku):
+	response = app.test_client().post('/add_batch', json=dict(
+		ref=ref, sku=sku, qty=100, eta=None,
+	))
+	assert response.status_code == 201
+
+
+def test_nothing_is_bootstrapped_until_the_first_request():
+	app, buses = make_app()
+	assert buses == []
+
+	post_batch(app, 'b1', 'sku1')
+	post_batch(app, 'b2', 'sku1')
+	assert len(buses) == 1
+
+
+def test_each_thread_gets_its_own_bus_and_unit_of_work():
+	app, buses = make_app()
+	threads = [
+		threading.Thread(target=post_batch, args=(app, f'b{i}', f'sku{i}'))
+		for i in range(3)
+	]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	assert len(buses) == 3
+	assert len({id(bus.uow) for bus in buses}) == 3
+
+
+def test_requests_use_their_thread_bus():
+	app, buses = make_app()
+	post_batch(app, 'b1', 'sku1')
+	response = app.test_client().post('/allocate', json=dict(
+		orderid='o1', sku='nonexistent', qty=10,
+	))
+
+	assert response.status_code == 400
+	[bus] = buses
+	assert bus.uow.products.get('sku1') is not None
+
+
+def test_malformed_bulk_allocations_are_rejected():
+	app, _ = make_app()
+	post_batch(app, 'b1', 'sku1')
+	client = app.test_client()
+	for payload, message in [
+		({}, 'Expected an object with a list of lines'),
+		({'lines': 'o1'}, 'Expected an object with a list of lines'),
+		({'lines': [None]}, 'Line 0 is not an object'),
+		({'lines': [dict(orderid='o1', sku='sku1', qty=1), dict(orderid='o2')]},
+		 'Line 1 has no sku, qty'),
+		({'lines': [dict(orderid='o1', sku='sku1', qty='1')]},
+		 'Line 0 has a qty that is not an integer'),
+	]:
+		response = client.post('/allocate/bulk', json=payload)
+		assert response.status_code == 400
+		assert response.json['message'] == message
+
+	response = client.post('/allocate/bulk', json={
+		'lines': [dict(orderid='o1', sku='sku1', qty=1)],
+	})
+	assert response.status_code == 202
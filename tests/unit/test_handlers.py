@@ -44,6 +44,21 @@ class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
 		pass
 
 
+class FlakyUnitOfWork(FakeUnitOfWork):
+
+	def __init__(self, conflicts):
+		super().__init__()
+		self.conflicts = conflicts
+		self.attempts = 0
+
+	def _commit(self):
+		self.attempts += 1
+		if self.conflicts:
+			self.conflicts -= 1
+			raise unit_of_work.ConcurrencyError('version conflict')
+		super()._commit()
+
+
 class FakeNotifications(notifications.AbstractNotifications):
 
 	def __init__(self):
@@ -120,6 +135,109 @@ class TestAllocate:
 
 
 
+class TestConcurrencyRetries:
+
+	def bootstrap_flaky_app(self, conflicts):
+		bus = bootstrap.bootstrap(
+			start_orm=False,
+			uow=FlakyUnitOfWork(conflicts),
+			notifications=FakeNotifications(),
+			publish=lambda *args: None,
+		)
+		bus.retry_backoff = 0
+		return bus
+
+	def test_retries_command_after_a_conflict(self):
+		bus = self.bootstrap_flaky_app(conflicts=0)
+		bus.handle(commands.CreateBatch("b1", "WOBBLY-STOOL", 100, None))
+		bus.uow.conflicts = 2
+		bus.handle(commands.Allocate("o1", "WOBBLY-STOOL", 10))
+		assert bus.uow.attempts == 1 + 3
+		assert bus.uow.committed
+
+
+	def test_gives_up_after_bounded_attempts(self):
+		bus = self.bootstrap_flaky_app(conflicts=0)
+		bus.handle(commands.CreateBatch("b1", "WOBBLY-STOOL", 100, None))
+		bus.uow.conflicts = 10
+		with pytest.raises(unit_of_work.ConcurrencyError):
+			bus.handle(commands.Allocate("o1", "WOBBLY-STOOL", 10))
+		assert bus.uow.attempts == 1 + bus.retry_attempts
+
+
+
+class TestAllocateMany:
+
+	def test_allocates_every_line_and_reports_batchrefs(self):
+		bus = bootstrap_test_app()
+		bus.handle(commands.CreateBatch("b1", "SHINY-KETTLE", 100, None))
+		bus.handle(commands.CreateBatch("b2", "FADED-MUG", 10, None))
+		[results] = bus.handle(commands.AllocateMany([
+			commands.Allocate("o1", "SHINY-KETTLE", 10),
+			commands.Allocate("o2", "FADED-MUG", 5),
+			commands.Allocate("o3", "SHINY-KETTLE", 20),
+			commands.Allocate("o4", "FADED-MUG", 50),
+		]))
+		assert [r['batchref'] for r in results] == ["b1", "b2", "b1", None]
+		assert bus.uow.products.get("SHINY-KETTLE").batches[0].available_quantity == 70
+
+
+	def test_reports_invalid_skus_per_line(self):
+		bus = bootstrap_test_app()
+		bus.handle(commands.CreateBatch("b1", "REAL-TEAPOT", 100, None))
+		[results] = bus.handle(commands.AllocateMany([
+			commands.Allocate("o1", "NONEXISTENTSKU", 10),
+			commands.Allocate("o2", "REAL-TEAPOT", 10),
+		]))
+		assert results[0]['message'] == "Invalid sku NONEXISTENTSKU"
+		assert results[1]['batchref'] == "b1"
+
+
+	def test_sends_one_notification_per_out_of_stock_line(self):
+		fake_notifs = FakeNotifications()
+		bus = bootstrap.bootstrap(
+			start_orm=False,
+			uow=FakeUnitOfWork(),
+			notifications=fake_notifs,
+			publish=lambda *args: None,
+		)
+		bus.handle(commands.CreateBatch("b1", "RARE-VASE", 1, None))
+		bus.handle(commands.AllocateMany([
+			commands.Allocate("o1", "RARE-VASE", 5),
+			commands.Allocate("o2", "RARE-VASE", 5),
+		]))
+		assert len(fake_notifs.sent['stock@made.com']) == 2
+
+
+	def test_a_failing_sku_does_not_lose_the_events_of_the_others(self):
+		class BrokenSkuRepository(FakeRepository):
+			def _get(self, sku):
+				if sku == "BROKEN-LAMP":
+					raise OSError('database went away')
+				return super()._get(sku)
+
+		published = []
+		uow = FakeUnitOfWork()
+		uow.products = BrokenSkuRepository([])
+		bus = bootstrap.bootstrap(
+			start_orm=False,
+			uow=uow,
+			notifications=FakeNotifications(),
+			publish=lambda channel, event: published.append(event),
+			outbox=False,
+		)
+		bus.handle(commands.CreateBatch("b1", "SOLID-LAMP", 100, None))
+		[results] = bus.handle(commands.AllocateMany([
+			commands.Allocate("o1", "SOLID-LAMP", 10),
+			commands.Allocate("o2", "BROKEN-LAMP", 10),
+		]))
+
+		assert results[0]['batchref'] == "b1"
+		assert results[1]['message'] == "Could not allocate sku BROKEN-LAMP"
+		assert [e.orderid for e in published] == ["o1"]
+
+
+
 class TestChangeBatchQuantity:
 
 	def test_changes_available_quantity(self):
@@ -0,0 +1,72 @@
+import asyncio
+import threading
+import time
+from collections import defaultdict
+from allocation.entrypoints.redis_eventconsumer import BatchSkus, KeyedDispatcher
+
+
+def run_dispatcher(messages, workers, max_pending):
+	handled = defaultdict(list)
+	running = []
+	peak = []
+	lock = threading.Lock()
+
+	def handler(message):
+		key, n = message
+		with lock:
+			running.append(message)
+			peak.append(len(running))
+		time.sleep(0.01)
+		with lock:
+			running.remove(message)
+			handled[key].append(n)
+
+	async def main():
+		dispatcher = KeyedDispatcher([handler] * workers, max_pending=max_pending)
+		dispatcher.start()
+		for key, n in messages:
+			await dispatcher.submit(key, (key, n))
+			assert dispatcher.pending <= max_pending
+		await dispatcher.drain()
+		return dispatcher
+
+	dispatcher = asyncio.run(main())
+	return handled, max(peak), dispatcher
+
+
+def test_messages_with_the_same_key_are_handled_in_order():
+	messages = [(f'batch{i % 5}', i) for i in range(50)]
+	handled, _, _ = run_dispatcher(messages, workers=4, max_pending=10)
+	for key, numbers in handled.items():
+		assert numbers == sorted(numbers)
+	assert sum(len(numbers) for numbers in handled.values()) == 50
+
+
+def test_different_keys_are_handled_concurrently():
+	messages = [(f'batch{i}', i) for i in range(40)]
+	_, peak, _ = run_dispatcher(messages, workers=4, max_pending=10)
+	assert peak > 1
+
+
+def test_drain_waits_for_everything_submitted():
+	messages = [('batch1', i) for i in range(20)]
+	handled, _, dispatcher = run_dispatcher(messages, workers=2, max_pending=3)
+	assert handled['batch1'] == list(range(20))
+	assert dispatcher.pending == 0
+
+
+def test_batch_skus_are_looked_up_once_and_unknown_ones_again():
+	lookups = []
+	known = {'batch1': 'LAMP'}
+
+	def lookup(batchref):
+		lookups.append(batchref)
+		return known.get(batchref)
+
+	batch_skus = BatchSkus(lookup)
+	assert batch_skus('batch1') == 'LAMP'
+	assert batch_skus('batch1') == 'LAMP'
+	assert batch_skus('batch2') is None
+	known['batch2'] = 'LAMP'
+	assert batch_skus('batch2') == 'LAMP'
+	assert lookups == ['batch1', 'batch2', 'batch2']
@@ -0,0 +1,127 @@
+from dataclasses import dataclass
+from typing import List, cast
+import pytest
+from allocation.domain import commands, events
+from allocation.service_layer import messagebus, unit_of_work
+from .test_handlers import FakeUnitOfWork
+
+
+def make_bus(batches, batch_events=True):
+	def deallocate_everything(cmd):
+		product_events = [
+			events.Deallocated(f'o{i}', 'sku1', 1) for i in range(cmd.qty)
+		]
+		bus.queue.extend(product_events)
+
+	def reallocate(event):
+		bus.queue.append(events.Allocated(event.orderid, 'sku1', 1, 'b2'))
+
+	bus = messagebus.MessageBus(
+		uow=FakeUnitOfWork(),
+		event_handlers={
+			events.Deallocated: [reallocate],
+			events.Allocated: [],
+		},
+		command_handlers={commands.ChangeBatchQuantity: deallocate_everything},
+		batch_event_handlers={
+			events.Deallocated: [lambda batch: batches.append(batch)],
+			events.Allocated: [lambda batch: batches.append(batch)],
+		},
+		batch_events=batch_events,
+	)
+	return bus
+
+
+def test_events_of_one_type_are_delivered_as_a_batch():
+	batches = []  # type: List[List[events.Event]]
+	bus = make_bus(batches)
+	bus.handle(commands.ChangeBatchQuantity('b1', 3))
+
+	assert [[type(e) for e in batch] for batch in batches] == [
+		[events.Deallocated] * 3,
+		[events.Allocated] * 3,
+	]
+
+
+def test_batching_can_be_turned_off():
+	batches = []  # type: List[List[events.Event]]
+	bus = make_bus(batches, batch_events=False)
+	bus.handle(commands.ChangeBatchQuantity('b1', 3))
+
+	assert [len(batch) for batch in batches] == [1] * 6
+	assert [type(batch[0]) for batch in batches[:2]] == [
+		events.Deallocated, events.Deallocated,
+	]
+
+
+def test_after_handle_hooks_run_even_when_a_command_fails():
+	flushed = []
+
+	def blow_up(cmd):
+		raise ValueError('no')
+
+	bus = messagebus.MessageBus(
+		uow=FakeUnitOfWork(),
+		event_handlers={},
+		command_handlers={commands.ChangeBatchQuantity: blow_up},
+		after_handle=[lambda: flushed.append(True)],
+	)
+	with pytest.raises(ValueError):
+		bus.handle(commands.ChangeBatchQuantity('b1', 3))
+	assert flushed == [True]
+
+
+def test_messages_are_routed_through_their_base_classes():
+	@dataclass
+	class UrgentAllocate(commands.Allocate):
+		pass
+
+	class LateOutOfStock(events.OutOfStock):
+		pass
+
+	handled = []  # type: List[events.Event]
+	bus = messagebus.MessageBus(
+		uow=FakeUnitOfWork(),
+		event_handlers={events.OutOfStock: [handled.append]},
+		command_handlers={commands.Allocate: lambda cmd: 'b1'},
+	)
+
+	assert bus.handle(UrgentAllocate('o1', 'sku1', 10)) == ['b1']
+	bus.handle(LateOutOfStock('sku1'))
+	assert [type(e) for e in handled] == [LateOutOfStock]
+	assert UrgentAllocate in bus.routes
+
+
+def test_messages_that_are_neither_events_nor_commands_are_rejected():
+	bus = messagebus.MessageBus(
+		uow=FakeUnitOfWork(), event_handlers={}, command_handlers={},
+	)
+	class Stray:
+		pass  # as a caller might pass by mistake
+
+	with pytest.raises(Exception, match='was not an Event or Command'):
+		bus.handle(cast(messagebus.Message, Stray()))
+
+
+def test_commands_retried_by_their_handler_are_not_retried_again():
+	attempts = []
+
+	def conflict(cmd):
+		attempts.append(cmd)
+		raise unit_of_work.ConcurrencyError('version conflict')
+
+	bus = messagebus.MessageBus(
+		uow=FakeUnitOfWork(), event_handlers={},
+		command_handlers={
+			commands.Allocate: conflict, commands.CreateBatch: conflict,
+		},
+		retry_backoff=0,
+		unretried_commands=[commands.Allocate],
+	)
+	with pytest.raises(unit_of_work.ConcurrencyError):
+		bus.handle(commands.Allocate('o1', 'sku1', 10))
+	assert len(attempts) == 1
+
+	with pytest.raises(unit_of_work.ConcurrencyError):
+		bus.handle(commands.CreateBatch('b1', 'sku1', 10, None))
+	assert len(attempts) == 1 + bus.retry_attempts
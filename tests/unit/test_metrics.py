@@ -0,0 +1,108 @@
+import pytest
+from allocation import bootstrap
+from allocation.adapters.metrics import PrometheusMetrics
+from allocation.domain import commands
+from allocation.entrypoints.flask_app import create_app
+from allocation.service_layer import handlers, unit_of_work
+from .test_handlers import (
+	FakeNotifications, FakeUnitOfWork, FlakyUnitOfWork, bootstrap_test_app,
+)
+
+
+def bootstrap_measured_app(metrics, uow=None):
+	return bootstrap.bootstrap(
+		start_orm=False,
+		uow=uow or FakeUnitOfWork(),
+		notifications=FakeNotifications(),
+		publish=lambda *args: None,
+		metrics=metrics,
+	)
+
+
+def test_histograms_are_rendered_with_cumulative_buckets():
+	metrics = PrometheusMetrics()
+	for seconds in [0.0004, 0.003, 0.003, 10]:
+		metrics.observe('allocation_commit_seconds', seconds)
+	lines = metrics.render().splitlines()
+
+	assert '# TYPE allocation_commit_seconds histogram' in lines
+	assert 'allocation_commit_seconds_bucket{le="0.0005"} 1' in lines
+	assert 'allocation_commit_seconds_bucket{le="0.005"} 3' in lines
+	assert 'allocation_commit_seconds_bucket{le="5.0"} 3' in lines
+	assert 'allocation_commit_seconds_bucket{le="+Inf"} 4' in lines
+	assert 'allocation_commit_seconds_count 4' in lines
+
+
+def test_counters_and_samples_are_rendered_with_their_types_and_labels():
+	metrics = PrometheusMetrics()
+	metrics.increment('allocation_handler_errors_total', message_type='Allocate', handler='allocate')
+	metrics.increment('allocation_handler_errors_total', message_type='Allocate', handler='allocate')
+	metrics.add_samples(lambda: {
+		'allocation_db_pool_checked_out': 3,
+		'allocation_db_pool_checkouts_total': 40,
+	})
+	lines = metrics.render().splitlines()
+
+	assert 'allocation_handler_errors_total{handler="allocate",message_type="Allocate"} 2.0' in lines
+	assert '# TYPE allocation_db_pool_checked_out gauge' in lines
+	assert 'allocation_db_pool_checked_out 3' in lines
+	assert '# TYPE allocation_db_pool_checkouts_total counter' in lines
+	assert 'allocation_db_pool_checkouts_total 40' in lines
+
+
+def test_cumulative_pool_stats_are_exported_as_counters(monkeypatch):
+	monkeypatch.setattr(unit_of_work, 'pool_stats', lambda: dict(
+		size=5, checked_out=2, overflow=0, checkouts=40,
+		wait_seconds_total=0.5, wait_seconds_max=0.1,
+	))
+	metrics = PrometheusMetrics()
+	metrics.add_samples(unit_of_work.pool_metrics)
+	lines = metrics.render().splitlines()
+
+	assert [line for line in lines if line.startswith('# TYPE')] == [
+		'# TYPE allocation_db_pool_size gauge',
+		'# TYPE allocation_db_pool_checked_out gauge',
+		'# TYPE allocation_db_pool_overflow gauge',
+		'# TYPE allocation_db_pool_checkouts_total counter',
+		'# TYPE allocation_db_pool_wait_seconds_total counter',
+	]
+
+
+def test_the_bus_times_each_message_and_counts_handler_errors():
+	metrics = PrometheusMetrics()
+	bus = bootstrap_measured_app(metrics)
+	bus.handle(commands.CreateBatch('b1', 'sku1', 100, None))
+	bus.handle(commands.Allocate('o1', 'sku1', 10))
+	with pytest.raises(handlers.InvalidSku):
+		bus.handle(commands.Allocate('o2', 'nonexistent', 10))
+	rendered = metrics.render()
+
+	assert 'allocation_message_seconds_count{kind="command",message_type="Allocate"} 2' in rendered
+	assert 'allocation_message_seconds_count{kind="event",message_type="Allocated"} 1' in rendered
+	assert 'allocation_scan_length_count 1' in rendered
+	assert 'allocation_handler_errors_total{handler="allocate",message_type="Allocate"} 1.0' in rendered
+
+
+def test_the_bus_counts_retried_commands():
+	metrics = PrometheusMetrics()
+	uow = FlakyUnitOfWork(conflicts=0)
+	bus = bootstrap_measured_app(metrics, uow=uow)
+	bus.handle(commands.CreateBatch('b1', 'sku1', 100, None))
+	uow.conflicts = 2
+	bus.handle(commands.Allocate('o1', 'sku1', 10))
+
+	assert 'allocation_command_retries_total{message_type="Allocate"} 2.0' in metrics.render()
+
+
+def test_metrics_are_served_only_when_enabled():
+	metrics = PrometheusMetrics()
+	metrics.observe('allocation_commit_seconds', 0.001)
+	# /metrics never needs a bus
+	enabled = create_app(make_bus=bootstrap_test_app, metrics=metrics).test_client()
+	disabled = create_app(make_bus=bootstrap_test_app).test_client()
+
+	response = enabled.get('/metrics')
+	assert response.status_code == 200
+	assert response.content_type.startswith('text/plain; version=0.0.4')
+	assert b'allocation_commit_seconds_count 1' in response.data
+	assert disabled.get('/metrics').status_code == 404
@@ -0,0 +1,84 @@
+import smtplib
+from typing import List, Tuple
+from allocation.adapters.notifications import QueuedEmailNotifications
+
+
+class FakeSMTP:
+
+	def __init__(self, log, drop_after=None):
+		self.log = log
+		self.drop_after = drop_after
+
+	def sendmail(self, from_addr, to_addrs, msg):
+		if self.drop_after is not None and len(self.log) >= self.drop_after:
+			raise smtplib.SMTPServerDisconnected('bye')
+		self.log.append((to_addrs, msg))
+
+	def quit(self):
+		pass
+
+
+def make_notifications(connections, log, clock=None, **kwargs):
+	def connect():
+		connection = FakeSMTP(log, **kwargs)
+		connections.append(connection)
+		kwargs.pop('drop_after', None)
+		return connection
+
+	return QueuedEmailNotifications(
+		workers=1, connect=connect, clock=clock or (lambda: 0),
+	)
+
+
+def test_sends_in_the_background_over_one_connection():
+	connections = []  # type: List[FakeSMTP]
+	log = []  # type: List[Tuple[List[str], str]]
+	notifications = make_notifications(connections, log)
+	for sku in ['A', 'B', 'C']:
+		notifications.send('stock@made.com', f'Out of stock for {sku}')
+	notifications.flush()
+	notifications.close()
+
+	assert [to for to, _ in log] == [['stock@made.com']] * 3
+	assert 'Out of stock for C' in log[-1][1]
+	assert len(connections) == 1
+
+
+def test_reconnects_when_the_server_drops_the_connection():
+	connections = []  # type: List[FakeSMTP]
+	log = []  # type: List[Tuple[List[str], str]]
+	notifications = make_notifications(connections, log, drop_after=1)
+	notifications.send('stock@made.com', 'Out of stock for A')
+	notifications.send('stock@made.com', 'Out of stock for B')
+	notifications.flush()
+	notifications.close()
+
+	assert len(log) == 2
+	assert len(connections) == 2
+
+
+def test_repeated_messages_within_the_window_are_sent_once():
+	now = [0.0]
+	connections = []  # type: List[FakeSMTP]
+	log = []  # type: List[Tuple[List[str], str]]
+	notifications = make_notifications(connections, log, clock=lambda: now[0])
+	for _ in range(1000):
+		notifications.send('stock@made.com', 'Out of stock for A')
+	now[0] += notifications.dedup_window + 1
+	notifications.send('stock@made.com', 'Out of stock for A')
+	notifications.flush()
+	notifications.close()
+
+	assert len(log) == 2
+
+
+def test_a_message_dropped_on_a_full_queue_can_be_sent_again():
+	notifications = QueuedEmailNotifications(
+		workers=0, max_queued=1, connect=lambda: None, clock=lambda: 0,
+	)
+	notifications.send('stock@made.com', 'Out of stock for A')
+	notifications.send('stock@made.com', 'Out of stock for B')  # queue full
+	assert notifications.queue.get_nowait() == ('stock@made.com', 'Out of stock for A')
+
+	notifications.send('stock@made.com', 'Out of stock for B')
+	assert notifications.queue.get_nowait() == ('stock@made.com', 'Out of stock for B')
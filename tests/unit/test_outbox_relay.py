@@ -0,0 +1,46 @@
+from unittest import mock
+import pytest
+from allocation.entrypoints import outbox_relay
+
+SETTINGS = dict(batch_size=10, poll_interval=0.1, max_backoff=1.0)
+
+
+class Stop(Exception):
+	pass
+
+
+def relay(results, sleeps):
+	"""Runs the relay until it has slept len(results) times."""
+	results = iter(results)
+	delays = []
+
+	def relay_batch(session, publish_batch, batch_size):
+		result = next(results)
+		if isinstance(result, Exception):
+			raise result
+		return result
+
+	def sleep(delay):
+		delays.append(delay)
+		if len(delays) == sleeps:
+			raise Stop()
+
+	with mock.patch.object(outbox_relay.outbox, 'relay_batch', relay_batch):
+		with pytest.raises(Stop):
+			outbox_relay.relay_forever(mock.Mock, mock.Mock(), SETTINGS, sleep=sleep)
+	return delays
+
+
+def test_failures_back_off_up_to_the_cap():
+	results = [ConnectionError()] * 6
+	assert relay(results, sleeps=6) == [0.1, 0.2, 0.4, 0.8, 1.0, 1.0]
+
+
+def test_a_success_resets_the_backoff():
+	results = [ConnectionError(), ConnectionError(), 3, ConnectionError()]
+	assert relay(results, sleeps=4) == [0.1, 0.2, 0.1, 0.1]
+
+
+def test_full_batches_are_relayed_without_waiting():
+	results = [10, 10, 3]
+	assert relay(results, sleeps=1) == [0.1]
@@ -69,3 +69,85 @@ def test_increments_version_number():
   product.version_number = 7
   product.allocate(line)
   assert product.version_number == 8
+
+
+def test_adding_or_rescheduling_batches_increments_version_number():
+  product = Product(sku="SCANDI-PEN", batches=[], version_number=7)
+  product.add_batch(Batch('b1', "SCANDI-PEN", 100, eta=None))
+  product.change_batch_eta('b1', today)
+  assert product.version_number == 9
+
+
+def test_skips_batches_without_enough_capacity():
+  small = Batch("small-batch", "TALL-VASE", 5, eta=None)
+  medium = Batch("medium-batch", "TALL-VASE", 20, eta=today)
+  large = Batch("large-batch", "TALL-VASE", 100, eta=later)
+  product = Product(sku="TALL-VASE", batches=[large, small, medium])
+
+  assert product.allocate(OrderLine("order1", "TALL-VASE", 30)) == "large-batch"
+  assert product.allocate(OrderLine("order2", "TALL-VASE", 10)) == "medium-batch"
+  assert product.allocate(OrderLine("order3", "TALL-VASE", 5)) == "small-batch"
+  assert product.allocate(OrderLine("order4", "TALL-VASE", 80)) is None
+
+
+def test_added_batches_join_the_allocation_order():
+  shipment = Batch("shipment-batch", "FLUFFY-RUG", 100, eta=tomorrow)
+  product = Product(sku="FLUFFY-RUG", batches=[shipment])
+  product.allocate(OrderLine("order1", "FLUFFY-RUG", 10))
+
+  product.add_batch(Batch("in-stock-batch", "FLUFFY-RUG", 100, eta=None))
+
+  assert product.allocate(OrderLine("order2", "FLUFFY-RUG", 10)) == "in-stock-batch"
+
+
+def test_changing_eta_reorders_batches():
+  earlier = Batch("earlier-batch", "CURVY-LAMP", 100, eta=tomorrow)
+  later_batch = Batch("later-batch", "CURVY-LAMP", 100, eta=later)
+  product = Product(sku="CURVY-LAMP", batches=[earlier, later_batch])
+  product.allocate(OrderLine("order1", "CURVY-LAMP", 10))
+
+  product.change_batch_eta("later-batch", today)
+
+  assert product.allocate(OrderLine("order2", "CURVY-LAMP", 10)) == "later-batch"
+
+
+def test_shrinking_a_batch_frees_it_from_the_allocation_order():
+  first = Batch("first-batch", "QUIET-FAN", 20, eta=None)
+  second = Batch("second-batch", "QUIET-FAN", 20, eta=today)
+  product = Product(sku="QUIET-FAN", batches=[first, second])
+
+  product.change_batch_quantity("first-batch", 5)
+
+  assert product.allocate(OrderLine("order1", "QUIET-FAN", 10)) == "second-batch"
+
+
+def test_shrinking_a_batch_reallocates_displaced_lines():
+  first = Batch("first-batch", "WIDE-SHELF", 20, eta=None)
+  second = Batch("second-batch", "WIDE-SHELF", 50, eta=today)
+  product = Product(sku="WIDE-SHELF", batches=[first, second])
+  product.allocate(OrderLine("order1", "WIDE-SHELF", 10))
+  product.allocate(OrderLine("order2", "WIDE-SHELF", 10))
+  product.events.clear()
+
+  product.change_batch_quantity("first-batch", 15)
+
+  assert first.available_quantity == 5
+  assert second.available_quantity == 40
+  [deallocated, allocated] = product.events
+  assert isinstance(deallocated, events.Deallocated)
+  assert allocated == events.Allocated(
+    orderid=deallocated.orderid, sku="WIDE-SHELF", qty=10,
+    batchref="second-batch",
+  )
+
+
+def test_finds_batches_by_reference():
+  batches = [
+    Batch(f"batch-{i}", "TINY-SPOON", 10, eta=today + timedelta(days=i))
+    for i in range(100)
+  ]
+  product = Product(sku="TINY-SPOON", batches=batches)
+
+  assert product.get_batch("batch-42") is batches[42]
+  product.add_batch(Batch("batch-new", "TINY-SPOON", 10, eta=None))
+  assert product.get_batch("batch-new").reference == "batch-new"
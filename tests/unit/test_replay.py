@@ -0,0 +1,93 @@
+import io
+import json
+from typing import Dict
+import pytest
+from allocation import bootstrap
+from allocation.domain import commands, model
+from allocation.entrypoints import replay
+from allocation.service_layer import unit_of_work
+from .test_handlers import FakeNotifications
+
+PLAN = [
+	dict(command='CreateBatch', ref='b1', sku='LAMP', qty=10, eta=None),
+	dict(command='CreateBatch', ref='b2', sku='LAMP', qty=10, eta='2026-10-20'),
+]
+
+
+def run_replay(*lines):
+	commands_file = io.StringIO(''.join(json.dumps(line) + '\n' for line in lines))
+	output = io.StringIO()
+	bus = replay.make_bus('memory', ':memory:', replay.OutOfStockLog())
+	totals = replay.replay(bus, replay.read_commands([commands_file]), output)
+	return totals, [json.loads(line) for line in output.getvalue().splitlines()]
+
+
+def test_in_memory_units_of_work_share_their_store():
+	products = {}  # type: Dict[str, model.Product]
+	bus = bootstrap.bootstrap(
+		start_orm=False,
+		uow=unit_of_work.InMemoryUnitOfWork(products),
+		notifications=FakeNotifications(),
+		publish=lambda *args: None,
+	)
+	bus.handle(commands.CreateBatch('b1', 'LAMP', 10, None))
+
+	uow = unit_of_work.InMemoryUnitOfWork(products)
+	with uow:
+		assert uow.products.get_by_batchref('b1').sku == 'LAMP'
+	assert bus.handle(commands.Allocate('o1', 'LAMP', 2)) == ['b1']
+
+
+def test_replay_reports_each_allocation():
+	totals, allocations = run_replay(
+		*PLAN,
+		dict(command='Allocate', orderid='o1', sku='LAMP', qty=8),
+		dict(command='Allocate', orderid='o2', sku='LAMP', qty=8),
+		dict(command='Allocate', orderid='o3', sku='LAMP', qty=8),
+	)
+
+	assert [a['batchref'] for a in allocations] == ['b1', 'b2', None]
+	assert totals['commands'] == 5
+	assert (totals['allocated'], totals['unallocated']) == (2, 1)
+
+
+def test_replay_reports_unknown_skus_and_carries_on():
+	_, allocations = run_replay(
+		*PLAN,
+		dict(command='Allocate', orderid='o1', sku='NOPE', qty=1),
+		dict(command='AllocateMany', lines=[
+			dict(orderid='o2', sku='LAMP', qty=1),
+			dict(orderid='o3', sku='NOPE', qty=1),
+		]),
+	)
+
+	assert allocations[0]['message'] == 'Invalid sku NOPE'
+	assert [a['batchref'] for a in allocations] == [None, 'b1', None]
+
+
+def test_replay_reports_failed_commands_of_every_type():
+	totals, lines = run_replay(
+		*PLAN,
+		dict(command='ChangeBatchQuantity', ref='nope', qty=5),
+		dict(command='Allocate', orderid='o1', sku='LAMP', qty=1),
+	)
+
+	assert lines[0] == dict(
+		command='ChangeBatchQuantity', ref='nope', qty=5,
+		message='Invalid batchref nope',
+	)
+	assert lines[1]['batchref'] == 'b1'
+	assert totals['failed'] == 1
+
+
+def test_an_in_memory_store_is_refused_where_it_would_lose_events(monkeypatch):
+	with pytest.raises(ValueError, match='OUTBOX=1'):
+		bootstrap.bootstrap(
+			start_orm=False, uow=unit_of_work.InMemoryUnitOfWork({}),
+			notifications=FakeNotifications(), publish=lambda *args: None,
+			outbox=True,
+		)
+
+	monkeypatch.setenv('STORE', 'memory')
+	with pytest.raises(ValueError, match='STORE=memory'):
+		bootstrap.make_bus_factory()